@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+
+#
+# Benchmarks for the analysis hot paths and the models, so that the effect of
+# a change (to a profile's settings, image sizing, an engine...) can be measured
+# rather than guessed at. See --help.
+#
+# Each benchmark is run on a set of cases: synthetic images of a few sizes and
+# numbers of colors (see synthetic_image), plus samples/01_in.jpg. For each we
+# report the wall time (the best of as many runs as fit in --min-time, or of
+# one run for anything slower than that) and the peak memory allocated while
+# it ran, as traced by tracemalloc. That includes NumPy arrays but not
+# OpenCV's internal buffers. The clustering benchmarks also report the palette
+# error: the Earth Mover's Distance, in RGB, between the palette we got and
+# the reference palette for the case (the colors a synthetic image was made
+# from, or reference.json for the sample), i.e. how far, per pixel, the colors
+# are off.
+#
+# Results are written as JSON. Pass an earlier run as --baseline to compare:
+# anything that got slower, used more memory or lost accuracy by more than
+# --threshold is reported, and we exit with 1.
+#
+
+from argparse import ArgumentParser
+from datetime import datetime
+from datetime import timezone
+from json import dump
+from json import load
+from os import cpu_count
+from os.path import abspath
+from os.path import dirname
+from os.path import join
+from os.path import realpath
+from platform import platform
+from platform import python_version
+from random import Random
+from sys import exit
+from sys import path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+import tracemalloc
+
+# So that we can import cw without installing it. (Before cv2, which replaces
+# sys.path when it's imported.)
+path.append(abspath(dirname(dirname(realpath(__file__)))))
+
+import cv2
+import numpy as np
+import cw.utils.color_analysis as color_analysis
+from cw.models import ColorVolume
+from cw.models import Image
+from cw.models import ImageSet
+from cw.utils.color_analysis import COLOR_SPACES
+from cw.utils.color_analysis import ENGINES
+from cw.utils.color_analysis import ImageAnalyzer
+from cw.utils.color_analysis import MAX_PIXELS
+from cw.utils.color_analysis import PROFILE
+from cw.utils.color_analysis import PROFILES
+from cw.utils.color_analysis import SWEEPS
+from cw.utils.color_analysis import WORKERS
+from cw.utils.decode import RESAMPLES
+
+DESCRIPTION = 'Benchmark image analysis and the models.'
+
+BENCHMARKS_DIR = dirname(realpath(__file__))
+SAMPLE = join(dirname(BENCHMARKS_DIR), 'samples', '01_in.jpg')
+REFERENCE = join(BENCHMARKS_DIR, 'reference.json')
+
+SIZES = (128, 256, 512) # synthetic images are SIZE x SIZE
+COMPLEXITIES = (3, 6, 10) # ...with this many colors
+KS = (1, 2, 4, 8, 12)
+IMAGE_SET_SIZES = (1000, 100000)
+MIN_TIME = 0.2 # seconds
+NOISE = 8 # standard deviation, per channel, of the noise in synthetic images
+THRESHOLD = 0.1
+
+HELP = {
+    'output' : "Where to write the results. (default: benchmark.json)",
+
+    'baseline' : """Results of an earlier run to compare with. Exits with 1 if
+anything regressed by more than --threshold.""",
+
+    'threshold' : f"""How much slower, bigger, or less accurate than the
+baseline counts as a regression, e.g. 0.1 for 10%%. (default: {THRESHOLD})""",
+
+    'only' : """Only run the benchmarks whose names start with this, e.g.
+'k_means' or 'image_set'. Can be repeated.""",
+
+    'sizes' : f"""The sizes of the synthetic images, comma-separated. (default:
+{','.join(map(str, SIZES))})""",
+
+    'complexities' : f"""The numbers of colors in the synthetic images,
+comma-separated. (default: {','.join(map(str, COMPLEXITIES))})""",
+
+    'ks' : f"""The values of k to time _k_means with, comma-separated. (default:
+{','.join(map(str, KS))})""",
+
+    'image_set_sizes' : f"""The numbers of records to load and save,
+comma-separated. (default: {','.join(map(str, IMAGE_SET_SIZES))})""",
+
+    'min_time' : f"""Repeat fast benchmarks until they've taken at least this
+many seconds, and report the best run. (default: {MIN_TIME})""",
+
+    'engine' : "See colorweight.py --engine. (default: cv2)",
+
+    'profile' : "See colorweight.py --profile. (default: exact)",
+    'color_space' : "See colorweight.py --color-space. (default: bgr)",
+
+    'sweep' : "See colorweight.py --sweep. (default: full)",
+
+    'adaptive' : "See colorweight.py --adaptive.",
+
+    'workers' : f"See colorweight.py --workers. (default: {WORKERS})",
+
+    'max_pixels' : "See colorweight.py --max-pixels.",
+
+    'resample' : "See colorweight.py --resample. (default: area)",
+}
+
+def synthetic_image(size, n_colors, seed=0):
+    # A size x size BGR image of n_colors flat regions (a Voronoi diagram with
+    # random, unevenly spread sites) with some noise on top, and the palette
+    # it was made from: [(bgr, share of the pixels), ...].
+    rng = np.random.default_rng(seed)
+    palette = rng.integers(0, 256, (n_colors, 3))
+    sites = rng.random((n_colors, 2)) ** 2 * size
+    ys, xs = np.mgrid[0:size, 0:size]
+    d = (ys[..., None] - sites[:, 0])**2 + (xs[..., None] - sites[:, 1])**2
+    labels = np.argmin(d, axis=2)
+    noise = rng.normal(0, NOISE, (size, size, 3))
+    image = np.uint8(np.clip(palette[labels] + noise, 0, 255))
+    shares = np.bincount(labels.ravel(), minlength=n_colors) / labels.size
+    return image, [(bgr, share) for bgr, share in zip(palette, shares) if share > 0]
+
+def synthetic_image_set(n, seed=0):
+    rng = Random(seed)
+    images = []
+    for i in range(n):
+        volumes = [rng.random() for _ in range(rng.randint(1, 8))]
+        total = sum(volumes)
+        colors = [ColorVolume(v / total, [rng.randint(0, 255) for _ in range(3)])
+            for v in sorted(volumes, reverse=True)]
+        images.append(Image(colors, f'palettes/{i:06}.png', f'images/{i:06}.jpg'))
+    return ImageSet(images)
+
+def palette_error(colors, reference):
+    # EMD between a dominant_colors_list and [(bgr, share), ...]
+    ours = np.float32([[c['relative_volume'], *c['rgb']] for c in colors])
+    theirs = np.float32([[share, *bgr[::-1]] for bgr, share in reference])
+    ours[:, 0] /= ours[:, 0].sum()
+    theirs[:, 0] /= theirs[:, 0].sum()
+    return float(cv2.EMD(ours, theirs, cv2.DIST_L2)[0])
+
+def measure(setup, run, min_time=MIN_TIME):
+    # Returns (best seconds, runs, peak bytes, state). setup() makes whatever
+    # run() needs (fresh each time, so that nothing is cached between runs)
+    # and isn't timed. state is what the last run ran on.
+    times = []
+    while not times or (sum(times) < min_time and times[0] < min_time):
+        state = setup()
+        start = perf_counter()
+        run(state)
+        times.append(perf_counter() - start)
+    state = setup()
+    tracemalloc.start()
+    try:
+        run(state)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(times), len(times), peak, state
+
+class Benchmarks(object):
+    def __init__(self, options={}, sizes=SIZES, complexities=COMPLEXITIES,
+            ks=KS, image_set_sizes=IMAGE_SET_SIZES, only=None,
+            min_time=MIN_TIME):
+        self.options = options # passed on to ImageAnalyzer
+        self.sizes = sizes
+        self.complexities = complexities
+        self.ks = ks
+        self.image_set_sizes = image_set_sizes
+        self.only = only
+        self.min_time = min_time
+
+    def cases(self):
+        # Yields (case name, encoded image, reference palette)
+        for size in self.sizes:
+            for n_colors in self.complexities:
+                image, palette = synthetic_image(size, n_colors)
+                data = cv2.imencode('.png', image)[1].tobytes()
+                yield f'synthetic-{size}x{size}-{n_colors}', data, palette
+        with open(SAMPLE, 'rb') as f:
+            data = f.read()
+        with open(REFERENCE, 'r') as f:
+            reference = [(c['rgb'][::-1], c['relative_volume']) for c in load(f)]
+        yield 'sample-01', data, reference
+
+    def run(self):
+        results = []
+        for case, data, reference in self.cases():
+            results += self._image_benchmarks(case, data, reference)
+        for n in self.image_set_sizes:
+            results += self._image_set_benchmarks(n)
+        return results
+
+    def _image_benchmarks(self, case, data, reference):
+        def analyzer():
+            return ImageAnalyzer(case, image_bytes=data, **self.options)
+        def ready():
+            # decoded, so that only the clustering is timed
+            ia = analyzer()
+            if self.options.get('engine') == 'histogram':
+                ia.histogram
+            elif self.options.get('engine') == 'minibatch':
+                ia.sample
+            else:
+                ia.pixels
+            return ia
+        clustered = None
+        benchmarks = [
+            ('pixels', analyzer, lambda ia: ia.pixels),
+            ('histogram', analyzer, lambda ia: ia.histogram),
+        ]
+        for k in self.ks:
+            benchmarks.append((f'k_means[{k}]', ready, lambda ia, k=k: ia._k_means(k)))
+        benchmarks += [
+            ('cluster_data', ready, lambda ia: ia.cluster_data),
+            ('find_best_k', None, lambda ia: ia._find_best_k()),
+            ('viz', None, lambda ia: ia.viz()),
+        ]
+        results = []
+        for name, setup, run in benchmarks:
+            if not self._selected(name):
+                continue
+            if setup is None:
+                # Sweeping is slow, so the rest reuse the cluster_data
+                # benchmark's (or, if that's not selected, one) sweep
+                if clustered is None:
+                    clustered = ready()
+                    clustered.cluster_data
+                setup = lambda: clustered
+            result, state = self._measure(name, case, setup, run)
+            if name == 'cluster_data':
+                clustered = state
+                result['best_k'] = int(state._find_best_k())
+                result['evaluated_ks'] = state.evaluated_ks
+                result['palette_error'] = palette_error(state.dominant_colors_list(), reference)
+            Benchmarks._report(result)
+            results.append(result)
+        return results
+
+    def _image_set_benchmarks(self, n):
+        results = []
+        image_set = synthetic_image_set(n)
+        with TemporaryDirectory() as tmp:
+            json_path = join(tmp, 'images.json')
+            image_set.save(json_path)
+            if self._selected('image_set.save'):
+                results.append(self._measure('image_set.save', f'records-{n}',
+                    lambda: image_set, lambda s: s.save(join(tmp, 'saved.json')))[0])
+            if self._selected('image_set.load'):
+                results.append(self._measure('image_set.load', f'records-{n}',
+                    lambda: json_path, ImageSet.from_file)[0])
+        for result in results:
+            Benchmarks._report(result)
+        return results
+
+    def _measure(self, name, case, setup, run):
+        # Returns (result, state); see measure
+        seconds, runs, peak, state = measure(setup, run, self.min_time)
+        result = {'name' : name, 'case' : case, 'seconds' : seconds, 'runs' : runs,
+            'peak_bytes' : peak}
+        return result, state
+
+    def _selected(self, name):
+        return not self.only or name.startswith(tuple(self.only))
+
+    @staticmethod
+    def _report(result):
+        line = f"{result['name']:<16} {result['case']:<24} {result['seconds']:10.4f}s"
+        line += f"{result['peak_bytes'] / 2**20:10.1f} MiB"
+        if 'palette_error' in result:
+            line += f"  k={result['best_k']:<2} error {result['palette_error']:.2f}"
+        print(line, flush=True)
+
+def compare(results, baseline, threshold=THRESHOLD):
+    # Prints how results compare with baseline, and returns the regressions
+    regressions = []
+    previous = {(r['name'], r['case']) : r for r in baseline['results']}
+    for r in results['results']:
+        before = previous.get((r['name'], r['case']))
+        if before is None:
+            continue
+        changes = []
+        for metric in ('seconds', 'peak_bytes', 'palette_error'):
+            if metric not in r or metric not in before:
+                continue
+            old, new = before[metric], r[metric]
+            ratio = new / old if old else (1.0 if new == old else float('inf'))
+            changes.append(f'{metric} x{ratio:.2f}')
+            # palette errors of a pixel or so are noise, whatever the ratio
+            if ratio > 1 + threshold and not (metric == 'palette_error' and new - old < 1):
+                regressions.append((r['name'], r['case'], metric, old, new))
+        print(f"{r['name']:<16} {r['case']:<24} {', '.join(changes)}")
+    for name, case, metric, old, new in regressions:
+        print(f'REGRESSION: {name} {case} {metric}: {old:.6g} -> {new:.6g}')
+    return regressions
+
+def _ints(s):
+    return tuple(int(i) for i in s.split(','))
+
+class BenchmarkCLI(object):
+
+    def __init__(self):
+        parser = ArgumentParser(description=DESCRIPTION, prog=__file__)
+        parser.add_argument('-o', '--output', metavar='PATH', default='benchmark.json', help=HELP['output'])
+        parser.add_argument('-b', '--baseline', metavar='PATH', default=None, help=HELP['baseline'])
+        parser.add_argument('-t', '--threshold', metavar='RATIO', type=float, default=THRESHOLD, help=HELP['threshold'])
+        parser.add_argument('--only', metavar='NAME', action='append', default=None, help=HELP['only'])
+        parser.add_argument('--sizes', metavar='LIST', type=_ints, default=SIZES, help=HELP['sizes'])
+        parser.add_argument('--complexities', metavar='LIST', type=_ints, default=COMPLEXITIES, help=HELP['complexities'])
+        parser.add_argument('--ks', metavar='LIST', type=_ints, default=KS, help=HELP['ks'])
+        parser.add_argument('--image-set-sizes', metavar='LIST', type=_ints, default=IMAGE_SET_SIZES, help=HELP['image_set_sizes'])
+        parser.add_argument('--min-time', metavar='SECONDS', type=float, default=MIN_TIME, help=HELP['min_time'])
+        parser.add_argument('-e', '--engine', default='cv2', choices=ENGINES, help=HELP['engine'])
+        parser.add_argument('-p', '--profile', default=PROFILE, choices=PROFILES, help=HELP['profile'])
+        parser.add_argument('--color-space', default='bgr', choices=COLOR_SPACES, help=HELP['color_space'])
+        parser.add_argument('-s', '--sweep', default='full', choices=SWEEPS, help=HELP['sweep'])
+        parser.add_argument('-a', '--adaptive', action='store_true', default=False, help=HELP['adaptive'])
+        parser.add_argument('-w', '--workers', metavar='NUMBER', type=int, default=WORKERS, help=HELP['workers'])
+        parser.add_argument('-m', '--max-pixels', metavar='NUMBER', type=int, default=MAX_PIXELS, help=HELP['max_pixels'])
+        parser.add_argument('--resample', default='area', choices=RESAMPLES, help=HELP['resample'])
+        self.args = parser.parse_args()
+
+    def execute(self):
+        options = {
+            'engine' : self.args.engine,
+            'profile' : self.args.profile,
+            'color_space' : self.args.color_space,
+            'sweep' : self.args.sweep,
+            'adaptive' : self.args.adaptive,
+            'workers' : self.args.workers,
+            'max_pixels' : self.args.max_pixels,
+            'resample' : self.args.resample,
+        }
+        benchmarks = Benchmarks(options, sizes=self.args.sizes,
+            complexities=self.args.complexities, ks=self.args.ks,
+            image_set_sizes=self.args.image_set_sizes, only=self.args.only,
+            min_time=self.args.min_time)
+        results = {
+            'meta' : BenchmarkCLI._meta(options),
+            'results' : benchmarks.run(),
+        }
+        with open(self.args.output, 'w') as f:
+            dump(results, f, indent=2, sort_keys=True)
+        if self.args.baseline is not None:
+            with open(self.args.baseline, 'r') as f:
+                baseline = load(f)
+            if compare(results, baseline, self.args.threshold):
+                exit(1)
+
+    @staticmethod
+    def _meta(options):
+        # What the results depend on besides the code
+        return {
+            'date' : datetime.now(timezone.utc).isoformat(),
+            'platform' : platform(),
+            'cpus' : cpu_count(),
+            'python' : python_version(),
+            'numpy' : np.__version__,
+            'cv2' : cv2.__version__,
+            'options' : options,
+            'constants' : {
+                'PROFILES' : {name : dict(settings, criteria=list(settings['criteria']))
+                    for name, settings in color_analysis.PROFILES.items()},
+                'K_MAX' : color_analysis.K_MAX,
+            },
+        }
+
+if __name__ == '__main__':
+    BenchmarkCLI().execute()
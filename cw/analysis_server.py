@@ -0,0 +1,563 @@
+#!/usr/bin/env python3
+
+#
+# A local HTTP service that analyzes images by color, for web apps that would
+# otherwise run colorweight.py for each request and pay for starting Python,
+# importing OpenCV and so on every time. See --help, and the README for the
+# endpoints.
+#
+# Each request is handled on its own thread, and the analysis itself runs on a
+# pool of processes that stays up. Requests for the same image with the same
+# parameters while it's being analyzed are coalesced: they wait for the one
+# analysis rather than starting their own. The last --lru-size responses are
+# kept in memory, and with --cache, so are clustering results on disk (see
+# cw/utils/cache.py), so e.g. a palette at a new size doesn't cluster again.
+# At most --max-queue analyses are in the pool at once; past that, requests
+# get a 503. If a worker dies (e.g. killed for using too much memory), the
+# requests waiting on it get a 500 and the pool is replaced.
+#
+# Images can be fetched from other servers only if their hosts are allowed
+# (--allow-remote), since anything that can reach the port could otherwise
+# have the service make requests for it, e.g. to hosts on an internal network.
+# Every request is checked, including redirects and, for IIIF image services,
+# the image that info.json points to. Responses for remote images are kept in
+# memory for --remote-ttl seconds at most, since they can change without us
+# knowing.
+#
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from cv2 import imencode
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from json import dumps
+from os import cpu_count
+from os import getcwd
+from os import stat
+from os.path import abspath
+from os.path import commonpath
+from os.path import dirname
+from os.path import join
+from os.path import realpath
+from signal import SIGTERM
+from signal import signal
+from sys import exit
+from sys import path
+from sys import stderr
+from threading import RLock
+from time import monotonic
+from time import perf_counter
+from urllib.parse import parse_qs
+from urllib.parse import urlsplit
+import numpy as np
+
+# This is necessary so that we can execute this file AND use it as a module.
+path.append(abspath(dirname(dirname(realpath(__file__)))))
+
+from cw.utils.cache import ResultCache
+from cw.utils.cache import content_hash
+from cw.utils.color_analysis import COLOR_SPACES
+from cw.utils.color_analysis import ENGINES
+from cw.utils.color_analysis import ImageAnalyzer
+from cw.utils.color_analysis import K_MAX
+from cw.utils.color_analysis import MAX_PIXELS
+from cw.utils.color_analysis import PROFILE
+from cw.utils.color_analysis import PROFILES
+from cw.utils.color_analysis import SWEEPS
+from cw.utils.color_analysis import init_analysis_worker
+from cw.utils.colorweight import DEFAULT_HEIGHT
+from cw.utils.colorweight import DEFAULT_WIDTH
+from cw.utils.iiif import fetch_image
+from cw.utils.iiif import is_uri
+from cw.utils.image_fetch import pooled_session
+from cw.utils.render import PNG_PARAMS
+
+DESCRIPTION = 'Serve color analysis of images over HTTP.'
+
+PORT = 8765
+LRU_SIZE = 256 # responses
+REMOTE_TTL = 300 # seconds
+MAX_UPLOAD = 64 * 1024 * 1024 # bytes
+LATENCY_WINDOW = 1000 # the latency percentiles are of this many requests
+MAX_GEOMETRY = 4096 # the biggest palette width or height
+
+# What each endpoint returns
+ENDPOINTS = {
+    '/colors' : 'application/json',
+    '/palette' : 'image/png',
+}
+
+HELP = {
+    'host' : "The address to listen on. (default: 127.0.0.1)",
+
+    'port' : f"The port to listen on. (default: {PORT})",
+
+    'root' : """Images given as paths are looked up in this directory, and
+paths outside it are refused. (default: the current directory)""",
+
+    'jobs' : """The number of processes analyzing images. (default: the number
+of CPUs)""",
+
+    'max_queue' : """The most analyses running or waiting for a process at
+once; more get a 503. Requests coalesced into one that's already running
+don't count. (default: four times --jobs)""",
+
+    'lru_size' : f"""The number of responses kept in memory. 0 turns this off.
+(default: {LRU_SIZE})""",
+
+    'allow_remote' : """Fetch images given as HTTP(S) URIs from this host (e.g.
+iiif.example.edu). Can be repeated; '*' allows any host. (default: none, i.e.
+only paths and uploaded images)""",
+
+    'remote_ttl' : f"""Keep responses for remote images in memory for at most
+this many seconds. (default: {REMOTE_TTL})""",
+
+    'max_upload' : f"""The largest image that can be uploaded, in bytes.
+(default: {MAX_UPLOAD})""",
+
+    'max_pixels' : """The default for the max_pixels parameter; see
+colorweight.py --max-pixels.""",
+
+    'engine' : "The default engine; see colorweight.py --engine. (default: cv2)",
+
+    'profile' : "The default profile; see colorweight.py --profile. (default: exact)",
+
+    'color_space' : "The default color space; see colorweight.py --color-space. (default: bgr)",
+
+    'sweep' : "The default sweep; see colorweight.py --sweep. (default: full)",
+
+    'adaptive' : "Sweep adaptively by default; see colorweight.py --adaptive.",
+
+    'cache' : "See colorweight.py --cache. (default: don't cache)",
+
+    'quiet' : "Don't log each request to stderr.",
+}
+
+# Each worker's sessions for remote images, by the hosts they allow
+_sessions = {}
+
+class RequestError(Exception):
+    # Turned into an error response with this status
+    def __init__(self, status, message):
+        super(RequestError, self).__init__(message)
+        self.status = status
+
+class HostNotAllowed(ValueError):
+    pass
+
+def host_allowed(uri, allowed_hosts):
+    # allowed_hosts is a frozenset of lowercase host names, or '*'
+    if '*' in allowed_hosts:
+        return True
+    return urlsplit(uri).hostname in allowed_hosts
+
+def remote_session(allowed_hosts):
+    # A pooled_session that refuses to send anything to a host that isn't
+    # allowed. Redirects go through send too, so they're checked as well.
+    session = _sessions.get(allowed_hosts)
+    if session is None:
+        session = pooled_session(workers=1)
+        send = session.send
+        def checked_send(request, **kwargs):
+            if not host_allowed(request.url, allowed_hosts):
+                raise HostNotAllowed(f'fetching images from {urlsplit(request.url).hostname} is not allowed (see --allow-remote)')
+            return send(request, **kwargs)
+        session.send = checked_send
+        _sessions[allowed_hosts] = session
+    return session
+
+def render(image_path, image_bytes, options, endpoint, n_colors, height, width,
+        allowed_hosts=frozenset()):
+    # Runs in a pool worker. Returns (the response body, None), or (None,
+    # (status, message)) if the analysis failed, since not every exception
+    # survives pickling.
+    try:
+        if image_bytes is None and is_uri(image_path):
+            image_bytes = fetch_image(image_path, max_pixels=options.get('max_pixels'),
+                session=remote_session(allowed_hosts))
+        with ImageAnalyzer(image_path, image_bytes=image_bytes, lean=True, **options) as ia:
+            if endpoint == '/colors':
+                data = ia.dominant_colors_list(n_colors=n_colors)
+                return dumps(data, sort_keys=True).encode(), None
+            image_data = ia.viz(n_colors=n_colors, height=height, width=width)
+            return imencode('.png', image_data, PNG_PARAMS)[1].tobytes(), None
+    except HostNotAllowed as e:
+        # e.g. a redirect to another host
+        return None, (403, str(e))
+    except Exception as e:
+        return None, (422, repr(e))
+
+class ResponseLRU(object):
+    # The last max_entries response bodies, by request key. Entries put with a
+    # ttl are dropped once they're older than that.
+    def __init__(self, max_entries=LRU_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict() # key -> (body, expiry or None)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        body, expires = self.entries.get(key, (None, None))
+        if body is not None and expires is not None and monotonic() >= expires:
+            del self.entries[key]
+            body = None
+        if body is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return body
+
+    def put(self, key, body, ttl=None):
+        if self.max_entries <= 0 or (ttl is not None and ttl <= 0):
+            return
+        self.entries[key] = (body, None if ttl is None else monotonic() + ttl)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        return {
+            'entries' : len(self.entries),
+            'max_entries' : self.max_entries,
+            'bytes' : sum(len(body) for body, _ in self.entries.values()),
+            'hits' : self.hits,
+            'misses' : self.misses,
+        }
+
+class AnalysisService(object):
+    # What the server does, apart from HTTP: turns a request's source and
+    # parameters into a response body, coalescing, caching and timing as it
+    # goes. Thread safe; everything shared is behind self.lock.
+    def __init__(self, jobs, root=None, options=None, max_queue=None,
+            lru_size=LRU_SIZE, allowed_hosts=(), remote_ttl=REMOTE_TTL):
+        self.jobs = jobs
+        self.pool = self._new_pool()
+        self.root = realpath(root or getcwd())
+        # ImageAnalyzer's keyword arguments, by default
+        self.options = {} if options is None else options
+        self.max_queue = max_queue or 4 * jobs
+        self.lru = ResponseLRU(lru_size)
+        self.allowed_hosts = frozenset(h.lower() for h in allowed_hosts)
+        self.remote_ttl = remote_ttl
+        # Reentrant, since add_done_callback calls _finished right away if the
+        # analysis is already done
+        self.lock = RLock()
+        self.in_flight = {} # key -> the Future of its analysis
+        self.waiting = 0 # requests waiting on an analysis, coalesced or not
+        self.requests = 0
+        self.coalesced = 0
+        self.rejected = 0
+        self.errors = 0
+        self.restarts = 0 # of the pool, after a worker died
+        self.latencies = deque(maxlen=LATENCY_WINDOW) # seconds
+
+    def respond(self, endpoint, query, upload=None):
+        # Returns (body, how it was answered: 'hit', 'coalesced' or
+        # 'analyzed'). Raises RequestError.
+        start = perf_counter()
+        try:
+            return self._respond(endpoint, query, upload)
+        except RequestError:
+            with self.lock:
+                self.errors += 1
+            raise
+        finally:
+            with self.lock:
+                self.requests += 1
+                self.latencies.append(perf_counter() - start)
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+    def stats(self):
+        with self.lock:
+            in_flight = len(self.in_flight)
+            latencies = np.float64(self.latencies)
+            values = {
+                'requests' : self.requests,
+                'coalesced' : self.coalesced,
+                'rejected' : self.rejected,
+                'errors' : self.errors,
+                'restarts' : self.restarts,
+                'queue' : {
+                    'analyzing' : min(in_flight, self.jobs),
+                    'queued' : max(in_flight - self.jobs, 0),
+                    'waiting' : self.waiting,
+                    'max_queue' : self.max_queue,
+                    'jobs' : self.jobs,
+                },
+                'lru' : self.lru.stats(),
+            }
+        latency = {'count' : len(latencies)}
+        if len(latencies):
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+            latency.update(p50=p50, p90=p90, p99=p99, max=latencies.max())
+        values['latency'] = latency
+        return values
+
+    def _respond(self, endpoint, query, upload):
+        image_path, image_bytes, source = self._source(query, upload)
+        options, n_colors, height, width = self._parameters(endpoint, query)
+        key = (endpoint, source, dumps(options, sort_keys=True), n_colors, height, width)
+        with self.lock:
+            body = self.lru.get(key)
+            if body is not None:
+                return body, 'hit'
+            future = self.in_flight.get(key)
+            how = 'coalesced'
+            if future is None:
+                if len(self.in_flight) >= self.max_queue:
+                    self.rejected += 1
+                    raise RequestError(503, 'too many images are being analyzed; try again later')
+                args = (render, image_path, image_bytes, dict(self.options, **options),
+                    endpoint, n_colors, height, width, self.allowed_hosts)
+                try:
+                    future = self.pool.submit(*args)
+                except BrokenProcessPool:
+                    # A worker died since the last request; this one isn't
+                    # to blame, so give it the new pool
+                    self._replace_pool(self.pool)
+                    future = self.pool.submit(*args)
+                future.pool = self.pool
+                self.in_flight[key] = future
+                future.add_done_callback(lambda f: self._finished(key, f))
+                how = 'analyzed'
+            else:
+                self.coalesced += 1
+            self.waiting += 1
+        try:
+            body, error = future.result()
+        except BrokenProcessPool:
+            self._replace_pool(future.pool)
+            raise RequestError(500, 'the process analyzing the image stopped unexpectedly')
+        finally:
+            with self.lock:
+                self.waiting -= 1
+        if error is not None:
+            raise RequestError(*error)
+        return body, how
+
+    def _finished(self, key, future):
+        # Runs when the analysis is done (on the pool's thread): later
+        # requests get it from the LRU rather than the future
+        with self.lock:
+            del self.in_flight[key]
+            if future.cancelled() or future.exception() is not None:
+                return
+            body, error = future.result()
+            if error is None:
+                _, source = key[:2]
+                ttl = self.remote_ttl if source[0] == 'uri' else None
+                self.lru.put(key, body, ttl)
+
+    def _new_pool(self):
+        return ProcessPoolExecutor(self.jobs, initializer=init_analysis_worker)
+
+    def _replace_pool(self, broken):
+        # Replaces the pool if it's still the broken one (it's only replaced
+        # once, however many requests find it broken)
+        with self.lock:
+            if self.pool is not broken:
+                return
+            self.pool = self._new_pool()
+            self.restarts += 1
+        broken.shutdown(wait=False)
+
+    def _source(self, query, upload):
+        # Returns (image_path, image_bytes, source), where source identifies
+        # the image for coalescing and the LRU: uploads by their content,
+        # files by their path, size and modification time, and URLs as they
+        # are.
+        image = query.get('image')
+        if upload is not None:
+            if image is not None:
+                raise RequestError(400, 'give either an image parameter or an uploaded image, not both')
+            digest = content_hash(upload)
+            return f'upload-{digest[:16]}', upload, ('upload', digest)
+        if image is None:
+            raise RequestError(400, 'no image given: use the image parameter, or POST the image')
+        if is_uri(image):
+            if not host_allowed(image, self.allowed_hosts):
+                raise RequestError(403, f'fetching images from {urlsplit(image).hostname} is not allowed (see --allow-remote)')
+            return image, None, ('uri', image)
+        image_path = realpath(join(self.root, image))
+        if commonpath([self.root, image_path]) != self.root:
+            raise RequestError(403, f'{image} is outside the served directory')
+        try:
+            s = stat(image_path)
+        except OSError:
+            raise RequestError(404, f'{image} not found')
+        return image_path, None, ('path', image_path, s.st_size, s.st_mtime_ns)
+
+    def _parameters(self, endpoint, query):
+        # Returns (options that differ from the defaults, n_colors, height,
+        # width) from the query; height and width are None for /colors.
+        options = {}
+        for name, choices in (('engine', ENGINES), ('profile', PROFILES),
+                ('color_space', COLOR_SPACES), ('sweep', SWEEPS)):
+            if name in query:
+                if query[name] not in choices:
+                    raise RequestError(400, f'{name} must be one of {", ".join(choices)}')
+                options[name] = query[name]
+        if 'adaptive' in query:
+            if query['adaptive'] not in ('0', '1', 'true', 'false'):
+                raise RequestError(400, 'adaptive must be true or false')
+            options['adaptive'] = query['adaptive'] in ('1', 'true')
+        if 'max_pixels' in query:
+            options['max_pixels'] = _integer(query, 'max_pixels', 1)
+        engine = options.get('engine', self.options.get('engine'))
+        sweep = options.get('sweep', self.options.get('sweep'))
+        if engine == 'minibatch' and sweep == 'incremental':
+            raise RequestError(400, 'the minibatch engine only does the full sweep')
+        n_colors = None
+        if 'colors' in query:
+            n_colors = _integer(query, 'colors', 1, K_MAX)
+        if endpoint == '/colors':
+            return options, n_colors, None, None
+        height, width = DEFAULT_HEIGHT, DEFAULT_WIDTH
+        if 'geometry' in query:
+            try:
+                width, height = map(int, query['geometry'].split('x'))
+            except ValueError:
+                raise RequestError(400, 'geometry must be WxH, e.g. 400x100')
+            if not (0 < width <= MAX_GEOMETRY and 0 < height <= MAX_GEOMETRY):
+                raise RequestError(400, f'geometry must be at most {MAX_GEOMETRY}x{MAX_GEOMETRY}')
+        return options, n_colors, height, width
+
+def _integer(query, name, low, high=None):
+    try:
+        value = int(query[name])
+    except ValueError:
+        raise RequestError(400, f'{name} must be a whole number')
+    if value < low or (high is not None and value > high):
+        bounds = f'at least {low}' if high is None else f'from {low} to {high}'
+        raise RequestError(400, f'{name} must be {bounds}')
+    return value
+
+class AnalysisHandler(BaseHTTPRequestHandler):
+    # self.server is an AnalysisServer
+    protocol_version = 'HTTP/1.1' # i.e. keep-alive; every response has a length
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/stats':
+            body = dumps(self.server.service.stats(), sort_keys=True).encode()
+            return self._send(200, 'application/json', body)
+        self._analyze(url, None)
+
+    def do_POST(self):
+        # The body is the image, e.g. curl --data-binary @image.jpg
+        url = urlsplit(self.path)
+        try:
+            length = int(self.headers.get('Content-Length', ''))
+        except ValueError:
+            self.close_connection = True
+            return self._send_error(411, 'Content-Length is required')
+        if length > self.server.max_upload:
+            self.close_connection = True # rather than read it all
+            return self._send_error(413, f'images can be at most {self.server.max_upload} bytes')
+        self._analyze(url, self.rfile.read(length))
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super(AnalysisHandler, self).log_message(format, *args)
+
+    def _analyze(self, url, upload):
+        if url.path not in ENDPOINTS:
+            return self._send_error(404, f'no such endpoint: {url.path}')
+        # parse_qs gives lists; the last of a repeated parameter wins
+        query = {name : values[-1] for name, values in parse_qs(url.query).items()}
+        try:
+            body, how = self.server.service.respond(url.path, query, upload)
+        except RequestError as e:
+            return self._send_error(e.status, str(e))
+        self._send(200, ENDPOINTS[url.path], body, {'X-Cache' : how})
+
+    def _send_error(self, status, message):
+        body = dumps({'error' : message}).encode()
+        headers = {'Retry-After' : '1'} if status == 503 else {}
+        self._send(status, 'application/json', body, headers)
+
+    def _send(self, status, content_type, body, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+class AnalysisServer(ThreadingHTTPServer):
+    daemon_threads = True # don't wait for open connections at exit
+
+    def __init__(self, address, service, max_upload=MAX_UPLOAD, quiet=False):
+        super(AnalysisServer, self).__init__(address, AnalysisHandler)
+        self.service = service
+        self.max_upload = max_upload
+        self.quiet = quiet
+
+class AnalysisServerCLI(object):
+
+    def __init__(self):
+        parser = ArgumentParser(description=DESCRIPTION, prog=__file__)
+        parser.add_argument('--host', default='127.0.0.1', help=HELP['host'])
+        parser.add_argument('--port', type=int, default=PORT, help=HELP['port'])
+        parser.add_argument('--root', metavar='DIR', default=None, help=HELP['root'])
+        parser.add_argument('-j', '--jobs', metavar='NUMBER', type=int, default=None, help=HELP['jobs'])
+        parser.add_argument('--max-queue', metavar='NUMBER', type=int, default=None, help=HELP['max_queue'])
+        parser.add_argument('--lru-size', metavar='NUMBER', type=int, default=LRU_SIZE, help=HELP['lru_size'])
+        parser.add_argument('--allow-remote', metavar='HOST', action='append', default=[], help=HELP['allow_remote'])
+        parser.add_argument('--remote-ttl', metavar='SECONDS', type=float, default=REMOTE_TTL, help=HELP['remote_ttl'])
+        parser.add_argument('--max-upload', metavar='BYTES', type=int, default=MAX_UPLOAD, help=HELP['max_upload'])
+        parser.add_argument('-m', '--max-pixels', metavar='NUMBER', type=int, default=MAX_PIXELS, help=HELP['max_pixels'])
+        parser.add_argument('-e', '--engine', default='cv2', choices=ENGINES, help=HELP['engine'])
+        parser.add_argument('--profile', default=PROFILE, choices=PROFILES, help=HELP['profile'])
+        parser.add_argument('--color-space', default='bgr', choices=COLOR_SPACES, help=HELP['color_space'])
+        parser.add_argument('-s', '--sweep', default='full', choices=SWEEPS, help=HELP['sweep'])
+        parser.add_argument('-a', '--adaptive', action='store_true', default=False, help=HELP['adaptive'])
+        parser.add_argument('--cache', metavar='DIR', default=None, help=HELP['cache'])
+        parser.add_argument('-q', '--quiet', action='store_true', default=False, help=HELP['quiet'])
+
+        args = parser.parse_args()
+        if args.engine == 'minibatch' and args.sweep == 'incremental':
+            parser.error('--engine minibatch only does --sweep full')
+        self.args = args
+
+    def execute(self):
+        jobs = self.args.jobs or cpu_count()
+        options = {
+            'workers' : 1, # the pool is the parallelism
+            'max_pixels' : self.args.max_pixels,
+            'engine' : self.args.engine,
+            'profile' : self.args.profile,
+            'color_space' : self.args.color_space,
+            'sweep' : self.args.sweep,
+            'adaptive' : self.args.adaptive,
+            'cache' : None if self.args.cache is None else ResultCache(self.args.cache),
+        }
+        service = AnalysisService(jobs, root=self.args.root, options=options,
+            max_queue=self.args.max_queue, lru_size=self.args.lru_size,
+            allowed_hosts=self.args.allow_remote, remote_ttl=self.args.remote_ttl)
+        # Stop on SIGTERM as on Ctrl-C, so that the pool is shut down rather
+        # than its workers left behind
+        signal(SIGTERM, lambda signum, frame: exit(128 + signum))
+        try:
+            server = AnalysisServer((self.args.host, self.args.port), service,
+                max_upload=self.args.max_upload, quiet=self.args.quiet)
+            with server:
+                host, port = server.server_address[:2]
+                print(f'Serving {service.root} on http://{host}:{port}/', file=stderr, flush=True)
+                server.serve_forever()
+        finally:
+            service.shutdown()
+
+if __name__ == '__main__':
+    cli = AnalysisServerCLI()
+    try:
+        cli.execute()
+    except KeyboardInterrupt:
+        exit(130)
@@ -1,32 +1,322 @@
+#!/usr/bin/env python3
+
+#
+# Analyze a batch of images (directories, globs, or a list of files) across a
+# pool of processes, writing a palette PNG for each and collecting the results
+# in an ImageStore. See --help.
+#
+
+from argparse import ArgumentParser
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import as_completed
+from concurrent.futures import wait
+from contextlib import nullcontext
 from cv2 import imwrite
+from glob import glob
+from glob import has_magic
+from hashlib import sha1
+from json import dumps
+from os import cpu_count
 from os import listdir
+from os import makedirs
 from os.path import abspath
+from os.path import basename
 from os.path import dirname
+from os.path import isdir
+from os.path import isfile
 from os.path import join
 from os.path import realpath
+from os.path import splitext
+from sys import exit
 from sys import path
+from sys import stderr
+from sys import stdin
+from time import monotonic
+from time import perf_counter
 
 # This is necessary so that we can execute this file AND use it as a module.
 # Importing relative to this directory as opposed to ../cw feels wrong)
 path.append(abspath(dirname(dirname(realpath(__file__)))))
 
 from cw.models import Image
-from cw.models import ImageSet
+from cw.models import ImageStore
+from cw.utils.cache import ResultCache
+from cw.utils.color_analysis import COLOR_SPACES
+from cw.utils.color_analysis import ENGINES
 from cw.utils.color_analysis import ImageAnalyzer
+from cw.utils.color_analysis import MAX_PIXELS
+from cw.utils.color_analysis import PROFILE
+from cw.utils.color_analysis import PROFILES
+from cw.utils.color_analysis import SWEEPS
+from cw.utils.color_analysis import init_analysis_worker
+from cw.utils.colorweight import DEFAULT_HEIGHT
+from cw.utils.colorweight import DEFAULT_WIDTH
+from cw.utils.colorweight import GeometryAction
+from cw.utils.metrics import Metrics
+from cw.utils.render import PNG_PARAMS
+
+DESCRIPTION = 'Analyze a batch of images by their color.'
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.bmp', '.webp')
+
+HELP = {
+    'inputs' : """Images to analyze: files, directories (every image in
+them), or glob patterns (quote them; ** is supported).""",
+
+    'from_file' : """Also analyze the images listed, one per line, in this file
+('-' for stdin).""",
+
+    'output' : """The JSON Lines file that results are appended to (see
+cw.models.ImageStore). Images that are already in it are skipped, so an
+interrupted run can be restarted. (default: data.jsonl)""",
+
+    'palettes' : """The directory for the palette PNGs. (default: 'palettes'
+next to --output)""",
+
+    'jobs' : """The number of processes analyzing images. (default: the number
+of CPUs)""",
+
+    'max_in_flight' : """The most images queued or being analyzed at once.
+(default: twice --jobs)""",
+
+    'max_pixels' : """Analyze at most this many pixels per image; see
+colorweight.py --max-pixels.""",
+
+    'engine' : "See colorweight.py --engine. (default: cv2)",
+
+    'profile' : "See colorweight.py --profile. (default: exact)",
+    'color_space' : "See colorweight.py --color-space. (default: bgr)",
+
+    'sweep' : "See colorweight.py --sweep. (default: full)",
+
+    'adaptive' : "See colorweight.py --adaptive.",
+
+    'cache' : "See colorweight.py --cache. (default: don't cache)",
 
-set = ImageSet([])
-dir = '/Users/jstroop/workspace/colorweight/images/ga'
-image_list = sorted(filter(lambda p: p.endswith('.jpg'), listdir(dir)))
-data_path = join(dir, 'data.json')
-
-for im in image_list:
-    set = ImageSet.from_file(data_path)
-    print(im)
-    image_path = join(dir, im)
-    palette_image_path = join(dir, im.replace('.jpg', '.png'))
-    ia = ImageAnalyzer(image_path)
-    colors = ia.dominant_colors_list()
-    imwrite(palette_image_path, ia.viz())
+    'metrics' : """Append a line of JSON to this file ('-' for stderr) for each
+image, with how long each stage of its analysis took and more (see
+cw/utils/metrics.py). (default: don't)""",
+}
+
+def find_images(inputs):
+    # Expands directories and globs into image paths (absolute, so that they
+    # are stable keys in the ImageStore), in order and without duplicates.
+    found = []
+    for i in inputs:
+        if isdir(i):
+            found += sorted(join(i, f) for f in listdir(i)
+                if f.lower().endswith(IMAGE_EXTENSIONS))
+        elif has_magic(i):
+            found += sorted(filter(isfile, glob(i, recursive=True)))
+        else:
+            found.append(i)
+    return list(dict.fromkeys(map(abspath, found)))
+
+def palette_path(image_path, palettes_dir):
+    # The image's name plus a short hash of its absolute path, since a batch
+    # can have images with the same name in different directories (a/cover.jpg
+    # and b/cover.jpg) or with different extensions (x.jpg and x.png), and
+    # they mustn't share a palette PNG
+    digest = sha1(abspath(image_path).encode('utf-8')).hexdigest()[:8]
+    name = f'{splitext(basename(image_path))[0]}-{digest}.png'
+    return join(palettes_dir, name)
+
+def analyze(image_path, palette_image_path, options, height, width, metrics=False):
+    # Runs in a pool worker; returns the Image for the writer to store, or
+    # with metrics=True, (Image, Metrics.to_dict()). No palette PNG is written
+    # if palette_image_path is None.
+    m = Metrics(image=image_path) if metrics else None
+    with ImageAnalyzer(image_path, lean=True, metrics=m, **options) as ia:
+        colors = ia.dominant_colors_list()
+        if palette_image_path is not None:
+            image_data = ia.viz(height=height, width=width)
+            with ia.metrics.stage('write'):
+                imwrite(palette_image_path, image_data, PNG_PARAMS)
     image = Image(colors, palette_image_path, image_path)
-    set.append(image)
-    set.save(data_path)
+    if metrics:
+        return image, m.to_dict()
+    return image
+
+class Batch(object):
+    def __init__(self, image_paths, store_path, palettes_dir=None, jobs=None,
+            max_in_flight=None, options=None, height=DEFAULT_HEIGHT,
+            width=DEFAULT_WIDTH, log=stderr, metrics=None):
+        self.image_paths = image_paths
+        self.store_path = store_path
+        if palettes_dir is None:
+            palettes_dir = join(dirname(abspath(store_path)), 'palettes')
+        self.palettes_dir = palettes_dir
+        self.jobs = jobs or cpu_count()
+        self.max_in_flight = max_in_flight or 2 * self.jobs
+        # passed on to ImageAnalyzer
+        self.options = {} if options is None else options
+        self.height = height
+        self.width = width
+        self.log = log
+        self.metrics = metrics # a file for NDJSON metrics, or None
+
+    def run(self):
+        makedirs(self.palettes_dir, exist_ok=True)
+        with ProcessPoolExecutor(self.jobs, initializer=init_analysis_worker) as pool:
+            return self._process(lambda image_path: image_path,
+                lambda image_path: self._submit(pool, image_path))
+
+    def _process(self, key, submit):
+        # Runs the batch (and StreamBatch's): key(item) is the source_image an
+        # item of self.image_paths will be stored as, and submit(item) starts
+        # work on it and returns its future. A future with a `then` is a step
+        # on the way (e.g. a download); once it succeeds, then(future) returns
+        # the future of the next step.
+        #
+        # Work is handed out a few items at a time (max_in_flight) and only
+        # this process writes to the store, as results come back. If we're
+        # interrupted, whatever finished is already in the store.
+        with ImageStore(self.store_path) as store:
+            todo = [item for item in self.image_paths if key(item) not in store]
+            skipped = len(self.image_paths) - len(todo)
+            if skipped:
+                self._print(f'Skipping {skipped} images that are already done')
+            queue = iter(todo)
+            pending = set()
+            done = 0
+            start = monotonic()
+            try:
+                while True:
+                    while len(pending) < self.max_in_flight:
+                        item = next(queue, None)
+                        if item is None:
+                            break
+                        pending.add(submit(item))
+                    if not pending:
+                        break
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        then = getattr(future, 'then', None)
+                        if then is not None and future.exception() is None:
+                            pending.add(then(future))
+                        else:
+                            done += 1
+                            self._store(store, future, done, len(todo), start)
+            except KeyboardInterrupt:
+                # Images that a worker has already started analyzing can't be
+                # cancelled, so we may as well keep them; anything short of
+                # that is dropped.
+                running = [f for f in pending
+                    if not f.cancel() and getattr(f, 'then', None) is None]
+                self._print(f'Interrupted; finishing {len(running)} images '
+                    'in progress (Ctrl-C again to abandon them)')
+                for future in as_completed(running):
+                    done += 1
+                    self._store(store, future, done, len(todo), start)
+                self._print(f'{done} of {len(todo)} images done')
+                raise
+            if store.stale:
+                store.compact()
+        return done
+
+    def _submit(self, pool, image_path):
+        palette_image_path = palette_path(image_path, self.palettes_dir)
+        future = pool.submit(analyze, image_path, palette_image_path,
+            self.options, self.height, self.width, self.metrics is not None)
+        future.image_path = image_path
+        return future
+
+    def _store(self, store, future, done, total, start):
+        # Any stages that ran before analysis (e.g. downloads, in
+        # StreamBatch) are in future.stages
+        rate = done / max(monotonic() - start, 1e-9)
+        values = {'image' : future.image_path, 'stages' : {}}
+        try:
+            image = future.result()
+            if self.metrics is not None:
+                image, values = image
+            store_start = perf_counter()
+            store.append(image)
+            values['stages']['store'] = perf_counter() - store_start
+        except Exception as e:
+            values['error'] = repr(e)
+            self._print(f'[{done}/{total}] {future.image_path} failed: {e !r}')
+        else:
+            self._print(f'[{done}/{total}] {future.image_path} ({rate:.2f} images/sec)')
+        if self.metrics is not None:
+            values['stages'].update(getattr(future, 'stages', {}))
+            print(dumps(values, sort_keys=True), file=self.metrics, flush=True)
+
+    def _print(self, message):
+        if self.log is not None:
+            print(message, file=self.log, flush=True)
+
+class BatchAnalyzeCLI(object):
+
+    def __init__(self):
+        parser = ArgumentParser(description=DESCRIPTION, prog=__file__)
+        parser.add_argument('inputs', nargs='*', metavar='PATH', help=HELP['inputs'])
+        parser.add_argument('-f', '--from-file', metavar='PATH', help=HELP['from_file'])
+        parser.add_argument('-o', '--output', metavar='PATH', default='data.jsonl', help=HELP['output'])
+        parser.add_argument('-p', '--palettes', metavar='DIR', default=None, help=HELP['palettes'])
+        parser.add_argument('-j', '--jobs', metavar='NUMBER', type=int, default=None, help=HELP['jobs'])
+        parser.add_argument('--max-in-flight', metavar='NUMBER', type=int, default=None, help=HELP['max_in_flight'])
+        parser.add_argument('-g', '--geometry', action=GeometryAction)
+        parser.add_argument('-m', '--max-pixels', metavar='NUMBER', type=int, default=MAX_PIXELS, help=HELP['max_pixels'])
+        parser.add_argument('-e', '--engine', default='cv2', choices=ENGINES, help=HELP['engine'])
+        parser.add_argument('--profile', default=PROFILE, choices=PROFILES, help=HELP['profile'])
+        parser.add_argument('--color-space', default='bgr', choices=COLOR_SPACES, help=HELP['color_space'])
+        parser.add_argument('-s', '--sweep', default='full', choices=SWEEPS, help=HELP['sweep'])
+        parser.add_argument('-a', '--adaptive', action='store_true', default=False, help=HELP['adaptive'])
+        parser.add_argument('--cache', metavar='DIR', default=None, help=HELP['cache'])
+        parser.add_argument('--metrics', metavar='PATH', default=None, help=HELP['metrics'])
+        # set by --geometry
+        parser.set_defaults(width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT)
+
+        args = parser.parse_args()
+        del args.geometry
+        if not args.inputs and args.from_file is None:
+            parser.error('no images given')
+        if args.engine == 'minibatch' and args.sweep == 'incremental':
+            parser.error('--engine minibatch only does --sweep full')
+        self.args = args
+
+    def execute(self):
+        inputs = list(self.args.inputs)
+        if self.args.from_file is not None:
+            inputs += BatchAnalyzeCLI._read_list(self.args.from_file)
+        options = {
+            'max_pixels' : self.args.max_pixels,
+            'engine' : self.args.engine,
+            'profile' : self.args.profile,
+            'color_space' : self.args.color_space,
+            'sweep' : self.args.sweep,
+            'adaptive' : self.args.adaptive,
+            'cache' : None if self.args.cache is None else ResultCache(self.args.cache),
+        }
+        with BatchAnalyzeCLI._open_metrics(self.args.metrics) as metrics:
+            batch = Batch(find_images(inputs), self.args.output,
+                palettes_dir=self.args.palettes, jobs=self.args.jobs,
+                max_in_flight=self.args.max_in_flight, options=options,
+                height=self.args.height, width=self.args.width,
+                metrics=metrics)
+            batch.run()
+
+    @staticmethod
+    def _open_metrics(metrics_path):
+        # The --metrics file to use as a context manager (None if there isn't
+        # one). Metrics are appended, like results.
+        if metrics_path is None:
+            return nullcontext()
+        if metrics_path == '-':
+            return nullcontext(stderr)
+        return open(metrics_path, 'a')
+
+    @staticmethod
+    def _read_list(list_path):
+        f = stdin if list_path == '-' else open(list_path, 'r')
+        with f:
+            return [l.strip() for l in f if l.strip()]
+
+if __name__ == '__main__':
+    cli = BatchAnalyzeCLI()
+    try:
+        cli.execute()
+    except KeyboardInterrupt:
+        exit(130)
@@ -0,0 +1,158 @@
+from json import dump
+from json import load
+from os import makedirs
+from os.path import join
+import cv2
+import numpy as np
+
+# A search index for finding images by color, e.g. "covers that are mostly
+# this orange", or "covers with a palette like this one". Build one from
+# anything that iterates Images (ImageSet, ImageStore, SQLiteImageSet):
+#
+#   index = ColorIndex.from_images(ImageSet.from_file('data.jsonl'))
+#   index.by_color([230, 120, 20], k=10)
+#   index.by_palette([([230, 120, 20], 0.7), ([20, 20, 20], 0.3)], k=10)
+#
+# Both queries return [(source_image, distance), ...], nearest first.
+# Distances are Earth Mover's Distances in RGB: how far (on average, per
+# pixel) the colors of one palette have to move to become the other,
+# weighing each color by its relative_volume.
+#
+# Every palette color of every image is packed into one (M, 3) matrix, with
+# the images' boundaries in `offsets` (image i's colors are rows
+# offsets[i]:offsets[i+1]), so a query is a few NumPy passes over M rows and
+# no Python per image. save() writes the arrays as .npy files, and load()
+# memory maps them, so opening a big index is cheap.
+#
+# by_color is exact: when one side is a single color, the EMD is just the
+# volume-weighted mean distance to the other palette's colors. For by_palette
+# we first rank every image by the Relaxed Word Mover's Distance (Kusner et al.
+# 2015), a lower bound on the EMD that only needs nearest-color distances, and
+# then compute the real EMD (cv2.EMD) for candidates in that order until the
+# bound says nothing further down can make it into the top k.
+#
+
+INDEX_FILES = ('colors.npy', 'volumes.npy', 'offsets.npy')
+KEYS_FILE = 'images.json'
+
+class ColorIndex(object):
+    def __init__(self, colors, volumes, offsets, keys):
+        self.colors = colors # (M, 3) float32 RGB
+        self.volumes = volumes # (M,) float32, summing to 1 for each image
+        self.offsets = offsets # (N+1,) int64
+        self.keys = keys # N source_images
+        self._sq_norms = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    @classmethod
+    def from_images(cls, images):
+        # Images without any colors can't be found by color and are left out.
+        colors = []
+        volumes = []
+        offsets = [0]
+        keys = []
+        for image in images:
+            if not image.colors:
+                continue
+            total = sum(c.relative_volume for c in image.colors)
+            for c in image.colors:
+                colors.append(c.rgb)
+                volumes.append(c.relative_volume / total if total else 1 / len(image.colors))
+            offsets.append(len(colors))
+            keys.append(image.source_image)
+        return cls(np.float32(colors).reshape((-1, 3)), np.float32(volumes),
+            np.int64(offsets), keys)
+
+    def save(self, path):
+        # path is a directory
+        makedirs(path, exist_ok=True)
+        for name, array in zip(INDEX_FILES, (self.colors, self.volumes, self.offsets)):
+            np.save(join(path, name), array)
+        with open(join(path, KEYS_FILE), 'w') as f:
+            dump(self.keys, f)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        mmap_mode = 'r' if mmap else None
+        arrays = [np.load(join(path, name), mmap_mode=mmap_mode) for name in INDEX_FILES]
+        with open(join(path, KEYS_FILE), 'r') as f:
+            keys = load(f)
+        return cls(*arrays, keys)
+
+    def by_color(self, rgb, k=10):
+        if not len(self) or k <= 0:
+            return []
+        distances = self._distances(np.float32([rgb]))[0]
+        per_image = np.add.reduceat(distances * self.volumes, self.offsets[:-1])
+        nearest = ColorIndex._smallest(per_image, k)
+        return [(self.keys[i], float(per_image[i])) for i in nearest]
+
+    def by_palette(self, palette, k=10):
+        # palette is [(rgb, relative_volume), ...]; the volumes needn't add up
+        # to 1. (A dominant_colors_list works too, see _palette.)
+        if not len(self) or k <= 0:
+            return []
+        query, weights = ColorIndex._palette(palette)
+        distances = self._distances(query) # (len(query), M)
+        starts = self.offsets[:-1]
+        # RWMD: move every color to the nearest color on the other side, both
+        # ways round, and keep the larger of the two.
+        to_query = np.add.reduceat(distances.min(axis=0) * self.volumes, starts)
+        from_query = weights @ np.minimum.reduceat(distances, starts, axis=1)
+        bounds = np.maximum(to_query, from_query)
+        query_signature = np.hstack((weights[:, None], query))
+        best = [] # (emd, i), sorted
+        for i in ColorIndex._ascending(bounds, k):
+            if len(best) == k and bounds[i] >= best[-1][0]:
+                break
+            start, stop = self.offsets[i], self.offsets[i + 1]
+            signature = np.hstack((self.volumes[start:stop, None], self.colors[start:stop]))
+            emd = cv2.EMD(query_signature, np.float32(signature), cv2.DIST_L2)[0]
+            best = sorted(best + [(emd, i)])[:k]
+        return [(self.keys[i], float(emd)) for emd, i in best]
+
+    def _distances(self, query):
+        # (len(query), M) Euclidean distances from the query colors to every
+        # indexed color, from |c - q|^2 = |c|^2 - 2c.q + |q|^2. The |c|^2 are
+        # worked out on the first query rather than in __init__, so that
+        # load() doesn't read the whole (memory mapped) index.
+        if self._sq_norms is None:
+            self._sq_norms = np.einsum('ij,ij->i', self.colors, self.colors)
+        sq = self._sq_norms - 2 * (query @ self.colors.T)
+        sq += np.einsum('ij,ij->i', query, query)[:, None]
+        return np.sqrt(np.maximum(sq, 0, out=sq), out=sq)
+
+    @staticmethod
+    def _palette(palette):
+        if palette and isinstance(palette[0], dict):
+            palette = [(c['rgb'], c['relative_volume']) for c in palette]
+        query = np.float32([rgb for rgb, _ in palette])
+        weights = np.float32([volume for _, volume in palette])
+        return query, weights / weights.sum()
+
+    @staticmethod
+    def _ascending(values, k):
+        # Yields indices in order of their values. The bound usually stops
+        # by_palette after a few times k candidates, so rather than sorting
+        # everything we sort the smallest n, then 2n, ...
+        seen = np.zeros(len(values), bool)
+        n = max(4 * k, 1)
+        while True:
+            head = ColorIndex._smallest(values, n)
+            for i in head[~seen[head]]:
+                seen[i] = True
+                yield i
+            if len(head) == len(values):
+                return
+            n *= 2
+
+    @staticmethod
+    def _smallest(values, k):
+        # Indices of the k smallest values, smallest first
+        k = min(k, len(values))
+        if k <= 0:
+            return np.empty(0, np.intp)
+        candidates = np.argpartition(values, k - 1)[:k]
+        return candidates[np.argsort(values[candidates], kind='stable')]
@@ -1,26 +1,231 @@
-from colorsys import rgb_to_hsv
+#!/usr/bin/env python3
+
+#
+# Sorting colors, and whole collections by their dominant colors, so that they
+# can be laid out as a smooth strip of color or a mosaic of palettes. See
+# --help.
+#
+# Everything works on (N, 3) arrays at once. Sort keys are for RGB floats in
+# [0, 1], as in colorsys; rgb_to_hsv, luminance and step_keys give the same
+# numbers as colorsys.rgb_to_hsv, lum and step do for one color at a time, and
+# sort_order the same order as sorting with them. The renderers build an
+# index from each output pixel to a color and then write every pixel once.
+#
+
+from argparse import ArgumentParser
+from colorsys import rgb_to_hsv as _rgb_to_hsv
+from math import ceil
 from math import sqrt
-from random import random
+from os.path import abspath
+from os.path import dirname
+from os.path import isdir
+from os.path import realpath
+from sys import path
+
+# This is necessary so that we can execute this file AND use it as a module.
+path.append(abspath(dirname(dirname(realpath(__file__)))))
+
+# (after the path.append above; importing cv2 resets sys.path)
 import cv2
 import numpy as np
 
-def viz(colors_rgb, width=1200, height=200):
-    image = np.zeros((height, width, 3), np.uint8)
-    section_width = 1/len(colors_rgb)
-    for i,color_rgb in enumerate(colors_rgb):
-        offset = int(i*section_width*width)
-        # Remember that in cv2 colors are B G R
-        image[:, offset:width] = [int(255.0*c) for c in reversed(color_rgb)]
+from cw.columnar_models import ColumnarImageSet
+from cw.models import ImageSet
+
+DESCRIPTION = 'Sort a collection by its dominant colors and draw it.'
+
+SORT_KEYS = ('step', 'hsv', 'lum', 'rgb')
+REPETITIONS = 8 # for the step sort; see step_keys
+BACKGROUND = (0, 0, 0) # BGR, for cells without an image, or an image without colors
+
+HELP = {
+    'input' : """A JSON or JSON Lines file of images (see
+cw.models.ImageSet.iter_file), or a directory saved by
+cw.columnar_models.ColumnarImageSet.""",
+
+    'output' : "The image file to write, e.g. mosaic.png.",
+
+    'key' : """How to sort: 'step' (default) groups by hue into --repetitions
+bands, then by luminance; 'hsv' by hue, saturation, value; 'lum' by
+luminance; 'rgb' by red, green, blue.""",
+
+    'repetitions' : f"The number of hue bands for the step sort. (default: {REPETITIONS})",
+
+    'alternate' : """Reverse the luminance of every other hue band in the step
+sort, so that neighboring bands meet smoothly.""",
+
+    'strip' : """Draw one strip of every image's dominant color, --width by
+--height, rather than a mosaic.""",
+
+    'dominant' : "Fill each cell of the mosaic with just the image's dominant color.",
+
+    'columns' : "The number of images across the mosaic. (default: 100)",
+
+    'cell' : "The width and height of each image's cell in the mosaic. (default: 40x10)",
+
+    'width' : "The width of the strip. (default: 1200)",
+
+    'height' : "The height of the strip. (default: 200)",
+}
+
+def rgb_to_hsv(rgb):
+    # (N, 3) RGB floats -> (N, 3) HSV floats, as colorsys.rgb_to_hsv
+    rgb = np.asarray(rgb, np.float64).reshape((-1, 3))
+    r, g, b = rgb.T
+    maxc = rgb.max(axis=1)
+    minc = rgb.min(axis=1)
+    rangec = maxc - minc
+    gray = rangec == 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        s = np.where(gray, 0.0, rangec / maxc)
+        rc = (maxc - r) / rangec
+        gc = (maxc - g) / rangec
+        bc = (maxc - b) / rangec
+    h = np.where(r == maxc, bc - gc, np.where(g == maxc, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = np.where(gray, 0.0, (h / 6.0) % 1.0)
+    return np.column_stack((h, s, maxc))
+
+def luminance(rgb):
+    # (N, 3) RGB floats -> (N,); see lum
+    rgb = np.asarray(rgb, np.float64).reshape((-1, 3))
+    return np.sqrt(.241 * rgb[:, 0] + .691 * rgb[:, 1] + .068 * rgb[:, 2])
+
+def step_keys(rgb, repetitions=1, alternate=False):
+    # (N, 3) RGB floats -> (N, 3) keys, as step: the hue band, luminance,
+    # and value band of each color
+    hsv = rgb_to_hsv(rgb)
+    l = luminance(rgb)
+    h2 = np.int64(hsv[:, 0] * repetitions)
+    v2 = np.int64(hsv[:, 2] * repetitions)
+    if alternate:
+        # invert the luminosity of every other segment for smoothness
+        odd = h2 % 2 == 1
+        v2 = np.where(odd, repetitions - v2, v2)
+        l = np.where(odd, repetitions - l, l)
+    return np.column_stack((h2, l, v2))
+
+def sort_order(rgb, key='step', repetitions=REPETITIONS, alternate=False):
+    # The indices that sort (N, 3) RGB floats by key (see SORT_KEYS). The sort
+    # is stable, i.e. the same as sorted(colors, key=...).
+    if key not in SORT_KEYS:
+        raise ValueError(f'key must be one of {SORT_KEYS !r}, not {key !r}')
+    rgb = np.asarray(rgb, np.float64).reshape((-1, 3))
+    if key == 'step':
+        keys = step_keys(rgb, repetitions, alternate)
+    elif key == 'hsv':
+        keys = rgb_to_hsv(rgb)
+    elif key == 'lum':
+        keys = luminance(rgb)[:, None]
+    else:
+        keys = rgb
+    # lexsort sorts by the last key first
+    return np.lexsort(keys.T[::-1])
+
+def dominant_order(images, key='step', repetitions=REPETITIONS, alternate=False):
+    # The indices that sort images (a ColumnarImageSet, or anything that
+    # iterates Images) by their dominant colors. Images without any colors go
+    # last.
+    images = as_columns(images)
+    has_colors = images.color_counts > 0
+    with_colors = np.flatnonzero(has_colors)
+    rgb = color_int_to_float(images.dominant_rgb[with_colors])
+    order = with_colors[sort_order(rgb, key, repetitions, alternate)]
+    return np.concatenate((order, np.flatnonzero(~has_colors)))
+
+def sort_images(image_set, key='step', repetitions=REPETITIONS, alternate=False):
+    # A new ImageSet of the images in image_set (anything indexable), sorted
+    # by their dominant colors
+    order = dominant_order(image_set, key, repetitions, alternate)
+    return ImageSet([image_set[i] for i in order])
+
+def strip(colors_rgb, width=1200, height=200):
+    # An image of equal sections of colors_rgb (RGB floats), left to right,
+    # or of BACKGROUND if there aren't any
+    colors_rgb = np.asarray(colors_rgb, np.float64).reshape((-1, 3))
+    n = len(colors_rgb)
+    image = np.empty((height, width, 3), np.uint8)
+    if n == 0:
+        image[:] = BACKGROUND
+        return image
+    # Section i starts at int(i * (1/n) * width); when sections are narrower
+    # than a pixel, the last one to start at a pixel gets it.
+    starts = np.int64(np.arange(n) * (1 / n) * width)
+    columns = np.searchsorted(starts, np.arange(width), side='right') - 1
+    # Remember that in cv2 colors are B G R
+    palette = np.uint8(np.int64(255.0 * colors_rgb[:, ::-1]))
+    image[:] = palette[columns]
+    return image
+
+def viz(colors_rgb, width=1200, height=200, image_path=None):
+    # Writes strip() to image_path, or shows it if there isn't one
+    image = strip(colors_rgb, width, height)
+    if image_path is not None:
+        cv2.imwrite(image_path, image)
+        return
     cv2.imshow('[Image]: Close with "0"', image)
     cv2.waitKey(0)
     cv2.destroyAllWindows()
 
+def palette_strips(images, width, dominant=False, background=BACKGROUND):
+    # (N, width, 3) BGR: one row per image with its palette, each color as
+    # wide as its share of the volume (the same arithmetic as
+    # ImageAnalyzer.viz), or just its dominant color.
+    images = as_columns(images)
+    n = len(images)
+    counts = images.color_counts
+    has_colors = counts > 0
+    strips = np.empty((n, width, 3), np.uint8)
+    strips[~has_colors] = background
+    if not has_colors.any():
+        return strips
+    bgr = np.ascontiguousarray(images.rgb[:, ::-1])
+    if dominant:
+        strips[has_colors] = bgr[images.offsets[:-1][has_colors], None]
+        return strips
+    # Each color gets int(volume / total * width) pixels and the last color
+    # of each image the rest. Sections start at image * width + the widths
+    # before them, so that one searchsorted finds every pixel's color.
+    image_ids = np.repeat(np.arange(n), counts)
+    volumes = np.float64(images.volumes)
+    totals = np.bincount(image_ids, weights=volumes, minlength=n)
+    shares = np.divide(volumes, totals[image_ids], out=np.zeros_like(volumes),
+        where=totals[image_ids] > 0)
+    widths = np.int64(shares * width)
+    before = np.cumsum(widths) - widths
+    before -= np.repeat(before[images.offsets[:-1][has_colors]], counts[has_colors])
+    starts = image_ids * width + before
+    pixels = np.arange(n * width).reshape((n, width))
+    index = np.searchsorted(starts, pixels, side='right') - 1
+    strips[has_colors] = bgr[index[has_colors]]
+    return strips
+
+def mosaic(images, columns=100, cell_width=40, cell_height=10, order=None,
+        dominant=False, background=BACKGROUND):
+    # A contact sheet of palette strips (see palette_strips), one cell per
+    # image, left to right and top to bottom in `order` (e.g. dominant_order)
+    images = as_columns(images)
+    if order is None:
+        order = np.arange(len(images))
+    rows = max(ceil(len(order) / columns), 1)
+    strips = palette_strips(images, cell_width, dominant, background)
+    cells = np.empty((rows * columns, cell_width, 3), np.uint8)
+    cells[:len(order)] = strips[order]
+    cells[len(order):] = background
+    image = np.empty((rows, cell_height, columns, cell_width, 3), np.uint8)
+    image[:] = cells.reshape((rows, 1, columns, cell_width, 3))
+    return image.reshape((rows * cell_height, columns * cell_width, 3))
+
+def as_columns(images):
+    if isinstance(images, ColumnarImageSet):
+        return images
+    return ColumnarImageSet.from_images(images)
+
 def lum(r,g,b):
     return sqrt(.241 * r + .691 * g + .068 * b)
 
 def step(r,g,b, repetitions=1, alternate=False):
     l = lum(r,g,b) #lum
-    h,s,v = rgb_to_hsv(r,g,b)
+    h,s,v = _rgb_to_hsv(r,g,b)
     h2 = int(h * repetitions)
     lum2 = int(l * repetitions)
     v2 = int(v * repetitions)
@@ -31,28 +236,50 @@ def step(r,g,b, repetitions=1, alternate=False):
     return (h2, l, v2)
 
 def color_float_to_int(rgb):
+    # Works for one color or an (N, 3) array
+    if isinstance(rgb, np.ndarray):
+        return np.int64(255.0 * rgb)
     return tuple(int(255.0*c) for c in rgb)
 
 def color_int_to_float(rgb):
+    # Works for one color or an (N, 3) array
+    if isinstance(rgb, np.ndarray):
+        return rgb / 255.0
     return tuple(c / 255.0 for c in rgb)
 
+class ColorSortingCLI(object):
 
-if __name__ == '__main__':
-    # colors = [[random() for _ in range(3)] for _ in range(1200)]
-
-    from models import ImageSet
-    image_set = ImageSet.from_file('/Users/jstroop/workspace/colorweight/images/ga/data.json')
-    colors = [color_int_to_float(rgb) for rgb in [i.colors[0].rgb for i in image_set]]
-
-    print(colors)
-    # viz(sorted(colors))
-
+    def __init__(self):
+        parser = ArgumentParser(description=DESCRIPTION, prog=__file__)
+        parser.add_argument('input', metavar='PATH', help=HELP['input'])
+        parser.add_argument('-o', '--output', metavar='PATH', required=True, help=HELP['output'])
+        parser.add_argument('-k', '--key', default='step', choices=SORT_KEYS, help=HELP['key'])
+        parser.add_argument('-r', '--repetitions', metavar='NUMBER', type=int, default=REPETITIONS, help=HELP['repetitions'])
+        parser.add_argument('--alternate', action='store_true', default=False, help=HELP['alternate'])
+        parser.add_argument('--strip', action='store_true', default=False, help=HELP['strip'])
+        parser.add_argument('--dominant', action='store_true', default=False, help=HELP['dominant'])
+        parser.add_argument('-c', '--columns', metavar='NUMBER', type=int, default=100, help=HELP['columns'])
+        parser.add_argument('--cell', metavar='WxH', default='40x10', help=HELP['cell'])
+        parser.add_argument('--width', metavar='NUMBER', type=int, default=1200, help=HELP['width'])
+        parser.add_argument('--height', metavar='NUMBER', type=int, default=200, help=HELP['height'])
+        self.args = parser.parse_args()
 
-    # in colorsys colors are floats between 0-1 (not 0-255)
+    def execute(self):
+        if isdir(self.args.input):
+            images = ColumnarImageSet.load(self.args.input)
+        else:
+            images = ColumnarImageSet.from_file(self.args.input)
+        order = dominant_order(images, self.args.key, self.args.repetitions,
+            self.args.alternate)
+        if self.args.strip:
+            order = order[images.color_counts[order] > 0]
+            colors = color_int_to_float(images.dominant_rgb[order])
+            viz(colors, self.args.width, self.args.height, self.args.output)
+        else:
+            w, h = map(int, map(str.strip, self.args.cell.split('x')))
+            image = mosaic(images, self.args.columns, w, h, order=order,
+                dominant=self.args.dominant)
+            cv2.imwrite(self.args.output, image)
 
-    # in colorsys colors are floats between 0-1 (not 0-255)
-    # lum_sorted = sorted(colors, key=lambda rgb: lum(*rgb))
-    # viz(lum_sorted)
-
-    step_sorted = sorted(colors, key=lambda rgb: step(*rgb,8))
-    viz(step_sorted)
+if __name__ == '__main__':
+    ColorSortingCLI().execute()
@@ -0,0 +1,162 @@
+from os import makedirs
+from os.path import join
+import numpy as np
+
+from cw.models import ColorVolume
+from cw.models import Image
+from cw.models import ImageSet
+
+# A columnar ImageSet, for collections that are too big to hold as
+# dataclasses. Every color of every image is packed into two arrays, one row
+# per color: `rgb` ((M, 3) uint8) and `volumes` ((M,) float64), with the
+# images' boundaries in `offsets` (image i's colors are rows
+# offsets[i]:offsets[i+1]). The source_image and palette_image paths live in
+# one UTF-8 string table, `strings`: source_image i is
+# strings[string_offsets[2i]:string_offsets[2i+1]], and palette_image i is the
+# next string, or None if null_palettes[i].
+#
+# save() writes each array as a .npy file in a directory, and load() memory
+# maps them (np.load(..., mmap_mode='r')), so opening even a very big set reads
+# nothing until it's used. Images are only made into dataclasses when they're
+# asked for (__getitem__, __iter__), and aggregates like color_variance are
+# computed for the whole set at once, with NumPy.
+#
+# Conversion to and from the JSON formats in models.py is lossless: volumes
+# are kept as float64 (i.e. Python floats) rather than float32, and export_json
+# writes exactly what ImageSet.save would.
+
+COLUMN_FILES = ('rgb.npy', 'volumes.npy', 'offsets.npy', 'strings.npy',
+    'string_offsets.npy', 'null_palettes.npy')
+
+class ColumnarImageSet(object):
+    def __init__(self, rgb, volumes, offsets, strings, string_offsets, null_palettes):
+        self.rgb = rgb # (M, 3) uint8
+        self.volumes = volumes # (M,) float64
+        self.offsets = offsets # (N+1,) int64
+        self.strings = strings # (B,) uint8, UTF-8
+        self.string_offsets = string_offsets # (2N+1,) int64
+        self.null_palettes = null_palettes # (N,) bool
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError('ColumnarImageSet index out of range')
+        start, stop = self.offsets[position], self.offsets[position + 1]
+        colors = [ColorVolume(float(v), rgb) for v, rgb
+            in zip(self.volumes[start:stop], self.rgb[start:stop].tolist())]
+        return Image(colors, self.palette_image(position), self.source_image(position))
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def source_image(self, position):
+        return self._string(2 * position)
+
+    def palette_image(self, position):
+        if self.null_palettes[position]:
+            return None
+        return self._string(2 * position + 1)
+
+    @property
+    def color_counts(self):
+        # (N,) the number of colors of each image
+        return np.diff(self.offsets)
+
+    @property
+    def dominant_rgb(self):
+        # (N, 3) the dominant (i.e. first) color of each image; zeros for
+        # images without any colors (see dominant_volume)
+        dominant = np.zeros((len(self), 3), np.uint8)
+        has_colors = self.color_counts > 0
+        dominant[has_colors] = self.rgb[self.offsets[:-1][has_colors]]
+        return dominant
+
+    @property
+    def dominant_volume(self):
+        # (N,) the relative_volume of each image's dominant color, or NaN
+        volume = np.full(len(self), np.nan)
+        has_colors = self.color_counts > 0
+        volume[has_colors] = self.volumes[self.offsets[:-1][has_colors]]
+        return volume
+
+    @property
+    def color_variance(self):
+        # (N,) Image.color_variance (the population variance of the relative
+        # volumes) of every image, or NaN for images without any colors
+        counts = self.color_counts
+        variance = np.full(len(self), np.nan)
+        has_colors = counts > 0
+        if not has_colors.any():
+            return variance
+        # Images without colors have no rows, so they can just be left out of
+        # the segments.
+        starts = self.offsets[:-1][has_colors]
+        counts = counts[has_colors]
+        means = np.add.reduceat(self.volumes, starts) / counts
+        deviations = self.volumes - np.repeat(means, counts)
+        variance[has_colors] = np.add.reduceat(deviations**2, starts) / counts
+        return variance
+
+    @classmethod
+    def from_images(cls, images):
+        # images is anything that iterates Images (ImageSet, ImageStore,
+        # SQLiteImageSet...)
+        rgb = []
+        volumes = []
+        offsets = [0]
+        strings = []
+        null_palettes = []
+        for image in images:
+            for c in image.colors:
+                rgb.append(c.rgb)
+                volumes.append(c.relative_volume)
+            offsets.append(len(volumes))
+            strings.append(image.source_image)
+            strings.append(image.palette_image or '')
+            null_palettes.append(image.palette_image is None)
+        rgb = np.int64(rgb).reshape((-1, 3))
+        if rgb.size and (rgb.min() < 0 or rgb.max() > 255):
+            raise ValueError('rgb values must be between 0 and 255')
+        encoded = [s.encode('utf-8') for s in strings]
+        string_offsets = np.cumsum([0] + [len(s) for s in encoded])
+        return cls(np.uint8(rgb), np.float64(volumes), np.int64(offsets),
+            np.frombuffer(b''.join(encoded), np.uint8),
+            np.int64(string_offsets), np.bool_(null_palettes))
+
+    @classmethod
+    def from_file(cls, path):
+        # From a JSON or JSON Lines file (see ImageSet.iter_file)
+        return cls.from_images(ImageSet.iter_file(path))
+
+    def to_image_set(self):
+        return ImageSet(list(self))
+
+    def export_json(self, path):
+        # Writes the same JSON as ImageSet.save
+        ImageSet.write(self, path)
+
+    def save(self, path):
+        # path is a directory
+        makedirs(path, exist_ok=True)
+        for name, array in zip(COLUMN_FILES, self._columns()):
+            np.save(join(path, name), array)
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        mmap_mode = 'r' if mmap else None
+        return cls(*[np.load(join(path, name), mmap_mode=mmap_mode)
+            for name in COLUMN_FILES])
+
+    def _columns(self):
+        return (self.rgb, self.volumes, self.offsets, self.strings,
+            self.string_offsets, self.null_palettes)
+
+    def _string(self, index):
+        start, stop = self.string_offsets[index], self.string_offsets[index + 1]
+        return self.strings[start:stop].tobytes().decode('utf-8')
@@ -3,6 +3,9 @@ from dataclasses import dataclass
 from json import dumps
 from json import loads
 from json import load
+from os import fsync
+from os import replace
+from os.path import exists
 from statistics import pvariance
 from typing import List
 
@@ -85,6 +88,18 @@ class ImageSet(_CWClass):
         with open(path, 'w') as f:
             f.write(self.to_jsons())
 
+    @staticmethod
+    def write(images, path):
+        # Writes the same JSON as save for anything that iterates Images,
+        # without holding them all in memory.
+        with open(path, 'w') as f:
+            first = True
+            for image in images:
+                f.write('[\n  ' if first else ',\n  ')
+                f.write(image.to_jsons().replace('\n', '\n  '))
+                first = False
+            f.write('[]' if first else '\n]')
+
     @classmethod
     def from_dict_or_list(cls, l):
         images = [Image.from_dict_or_list(d) for d in l]
@@ -92,10 +107,134 @@ class ImageSet(_CWClass):
 
     @staticmethod
     def from_file(path):
+        return ImageSet(list(ImageSet.iter_file(path)))
+
+    @staticmethod
+    def iter_file(path):
+        # Yields the Images in either a JSON array (see save) or an
+        # ImageStore's JSON Lines, which are read one record at a time.
         with open(path, 'r') as f:
-            d = load(f)
-            set = ImageSet.from_dict_or_list(d)
-        return set
+            first = f.read(1)
+            while first.isspace():
+                first = f.read(1)
+            if first == '[':
+                f.seek(0)
+                yield from ImageSet.from_dict_or_list(load(f))
+                return
+        yield from ImageStore(path)
+
+class ImageStore(object):
+    # An append-only store of Image records: one JSON object per line (JSON
+    # Lines), so adding an image costs one write rather than rewriting the
+    # whole set like ImageSet.save does.
+    #
+    # Appends are flushed and fsync'd before append returns, so after a crash
+    # the file holds every finished record plus, at worst, a partial last line.
+    # Reading skips that line; it's cut off before the store's first append,
+    # so that just opening a store (e.g. in ImageSet.iter_file) never changes
+    # the file, or a line that another process is still writing. Records are
+    # keyed by source_image; if an image is appended again the later record
+    # wins.
+    # compact() rewrites the file without the superseded (`stale`) records.
+
+    def __init__(self, path, sync=True):
+        self.path = path
+        self.sync = sync
+        self._offsets = {} # source_image -> offset of its latest record
+        self._n_lines = 0
+        self._partial = None # the offset of a partial last line, if any
+        self._file = None
+        if exists(path):
+            self._scan()
+
+    def __contains__(self, source_image):
+        return source_image in self._offsets
+
+    def __len__(self):
+        return len(self._offsets)
+
+    @property
+    def stale(self):
+        # The number of lines that compact() would get rid of
+        return self._n_lines - len(self._offsets)
+
+    def __iter__(self):
+        # Streams the live records, in the order they were (last) appended
+        live = set(self._offsets.values())
+        if not exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            offset = f.tell()
+            line = f.readline()
+            while line.endswith(b'\n'):
+                if offset in live:
+                    yield Image.from_dict_or_list(loads(line))
+                offset = f.tell()
+                line = f.readline()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, image):
+        if self._file is None:
+            if self._partial is not None:
+                # So that this record starts on a line of its own
+                with open(self.path, 'r+b') as f:
+                    f.truncate(self._partial)
+                self._partial = None
+            self._file = open(self.path, 'ab')
+        offset = self._file.tell()
+        self._file.write(ImageStore._line(image))
+        self._file.flush()
+        if self.sync:
+            fsync(self._file.fileno())
+        self._offsets[image.source_image] = offset
+        self._n_lines += 1
+
+    def compact(self):
+        # Write the live records to a new file and swap it in. os.replace is
+        # atomic, so a crash part way through leaves the old file as it was.
+        self.close()
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            for image in self:
+                f.write(ImageStore._line(image))
+            f.flush()
+            fsync(f.fileno())
+        replace(tmp_path, self.path)
+        self._scan()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _scan(self):
+        # Index the file, and note where a partial last line (left by a crash)
+        # starts, for append to cut it off.
+        self._offsets = {}
+        self._n_lines = 0
+        with open(self.path, 'rb') as f:
+            offset = f.tell()
+            line = f.readline()
+            while line.endswith(b'\n'):
+                try:
+                    source_image = loads(line)['source_image']
+                except (ValueError, KeyError):
+                    pass # garbage; compact() will drop it
+                else:
+                    self._offsets[source_image] = offset
+                self._n_lines += 1
+                offset = f.tell()
+                line = f.readline()
+        self._partial = offset if line else None
+
+    @staticmethod
+    def _line(image):
+        return (dumps(image.to_dict(), sort_keys=True) + '\n').encode('utf-8')
 
 if __name__ == "__main__":
     set = ImageSet.from_file('/Users/jstroop/workspace/colorweight/data.json')
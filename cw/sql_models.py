@@ -0,0 +1,195 @@
+from itertools import groupby
+from sqlite3 import connect
+
+from cw.models import ColorVolume
+from cw.models import Image
+from cw.models import ImageSet
+
+# A SQLite-backed ImageSet, for collections that are too big to load into
+# memory as dataclasses. It has the same append/__getitem__/__len__ surface as
+# ImageSet, but images are only read from the database when they're asked for,
+# and the dominant (i.e. first) color and color_variance of each image are
+# indexed columns, so collections can be queried by those without loading
+# anything else (see by_dominant_color and by_color_variance).
+#
+# import_file/export_json convert to and from the JSON formats in models.py.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    id INTEGER PRIMARY KEY,
+    source_image TEXT NOT NULL UNIQUE,
+    palette_image TEXT,
+    color_variance REAL,
+    dominant_r INTEGER,
+    dominant_g INTEGER,
+    dominant_b INTEGER,
+    dominant_volume REAL
+);
+CREATE TABLE IF NOT EXISTS colors (
+    image_id INTEGER NOT NULL REFERENCES images (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    r INTEGER NOT NULL,
+    g INTEGER NOT NULL,
+    b INTEGER NOT NULL,
+    relative_volume REAL NOT NULL,
+    PRIMARY KEY (image_id, position)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS images_dominant_color
+    ON images (dominant_r, dominant_g, dominant_b);
+CREATE INDEX IF NOT EXISTS images_color_variance
+    ON images (color_variance);
+"""
+
+# If an image (by source_image) is added again it replaces what was there,
+# same as ImageStore.
+UPSERT_IMAGE = """
+INSERT INTO images (source_image, palette_image, color_variance, dominant_r,
+    dominant_g, dominant_b, dominant_volume)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (source_image) DO UPDATE SET
+    palette_image = excluded.palette_image,
+    color_variance = excluded.color_variance,
+    dominant_r = excluded.dominant_r,
+    dominant_g = excluded.dominant_g,
+    dominant_b = excluded.dominant_b,
+    dominant_volume = excluded.dominant_volume
+"""
+
+INSERT_COLOR = """
+INSERT INTO colors (image_id, position, r, g, b, relative_volume)
+VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+# Images with their colors, one row per color, in order. Callers add WHERE,
+# ORDER BY and LIMIT/OFFSET clauses to the inner query, and the order of the
+# images to the outer one.
+SELECT_IMAGES = """
+SELECT i.id, i.source_image, i.palette_image, c.r, c.g, c.b, c.relative_volume
+FROM (SELECT id, source_image, palette_image, color_variance FROM images {}) AS i
+LEFT JOIN colors AS c ON c.image_id = i.id
+ORDER BY {}, c.position
+"""
+
+BATCH_SIZE = 10000
+
+class SQLiteImageSet(object):
+    def __init__(self, path):
+        self.path = path
+        self._connection = connect(path)
+        self._connection.execute('PRAGMA foreign_keys = ON')
+        self._connection.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._connection.execute('SELECT COUNT(*) FROM images').fetchone()[0]
+
+    def __getitem__(self, position):
+        # Positions are in the order images were first added.
+        if isinstance(position, slice):
+            start, stop, step = position.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            where = 'ORDER BY id LIMIT ? OFFSET ?'
+            return list(self._select(where, (max(stop - start, 0), start)))
+        if position < 0:
+            position += len(self)
+        images = list(self._select('ORDER BY id LIMIT 1 OFFSET ?', (position,)))
+        if position < 0 or not images:
+            raise IndexError('SQLiteImageSet index out of range')
+        return images[0]
+
+    def __iter__(self):
+        return self._select('')
+
+    def __contains__(self, source_image):
+        query = 'SELECT 1 FROM images WHERE source_image = ?'
+        return self._connection.execute(query, (source_image,)).fetchone() is not None
+
+    def append(self, image):
+        self.extend([image])
+
+    def extend(self, images, batch_size=BATCH_SIZE):
+        # Adds images in transactions of batch_size; much faster than one at a
+        # time.
+        images = iter(images)
+        while True:
+            batch = [image for _, image in zip(range(batch_size), images)]
+            if not batch:
+                break
+            with self._connection:
+                cursor = self._connection.cursor()
+                colors = []
+                for image in batch:
+                    colors += self._upsert(cursor, image)
+                cursor.executemany(INSERT_COLOR, colors)
+
+    def by_dominant_color(self, rgb, tolerance=16, limit=None):
+        # Images whose dominant color is within tolerance of rgb on every
+        # channel, e.g. by_dominant_color([230, 120, 20]) for "mostly orange".
+        r, g, b = rgb
+        where = """WHERE dominant_r BETWEEN ? AND ?
+            AND dominant_g BETWEEN ? AND ?
+            AND dominant_b BETWEEN ? AND ?"""
+        params = (r - tolerance, r + tolerance, g - tolerance, g + tolerance,
+            b - tolerance, b + tolerance)
+        return self._select(*SQLiteImageSet._limit(where, params, limit))
+
+    def by_color_variance(self, low=None, high=None, limit=None):
+        # Images with color_variance in [low, high], least varied first.
+        # (Low variance: the colors have similar volumes; high: one dominates.)
+        where = 'WHERE color_variance BETWEEN ? AND ? ORDER BY color_variance, id'
+        params = (float('-inf') if low is None else low,
+            float('inf') if high is None else high)
+        where, params = SQLiteImageSet._limit(where, params, limit)
+        return self._select(where, params, order='i.color_variance, i.id')
+
+    def import_file(self, path, batch_size=BATCH_SIZE):
+        # Adds the images from a JSON or JSON Lines file (see
+        # ImageSet.iter_file)
+        self.extend(ImageSet.iter_file(path), batch_size=batch_size)
+
+    def export_json(self, path):
+        # Writes the same JSON as ImageSet.save, without loading every image
+        # first.
+        ImageSet.write(self, path)
+
+    def close(self):
+        self._connection.close()
+
+    def _upsert(self, cursor, image):
+        # Returns the rows to insert into colors
+        if image.colors:
+            dominant = image.colors[0]
+            variance = image.color_variance
+            r, g, b = dominant.rgb
+            row = (variance, r, g, b, dominant.relative_volume)
+        else:
+            row = (None,) * 5
+        cursor.execute(UPSERT_IMAGE, (image.source_image, image.palette_image) + row)
+        query = 'SELECT id FROM images WHERE source_image = ?'
+        image_id = cursor.execute(query, (image.source_image,)).fetchone()[0]
+        cursor.execute('DELETE FROM colors WHERE image_id = ?', (image_id,))
+        return [(image_id, position, *c.rgb, c.relative_volume)
+            for position, c in enumerate(image.colors)]
+
+    def _select(self, where, params=(), order='i.id'):
+        # Streams Images; see SELECT_IMAGES
+        query = SELECT_IMAGES.format(where, order)
+        rows = self._connection.execute(query, params)
+        for _, image_rows in groupby(rows, key=lambda row: row[0]):
+            image_rows = list(image_rows)
+            colors = [ColorVolume(row[6], list(row[3:6])) for row in image_rows
+                if row[3] is not None] # LEFT JOIN: an image with no colors
+            _, source_image, palette_image = image_rows[0][:3]
+            yield Image(colors, palette_image, source_image)
+
+    @staticmethod
+    def _limit(where, params, limit):
+        if limit is None:
+            return where, params
+        return f'{where} LIMIT ?', params + (limit,)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+
+#
+# Download and analyze a whole IIIF collection (or a list of image URLs) in
+# one go, without a staging directory: images are decoded straight from the
+# downloaded bytes, and the results go into an ImageStore. Saving the images
+# and writing palette PNGs are both optional. See --help.
+#
+# Downloads run on a pool of threads and analysis on a pool of processes, at
+# the same time, so the slower of the two sets the pace. At most
+# --max-in-flight images are being downloaded or waiting for / in analysis at
+# once, which bounds the memory used for downloaded bytes.
+#
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from os import makedirs
+from os import replace
+from os.path import abspath
+from os.path import dirname
+from os.path import join
+from os.path import realpath
+from sys import exit
+from sys import path
+from sys import stderr
+from time import perf_counter
+
+# This is necessary so that we can execute this file AND use it as a module.
+path.append(abspath(dirname(dirname(realpath(__file__)))))
+
+from cw.batch_analyze import Batch
+from cw.batch_analyze import BatchAnalyzeCLI
+from cw.batch_analyze import analyze
+from cw.utils.cache import ResultCache
+from cw.utils.color_analysis import COLOR_SPACES
+from cw.utils.color_analysis import ENGINES
+from cw.utils.color_analysis import MAX_PIXELS
+from cw.utils.color_analysis import PROFILE
+from cw.utils.color_analysis import PROFILES
+from cw.utils.color_analysis import SWEEPS
+from cw.utils.color_analysis import init_analysis_worker
+from cw.utils.colorweight import DEFAULT_HEIGHT
+from cw.utils.colorweight import DEFAULT_WIDTH
+from cw.utils.colorweight import GeometryAction
+from cw.utils.iiif import fetch_image
+from cw.utils.image_fetch import ImageCollector
+from cw.utils.image_fetch import WORKERS as FETCHERS
+
+DESCRIPTION = 'Download and analyze a IIIF collection by color, without staging it on disk.'
+
+IIIF_PARAMS = '/full/!800,800/0/default.jpg'
+
+HELP = {
+    'collection' : "The URI of a IIIF Collection manifest.",
+
+    'from_file' : """Analyze the image URLs listed, one per line, in this file
+('-' for stdin) instead of a collection. URLs that don't end in an image
+extension are taken to be IIIF Image API services.""",
+
+    'output' : """The JSON Lines file that results are appended to. Images (by
+URL) that are already in it are skipped. (default: data.jsonl)""",
+
+    'palettes' : """Write a palette PNG for each image to this directory. (default:
+don't)""",
+
+    'images' : """Also save the downloaded images to this directory. (default:
+don't)""",
+
+    'iiif_params' : f"""Appended to each thumbnail's IIIF service. (default:
+{IIIF_PARAMS}, or with --max-pixels, the smallest size of each image that has
+that many pixels)""",
+
+    'fetchers' : f"""The number of concurrent downloads. (default: {FETCHERS})""",
+
+    'jobs' : """The number of processes analyzing images. (default: the number
+of CPUs)""",
+
+    'max_in_flight' : """The most images being downloaded or analyzed at once.
+(default: --fetchers plus twice --jobs)""",
+
+    'max_pixels' : """Analyze at most this many pixels per image; see
+colorweight.py --max-pixels.""",
+
+    'engine' : "See colorweight.py --engine. (default: cv2)",
+
+    'profile' : "See colorweight.py --profile. (default: exact)",
+    'color_space' : "See colorweight.py --color-space. (default: bgr)",
+
+    'sweep' : "See colorweight.py --sweep. (default: full)",
+
+    'adaptive' : "See colorweight.py --adaptive.",
+
+    'cache' : "See colorweight.py --cache. (default: don't cache)",
+
+    'metrics' : """See batch_analyze.py --metrics. Download times are
+included. (default: don't)""",
+}
+
+class StreamBatch(Batch):
+    # A Batch whose images come from URLs. `sources` are (name, url) pairs;
+    # url is the source_image in the store, and name is used for the palette
+    # PNG and saved image, if any (see ImageCollector.thumbnail_urls).
+    def __init__(self, sources, store_path, collector, palettes_dir=None,
+            images_dir=None, fetchers=FETCHERS, jobs=None, max_in_flight=None,
+            options=None, height=DEFAULT_HEIGHT, width=DEFAULT_WIDTH, log=stderr,
+            metrics=None):
+        super(StreamBatch, self).__init__(sources, store_path, jobs=jobs,
+            options=options, height=height, width=width, log=log,
+            metrics=metrics)
+        self.collector = collector
+        self.palettes_dir = palettes_dir
+        self.images_dir = images_dir
+        self.fetchers = fetchers
+        self.max_in_flight = max_in_flight or fetchers + 2 * self.jobs
+
+    def run(self):
+        for d in (self.palettes_dir, self.images_dir):
+            if d is not None:
+                makedirs(d, exist_ok=True)
+        with ThreadPoolExecutor(self.fetchers) as fetch_pool, \
+                ProcessPoolExecutor(self.jobs, initializer=init_analysis_worker) as pool:
+            # Each image is downloaded, and then analyzed (see Batch._process)
+            return self._process(lambda source: source[1],
+                lambda source: self._fetch(fetch_pool, pool, *source))
+
+    def _fetch(self, fetch_pool, pool, name, url):
+        future = fetch_pool.submit(self._download, name, url)
+        future.name = name
+        future.image_path = url
+        future.then = lambda fetched: self._analyze(pool, fetched)
+        return future
+
+    def _download(self, name, url):
+        # Runs on a fetch thread; returns (the image's bytes, seconds taken)
+        start = perf_counter()
+        max_pixels = self.options.get('max_pixels')
+        data = fetch_image(url, max_pixels=max_pixels, session=self.collector.session)
+        if self.images_dir is not None:
+            image_path = join(self.images_dir, f'{name}.jpg')
+            with open(f'{image_path}.part', 'wb') as f:
+                f.write(data)
+            replace(f'{image_path}.part', image_path)
+        return data, perf_counter() - start
+
+    def _analyze(self, pool, fetched):
+        palette_image_path = None
+        if self.palettes_dir is not None:
+            palette_image_path = join(self.palettes_dir, f'{fetched.name}.png')
+        data, seconds = fetched.result()
+        options = dict(self.options, image_bytes=data)
+        future = pool.submit(analyze, fetched.image_path, palette_image_path,
+            options, self.height, self.width, self.metrics is not None)
+        future.image_path = fetched.image_path
+        future.stages = {'fetch' : seconds}
+        return future
+
+class StreamAnalyzeCLI(object):
+
+    def __init__(self):
+        parser = ArgumentParser(description=DESCRIPTION, prog=__file__)
+        parser.add_argument('collection', nargs='?', metavar='URI', help=HELP['collection'])
+        parser.add_argument('-f', '--from-file', metavar='PATH', help=HELP['from_file'])
+        parser.add_argument('-o', '--output', metavar='PATH', default='data.jsonl', help=HELP['output'])
+        parser.add_argument('-p', '--palettes', metavar='DIR', default=None, help=HELP['palettes'])
+        parser.add_argument('-i', '--images', metavar='DIR', default=None, help=HELP['images'])
+        parser.add_argument('--iiif-params', metavar='PARAMS', default=None, help=HELP['iiif_params'])
+        parser.add_argument('-F', '--fetchers', metavar='NUMBER', type=int, default=FETCHERS, help=HELP['fetchers'])
+        parser.add_argument('-j', '--jobs', metavar='NUMBER', type=int, default=None, help=HELP['jobs'])
+        parser.add_argument('--max-in-flight', metavar='NUMBER', type=int, default=None, help=HELP['max_in_flight'])
+        parser.add_argument('-g', '--geometry', action=GeometryAction)
+        parser.add_argument('-m', '--max-pixels', metavar='NUMBER', type=int, default=MAX_PIXELS, help=HELP['max_pixels'])
+        parser.add_argument('-e', '--engine', default='cv2', choices=ENGINES, help=HELP['engine'])
+        parser.add_argument('--profile', default=PROFILE, choices=PROFILES, help=HELP['profile'])
+        parser.add_argument('--color-space', default='bgr', choices=COLOR_SPACES, help=HELP['color_space'])
+        parser.add_argument('-s', '--sweep', default='full', choices=SWEEPS, help=HELP['sweep'])
+        parser.add_argument('-a', '--adaptive', action='store_true', default=False, help=HELP['adaptive'])
+        parser.add_argument('--cache', metavar='DIR', default=None, help=HELP['cache'])
+        parser.add_argument('--metrics', metavar='PATH', default=None, help=HELP['metrics'])
+        # set by --geometry
+        parser.set_defaults(width=DEFAULT_WIDTH, height=DEFAULT_HEIGHT)
+
+        args = parser.parse_args()
+        del args.geometry
+        if (args.collection is None) == (args.from_file is None):
+            parser.error('give either a collection or --from-file')
+        if args.engine == 'minibatch' and args.sweep == 'incremental':
+            parser.error('--engine minibatch only does --sweep full')
+        self.args = args
+
+    def execute(self):
+        iiif_params = self.args.iiif_params
+        if iiif_params is None:
+            # Without params the thumbnail URLs are the IIIF services
+            # themselves, and fetch_image asks each for a size to suit
+            # --max-pixels.
+            iiif_params = IIIF_PARAMS if self.args.max_pixels is None else ''
+        collector = ImageCollector(self.args.collection,
+            iiif_params=iiif_params, workers=self.args.fetchers)
+        if self.args.collection is not None:
+            sources = list(collector.thumbnail_urls())
+        else:
+            urls = BatchAnalyzeCLI._read_list(self.args.from_file)
+            sources = [(str(i).zfill(4), url) for i, url in enumerate(urls, 1)]
+        options = {
+            'max_pixels' : self.args.max_pixels,
+            'engine' : self.args.engine,
+            'profile' : self.args.profile,
+            'color_space' : self.args.color_space,
+            'sweep' : self.args.sweep,
+            'adaptive' : self.args.adaptive,
+            'cache' : None if self.args.cache is None else ResultCache(self.args.cache),
+        }
+        with BatchAnalyzeCLI._open_metrics(self.args.metrics) as metrics:
+            batch = StreamBatch(sources, self.args.output, collector,
+                palettes_dir=self.args.palettes, images_dir=self.args.images,
+                fetchers=self.args.fetchers, jobs=self.args.jobs,
+                max_in_flight=self.args.max_in_flight, options=options,
+                height=self.args.height, width=self.args.width,
+                metrics=metrics)
+            batch.run()
+
+if __name__ == '__main__':
+    cli = StreamAnalyzeCLI()
+    try:
+        cli.execute()
+    except KeyboardInterrupt:
+        exit(130)
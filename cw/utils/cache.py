@@ -0,0 +1,129 @@
+from hashlib import sha256
+from json import dumps
+from os import environ
+from os import makedirs
+from os import remove
+from os import replace
+from os import scandir
+from os import utime
+from os.path import dirname
+from os.path import expanduser
+from os.path import join
+from tempfile import mkstemp
+from zipfile import BadZipFile
+import numpy as np
+#
+# An on-disk cache of analysis results for ./color_analysis.py, so that
+# analyzing the same image the same way again (e.g. for a palette at a
+# different size, or a different number of colors) doesn't cluster again.
+#
+# Records are .npz files of NumPy arrays, named for a content address: the
+# sha256 of the encoded image plus the parameters that affect the result (see
+# cache_key). Writers write to a temporary file and os.replace it into place,
+# so concurrent writers (e.g. batch_analyze.py's workers) never leave a partial
+# record; if two write the same key, they write the same thing. Reading a
+# record touches its mtime, and once the cache is over max_bytes the least
+# recently used records are deleted, down to LOW_WATER of max_bytes.
+#
+
+CACHE_DIR = join(environ.get('XDG_CACHE_HOME', expanduser('~/.cache')), 'colorweight')
+CACHE_SIZE = 256 * 1024 * 1024 # bytes
+LOW_WATER = 0.9
+
+# This process's running estimate of the size of each cache directory, so
+# that we don't have to scan it on every put
+_sizes = {}
+
+def content_hash(data=None, path=None, chunk_size=1024 * 1024):
+    # The sha256 of either data (bytes) or the file at path
+    h = sha256()
+    if data is not None:
+        h.update(data)
+    else:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+def cache_key(digest, params):
+    # params is a dict of anything that can go in JSON
+    h = sha256(digest.encode())
+    h.update(dumps(params, sort_keys=True).encode())
+    return h.hexdigest()
+
+class ResultCache(object):
+    def __init__(self, directory=CACHE_DIR, max_bytes=CACHE_SIZE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def get(self, key):
+        # Returns a dict of arrays, or None
+        path = self._path(key)
+        try:
+            with np.load(path) as record:
+                arrays = dict(record)
+            utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, BadZipFile):
+            # Damaged somehow; get rid of it and start again
+            ResultCache._remove(path)
+            return None
+        return arrays
+
+    def put(self, key, arrays):
+        path = self._path(key)
+        shard = dirname(path)
+        makedirs(shard, exist_ok=True)
+        fd, tmp_path = mkstemp(dir=shard, suffix='.tmp')
+        try:
+            with open(fd, 'wb') as f:
+                np.savez(f, **arrays)
+                size = f.tell()
+            replace(tmp_path, path)
+        except BaseException:
+            ResultCache._remove(tmp_path)
+            raise
+        if self.directory not in _sizes:
+            _sizes[self.directory] = self._scan()[1]
+        else:
+            _sizes[self.directory] += size
+        if _sizes[self.directory] > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        # Delete the least recently used records until we're under LOW_WATER
+        records, total = self._scan()
+        for _, size, path in sorted(records):
+            if total <= self.max_bytes * LOW_WATER:
+                break
+            ResultCache._remove(path)
+            total -= size
+        _sizes[self.directory] = total
+
+    def _path(self, key):
+        return join(self.directory, key[:2], f'{key}.npz')
+
+    def _scan(self):
+        # Returns ([(mtime, size, path), ...], total size)
+        records = []
+        try:
+            shards = [e.path for e in scandir(self.directory) if e.is_dir()]
+        except FileNotFoundError:
+            return records, 0
+        for shard in shards:
+            for e in scandir(shard):
+                if e.name.endswith('.npz'):
+                    try:
+                        stat = e.stat()
+                    except FileNotFoundError: # evicted by someone else
+                        continue
+                    records.append((stat.st_mtime, stat.st_size, e.path))
+        return records, sum(r[1] for r in records)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            remove(path)
+        except FileNotFoundError:
+            pass
@@ -1,7 +1,36 @@
-from numpy.matlib import repmat
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from json import dumps
+from multiprocessing.sharedctypes import RawArray
+from signal import SIG_IGN
+from signal import SIGINT
+from signal import signal
+from time import perf_counter
 import cv2
-import matplotlib.pyplot as plt
 import numpy as np
+
+from cw.utils.cache import cache_key
+from cw.utils.cache import content_hash
+from cw.utils.decode import decode_image
+from cw.utils.decode import read_image
+from cw.utils.histogram import ColorHistogram
+from cw.utils.histogram import HISTOGRAM_BITS
+from cw.utils.iiif import fetch_image
+from cw.utils.iiif import is_image_service
+from cw.utils.iiif import is_uri
+from cw.utils.kmeans import mini_batch_k_means
+from cw.utils.kmeans import nearest
+from cw.utils.kmeans import split_worst
+from cw.utils.kmeans import weighted_k_means
+from cw.utils.lab import lab_to_bgr
+from cw.utils.lab import pixels_to_lab
+from cw.utils.lab import points_to_lab
+from cw.utils.metrics import NULL_METRICS
+from cw.utils.render import render_strip
+from cw.utils.render import section_widths
+from cw.utils.tiles import TILE_PIXELS
+from cw.utils.tiles import open_tiles
+from cw.utils.tiles import reblock
 #
 # Pass the path to an image to this script to visualize the dominant colors in
 # the image. See the viz() method for additional options.
@@ -9,30 +38,269 @@ import numpy as np
 
 CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 200, 1.0) # consider 1.0; may want lower?
 FLAGS = cv2.KMEANS_RANDOM_CENTERS
+ATTEMPTS = 10
+# Named trade-offs between speed and quality for the k-means runs: how many
+# attempts each k gets, when an attempt stops (cv2 criteria: type, maximum
+# iterations, epsilon) and how its starting centers are picked (cv2 flags).
+# 'exact' is CRITERIA, ATTEMPTS and FLAGS above, i.e. what we've always done,
+# and it's the default. See the README for what each costs and how far the
+# palettes move.
+PROFILES = {
+    'fast' : {
+        'attempts' : 1,
+        'criteria' : (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 20, 2.0),
+        'flags' : cv2.KMEANS_PP_CENTERS,
+    },
+    'balanced' : {
+        'attempts' : 3,
+        'criteria' : (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 100, 1.0),
+        'flags' : cv2.KMEANS_PP_CENTERS,
+    },
+    'exact' : {
+        'attempts' : ATTEMPTS,
+        'criteria' : CRITERIA,
+        'flags' : FLAGS,
+    },
+}
+PROFILE = 'exact'
 K_MAX = 12
+WORKERS = 1 # processes used for the K sweep in cluster_data
+MAX_PIXELS = None # analyze at most this many pixels; see decode.py
+# How cluster_data gets from k=1 to K_MAX: 'full' clusters each k from scratch;
+# 'incremental' seeds k+1 from the k solution (see _incremental_sweep)
+SWEEPS = ('full', 'incremental')
+# With adaptive=True the sweep stops as soon as the distortion curve has
+# flattened out: once adding a cluster has cut the distortion by less than
+# ELBOW_DROP (i.e. 20%) ELBOW_PATIENCE times in a row. The best k is then the
+# last one before that happened. See _adaptive_best_k.
+ELBOW_DROP = 0.2
+ELBOW_PATIENCE = 2
+# What k-means runs over: 'cv2' clusters every pixel with cv2.kmeans;
+# 'histogram' clusters the bins of a ColorHistogram, weighted by their pixel
+# counts, so the cost doesn't grow with the size of the image. See histogram.py
+# for how far that can move the palette. 'minibatch' is mini-batch k-means
+# (see kmeans.mini_batch_k_means) over row strips of the image, seeded from a
+# random sample of its pixels, so the float32 copy of the image is never made;
+# it's for images too big for cv2.kmeans to hold (in float32) and run several
+# times per k. It can't do the incremental sweep.
+ENGINES = ('cv2', 'histogram', 'minibatch')
+# For the minibatch engine: about how many pixels go in each strip, and how
+# many are sampled to seed the clustering
+CHUNK_PIXELS = 1 << 16
+SAMPLE_SIZE = 1 << 14
+# With tiled=True the image is read a strip of about tile_pixels pixels at a
+# time (see tiles.py) and never decoded whole: the histogram engine adds each
+# strip to its histogram, and the minibatch engine reads the strips again on
+# every pass (so the histogram engine is a lot faster here). Both give the
+# same results as they do in memory, as long as the strips decode to the same
+# pixels, i.e. for files, but not for IIIF services, whose tiles are
+# compressed on their own. The cv2 engine needs every pixel at once, so it
+# can't be tiled.
+TILED_ENGINES = ('histogram', 'minibatch')
+# The space colors are clustered in: 'bgr', as they are, or 'lab' (CIELAB; see
+# lab.py), where distances are much closer to how different colors look, so
+# relative volumes are closer to what people see. Centroids are converted back
+# to BGR for dominant_colors. The histogram engine converts its bins' means
+# rather than the pixels; we don't know the scatter within the bins in Lab, so
+# its compactness is just that of the bin means.
+COLOR_SPACES = ('bgr', 'lab')
+# Bump this when a change would make cached results (see cache.py) wrong
+CACHE_VERSION = 1
 DEBUG = False
 
+def k_means(pixels, k, profile=PROFILE):
+    # cv2.kmeans draws its random centers from OpenCV's global RNG. Seeding it
+    # with k means that a given k gets the same answer no matter which process
+    # runs it or what ran before it, so serial and parallel sweeps match.
+    cv2.setRNGSeed(k)
+    settings = PROFILES[profile]
+    # returns (compactness, labels, centroids)
+    return cv2.kmeans(pixels, k, None, settings['criteria'],
+        settings['attempts'], settings['flags'])
+
+def init_analysis_worker():
+    # The initializer for pools of processes that each analyze whole images
+    # (colorweight.py --jobs, batch_analyze.py, analysis_server.py...)
+    cv2.setNumThreads(1) # the pool is the parallelism; don't oversubscribe
+    # Ctrl-C goes to the whole process group; let the parent handle it
+    signal(SIGINT, SIG_IGN)
+
+# Pool workers map the pixels from shared memory once (in _init_worker) and
+# then only receive k for each task.
+_shared_pixels = None
+
+def _init_worker(shared, shape):
+    global _shared_pixels
+    cv2.setNumThreads(1) # the pool is the parallelism; don't oversubscribe
+    _shared_pixels = np.frombuffer(shared, dtype=np.float32).reshape(shape)
+
+def _k_means_worker(k, lean=False, profile=PROFILE):
+    # returns ((k, compactness, labels, centroids), counts, seconds); see
+    # ImageAnalyzer._entry
+    start = perf_counter()
+    compactness, labels, centroids = k_means(_shared_pixels, k, profile)
+    seconds = perf_counter() - start
+    if lean: # send back the counts rather than the (much bigger) labels
+        counts = np.bincount(labels.ravel(), minlength=k)
+        return (k, compactness, None, centroids), counts, seconds
+    return (k, compactness, labels, centroids), None, seconds
+
 class ImageAnalyzer(object):
-    def __init__(self, image_path):
+    def __init__(self, image_path, workers=WORKERS, sweep='full', engine='cv2',
+            histogram_bits=HISTOGRAM_BITS, max_pixels=MAX_PIXELS,
+            resample='area', lean=False, adaptive=False, image_bytes=None,
+            cache=None, metrics=None, tiled=False, tile_pixels=TILE_PIXELS,
+            profile=PROFILE, color_space='bgr'):
+        if sweep not in SWEEPS:
+            raise ValueError(f'sweep must be one of {SWEEPS !r}, not {sweep !r}')
+        if engine not in ENGINES:
+            raise ValueError(f'engine must be one of {ENGINES !r}, not {engine !r}')
+        if profile not in PROFILES:
+            raise ValueError(f'profile must be one of {tuple(PROFILES)!r}, not {profile !r}')
+        if color_space not in COLOR_SPACES:
+            raise ValueError(f'color_space must be one of {COLOR_SPACES !r}, not {color_space !r}')
+        if engine == 'minibatch' and sweep == 'incremental':
+            raise ValueError('the minibatch engine only does the full sweep')
+        if tiled and engine not in TILED_ENGINES:
+            raise ValueError(f'tiled input needs one of the engines {TILED_ENGINES !r}')
+        if tiled and max_pixels is not None:
+            raise ValueError('max_pixels does not apply to tiled input')
         self.image_path = image_path
+        self.workers = workers
+        self.sweep = sweep
+        self.engine = engine
+        self.profile = profile # see PROFILES
+        self.color_space = color_space
+        self.histogram_bits = histogram_bits
+        self.max_pixels = max_pixels
+        self.resample = resample
+        # In lean mode cluster_data keeps the pixel count of each cluster
+        # rather than the labels for every pixel (i.e. entries are
+        # (k, compactness, None, centroids), with counts in _counts[k]).
+        # See best_labels if you need the labels.
+        self.lean = lean
+        self.adaptive = adaptive
+        # The encoded image, if it's already in memory; image_path is then
+        # just its name. image_path can also be an HTTP(S) URI (see iiif.py),
+        # which is fetched into image_bytes when it's first needed.
+        self.image_bytes = image_bytes
+        # A cache.ResultCache, or None. With one, clustering results are
+        # looked up by the image's content and the parameters above before
+        # anything is clustered, and saved afterwards.
+        self.cache = cache
+        # A metrics.Metrics to record timings and such in; see metrics.py
+        self.metrics = metrics or NULL_METRICS
+        self.tiled = tiled
+        self.tile_pixels = tile_pixels
+        self._digest = None
+        self._tiles = None
         self._image_data = None
         self._pixels = None
+        self._sample = None
+        self._histogram = None
+        self._histogram_points = None
         self._cluster_data = []
+        self._counts = {}
         self._average_color = None
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def release(self):
+        # Drop the decoded image and the float32 (or Lab) copy of it.
+        # Clustering results are kept, so e.g. dominant_colors() still works
+        # without decoding the image again (as long as it doesn't need to
+        # cluster).
+        self._image_data = None
+        self._pixels = None
+        self._sample = None
+        if self._tiles is not None:
+            self._tiles.close()
+            self._tiles = None
+
     @property
     def image_data(self):
         if self._image_data is None:
-            self._image_data = cv2.imread(self.image_path)
+            self._fetch()
+            with self.metrics.stage('decode'):
+                if self.image_bytes is not None:
+                    self._image_data = decode_image(self.image_bytes,
+                        max_pixels=self.max_pixels, resample=self.resample)
+                else:
+                    self._image_data = read_image(self.image_path,
+                        max_pixels=self.max_pixels, resample=self.resample)
+            height, width = self._image_data.shape[:2]
+            self.metrics.record(width=width, height=height, pixels=width*height)
         return self._image_data
 
     @property
     def pixels(self):
+        # (N, 3) float32, in color_space
         if self._pixels is None:
-            arr = np.float32(self.image_data) # a 3d ndarray
-            self._pixels = arr.reshape((-1, 3))
+            image_data = self.image_data
+            stage = 'lab' if self.color_space == 'lab' else 'float32'
+            with self.metrics.stage(stage):
+                self._pixels = self._points(image_data)
         return self._pixels
 
+    @property
+    def tiles(self):
+        # Tiled mode: where the strips come from (see tiles.py). Opening it
+        # reads the image's header (or the service's info.json).
+        if self._tiles is None:
+            if not is_image_service(self.image_path):
+                self._fetch()
+            with self.metrics.stage('decode'):
+                self._tiles = open_tiles(self.image_path, self.image_bytes, self.tile_pixels)
+            width, height = self._tiles.width, self._tiles.height
+            self.metrics.record(width=width, height=height, pixels=width*height)
+        return self._tiles
+
+    @property
+    def sample(self):
+        # For the minibatch engine: SAMPLE_SIZE pixels (or all of them, if
+        # there are fewer) picked at random, but the same ones every time, as
+        # (n, 3) float32
+        if self._sample is None:
+            if self.tiled:
+                n_pixels = self.tiles.width * self.tiles.height
+            else:
+                flat = self.image_data.reshape((-1, 3))
+                n_pixels = len(flat)
+            rng = np.random.default_rng(0)
+            picked = np.sort(rng.choice(n_pixels, min(SAMPLE_SIZE, n_pixels), replace=False))
+            if self.tiled: # pick them out of each strip as it goes by
+                parts = []
+                start = 0
+                for strip in self._strips():
+                    flat = strip.reshape((-1, 3))
+                    first, last = np.searchsorted(picked, [start, start + len(flat)])
+                    parts.append(flat[picked[first:last] - start])
+                    start += len(flat)
+                self._sample = self._points(np.concatenate(parts))
+            else:
+                self._sample = self._points(flat[picked])
+        return self._sample
+
+    @property
+    def histogram(self):
+        if self._histogram is None and self.tiled:
+            histogram = ColorHistogram(self.histogram_bits)
+            for strip in self._strips():
+                with self.metrics.stage('histogram'):
+                    histogram.add(strip)
+            self._histogram = histogram
+            self.metrics.record(bins=len(self._histogram.occupied))
+        elif self._histogram is None:
+            image_data = self.image_data
+            with self.metrics.stage('histogram'):
+                self._histogram = ColorHistogram(self.histogram_bits).add(image_data)
+            self.metrics.record(bins=len(self._histogram.occupied))
+        return self._histogram
+
     @property
     def average_color(self):
         # useless
@@ -43,35 +311,72 @@ class ImageAnalyzer(object):
 
     @property
     def cluster_data(self):
-        # TODO: Use multiprocessing!
-        # https://www.linuxjournal.com/content/multiprocessing-python
-        # runs through the image K_MAX times...can take a while!
-        if not self._cluster_data:
-            for k in range(1, K_MAX+1):
-                compactness, labels, centroids = self._k_means(k)
-                self._cluster_data.append((k, compactness, labels, centroids))
+        # runs through the image K_MAX times...can take a while! With more
+        # than one worker the k values are spread across a process pool. In
+        # adaptive mode we stop early, as soon as the elbow is clear.
+        if not self._cluster_data and not self._load_sweep():
+            self._clustered_points() # so that the sweep's time is just the sweep
+            if self.sweep == 'incremental':
+                sweep = self._incremental_sweep()
+            elif self.workers > 1 and self.engine == 'cv2':
+                sweep = self._parallel_sweep()
+            else:
+                sweep = (self._entry(k, *self._k_means(k)) for k in range(1, K_MAX+1))
+            with self.metrics.stage('sweep'):
+                for entry in sweep:
+                    self._cluster_data.append(entry)
+                    if self.adaptive and self._adaptive_best_k(self._cluster_data):
+                        sweep.close()
+                        break
+            self._save([(e, self._entry_counts(e)) for e in self._cluster_data])
         return self._cluster_data
 
+    @property
+    def evaluated_ks(self):
+        # The k values that were actually clustered, which in adaptive mode can
+        # be fewer than 1..K_MAX
+        return [e[0] for e in self.cluster_data]
+
+    @property
+    def best_labels(self):
+        # The labels for the best k. In lean mode these aren't kept from the
+        # sweep, so they're worked out (once) by assigning every point to the
+        # nearest of that k's centroids, which is what k-means converged on.
+        best_k = self._find_best_k()
+        index = [e[0] for e in self.cluster_data].index(best_k)
+        k, compactness, labels, centroids = self.cluster_data[index]
+        if labels is None and self.engine == 'minibatch':
+            labels = np.concatenate([nearest(chunk, centroids)[0]
+                for chunk in self._chunks()])
+            self._cluster_data[index] = (k, compactness, labels, centroids)
+        elif labels is None:
+            points, _ = self._clustered_points()
+            labels, _ = nearest(points, centroids)
+            self._cluster_data[index] = (k, compactness, labels, centroids)
+        return labels
+
     def dominant_colors(self, n_colors=None):
         # See: https://docs.opencv.org/3.4.2/d1/d5c/tutorial_py_kmeans_opencv.html
         if n_colors is None:
-            n_colors, _, labels, centroids = self._best_k_means_from_cluster_data()
+            entry = self._best_k_means_from_cluster_data()
+            centroids, counts = entry[3], self._entry_counts(entry)
         else:
-            _, labels, centroids = self._k_means(n_colors)
+            centroids, counts = self._fixed_k(n_colors)
 
         # "Labels will have the same size as that of test data where each data
         # will be labelled as '0','1','2' etc. depending on their centroids."
         # i.e. "labels" are indicies of centroids, and in our case the centroids
         # are colors expressed as [B,G,R].
 
-        # How often does each unique label occur?
-        #    returns (array(labels), array(frequency))
-        label_freq = np.unique(labels, return_counts=True)
-        # Zip the two arrays above into a list: [(label, freq),]
-        label_freq_pairs = zip(label_freq[0], label_freq[1])
+        # How many pixels went to each label? (skipping any that are empty)
+        #    gives a list: [(label, freq),]
+        label_freq_pairs = [(label, freq) for label, freq
+            in enumerate(counts) if freq > 0]
         # Sort the pairs by frequency, descending
         freq_sorted = sorted(label_freq_pairs, key=lambda t: t[1], reverse=True)
         # Convert the members of the centroids to ints
+        if self.color_space == 'lab':
+            centroids = lab_to_bgr(centroids)
         palette = np.uint8(centroids)
         # Replace the labels with the value from the palette/centroids
         # giving us: [([B,G,R], freq), ([B,G,R], freq), ...]
@@ -80,18 +385,24 @@ class ImageAnalyzer(object):
 
     def viz(self, n_colors=None, height=100, width=400, weighted=True, debug=DEBUG):
         # See: https://stackoverflow.com/a/12890573/714478
+        # The strip is drawn by render.py; weighted, each color is as wide as
+        # its share of the pixels, otherwise they're all the same width.
         colors = self.dominant_colors(n_colors)
-        image = np.zeros((height, width, 3), np.uint8)
-        if weighted:
-            pixels = ImageAnalyzer._viz_weighted(image, colors, width, debug)
-        else:
-            pixels = ImageAnalyzer._viz_unweighted(image, colors, width, debug)
-        return pixels
+        with self.metrics.stage('viz'):
+            image = render_strip(colors, width, height, weighted)
+        if debug:
+            widths = section_widths([c[1] for c in colors], width, weighted)
+            offset = 0
+            for (bgr, _), section_width in zip(colors, widths):
+                print(f'BGR: {bgr}, Offset: {offset}, Section Width: {section_width}')
+                offset += section_width
+        return image
 
     def dominant_colors_list(self, n_colors=None):
         return self._dominant_colors_list(n_colors=n_colors)
 
     def show_histogram(self):
+        import matplotlib.pyplot as plt # slow, and only needed here and in show_elbow
         color = ('b','g','r')
         for i,col in enumerate(color):
             histr = cv2.calcHist([self.image_data],[i],None,[256],[0,256])
@@ -104,6 +415,7 @@ class ImageAnalyzer(object):
         return list(filter(lambda d: d[0] == best_k, self.cluster_data))[0]
 
     def show_elbow(self):
+        import matplotlib.pyplot as plt
         ks = [e[0] for e in self.cluster_data]
         dist = [e[1] for e in self.cluster_data]
         plt.plot(ks, dist, 'bo-')
@@ -120,11 +432,292 @@ class ImageAnalyzer(object):
         total_pixels = sum([t[1] for t in colors])
         return [ImageAnalyzer._format_color_for_json(c, total_pixels) for c in colors]
 
-    def _k_means(self, k):
-        # returns (compactness, labels, centroids)
-        return cv2.kmeans(self.pixels, k, None, CRITERIA, 10, FLAGS)
+    def _fixed_k(self, k):
+        # (centroids, counts) for exactly k colors. A full sweep clusters each
+        # k the same way we would here, so if we have its results (in memory
+        # or in the cache) we use them; otherwise we look in the cache before
+        # clustering.
+        if self.sweep == 'full' and (self._cluster_data or self._load_sweep()):
+            for entry in self._cluster_data:
+                if entry[0] == k:
+                    return entry[3], self._entry_counts(entry)
+        results = self._load(n_colors=k)
+        if results is None:
+            compactness, labels, centroids = self._k_means(k)
+            counts = self._entry_counts((k, compactness, labels, centroids))
+            results = [((k, compactness, None, centroids), counts)]
+            self._save(results, n_colors=k)
+        (_, _, _, centroids), counts = results[0]
+        return centroids, counts
+
+    def _k_means(self, k, seeds=None):
+        # returns (compactness, labels, centroids). With seeds (k centroids)
+        # this is a single attempt starting from them instead of the profile's
+        # attempts. For the histogram engine the labels are per bin
+        # rather than per pixel; see _label_counts. The minibatch engine
+        # doesn't label the pixels at all: labels is None and the counts are
+        # put in _counts[k]. Each call is recorded in metrics (cv2.kmeans
+        # doesn't say how many iterations it ran).
+        settings = PROFILES[self.profile]
+        criteria, flags = settings['criteria'], settings['flags']
+        if self.engine == 'histogram':
+            points, weights = self._clustered_points()
+            attempts = settings['attempts'] if seeds is None else 1
+            info = {}
+            start = perf_counter()
+            compactness, labels, centroids = weighted_k_means(points, weights,
+                k, criteria, attempts, flags, seed=k, centers=seeds, info=info)
+            if self.color_space == 'bgr':
+                compactness += self.histogram.scatter
+            self.metrics.record_k(k, perf_counter() - start, compactness,
+                info['iterations'])
+            return compactness, labels, centroids
+        if self.engine == 'minibatch':
+            info = {}
+            start = perf_counter()
+            compactness, counts, centroids = mini_batch_k_means(self._chunks,
+                self.sample, k, criteria, settings['attempts'], flags, seed=k,
+                info=info)
+            self._counts[k] = counts
+            self.metrics.record_k(k, perf_counter() - start, compactness,
+                info['iterations'])
+            return compactness, None, centroids
+        pixels = self.pixels
+        start = perf_counter()
+        if seeds is None:
+            result = k_means(pixels, k, self.profile)
+        else:
+            labels, _ = nearest(pixels, seeds)
+            result = cv2.kmeans(pixels, k, labels, criteria, 1,
+                cv2.KMEANS_USE_INITIAL_LABELS)
+        self.metrics.record_k(k, perf_counter() - start, result[0])
+        return result
+
+    def _clustered_points(self):
+        # returns (points, weights): whatever the engine runs k-means over
+        # (for the minibatch engine that's only the sample it starts from;
+        # see _chunks)
+        if self.engine == 'histogram':
+            if self._histogram_points is None:
+                points = self.histogram.points
+                if self.color_space == 'lab':
+                    with self.metrics.stage('lab'):
+                        points = points_to_lab(points)
+                self._histogram_points = points
+            return self._histogram_points, self.histogram.weights
+        if self.engine == 'minibatch':
+            return self.sample, None
+        return self.pixels, None
+
+    def _points(self, pixels):
+        # uint8 BGR pixels, (..., 3), as (N, 3) float32 in color_space
+        if self.color_space == 'lab':
+            return pixels_to_lab(pixels)
+        return np.float32(pixels).reshape((-1, 3))
+
+    def _chunks(self):
+        # For the minibatch engine: the pixels as (n, 3) float32 strips of
+        # whole rows (see _points), about CHUNK_PIXELS at a time, so that only
+        # one strip is ever converted at once. (The same strips in tiled mode.)
+        if self.tiled:
+            rows = max(1, CHUNK_PIXELS // self.tiles.width)
+            strips = reblock(self._strips(), rows * self.tiles.width)
+        else:
+            image_data = self.image_data
+            height, width = image_data.shape[:2]
+            rows = max(1, CHUNK_PIXELS // width)
+            strips = (image_data[top:top+rows] for top in range(0, height, rows))
+        for strip in strips:
+            yield self._points(strip)
+
+    def _strips(self):
+        # Tiled mode: the image top to bottom, a strip at a time. Reading each
+        # strip (and for IIIF, fetching it) counts as decoding.
+        strips = self.tiles.strips()
+        while True:
+            with self.metrics.stage('decode'):
+                strip = next(strips, None)
+            if strip is None:
+                return
+            yield strip
+
+    def _label_counts(self, labels):
+        # The number of pixels that went to each label
+        _, weights = self._clustered_points()
+        return np.bincount(labels.ravel(), weights=weights).astype(np.int64)
+
+    def _entry_counts(self, entry):
+        # The pixel count of each cluster in a cluster_data entry
+        k, _, labels, _ = entry
+        return self._counts[k] if labels is None else self._label_counts(labels)
+
+    def _fetch(self):
+        # Download image_path into image_bytes if it's a URI (see iiif.py)
+        if self.image_bytes is None and is_uri(self.image_path):
+            with self.metrics.stage('fetch'):
+                self.image_bytes = fetch_image(self.image_path, max_pixels=self.max_pixels)
+
+    def _cache_key(self, n_colors=None):
+        # Everything that the results depend on. For a given n_colors that's
+        # not how (or whether) we sweep.
+        if self._digest is None and self.tiled and self.image_bytes is None \
+                and is_image_service(self.image_path):
+            # We never download the whole image, so go by the service's
+            # description of it
+            info = dumps(self.tiles.info, sort_keys=True).encode()
+            with self.metrics.stage('hash'):
+                self._digest = content_hash(info)
+        if self._digest is None:
+            self._fetch()
+            with self.metrics.stage('hash'):
+                if self.image_bytes is not None:
+                    self._digest = content_hash(self.image_bytes)
+                else:
+                    self._digest = content_hash(path=self.image_path)
+        params = {
+            'version' : CACHE_VERSION,
+            'engine' : self.engine,
+            'histogram_bits' : self.histogram_bits,
+            'max_pixels' : self.max_pixels,
+            'resample' : self.resample,
+            'criteria' : list(PROFILES[self.profile]['criteria']),
+            'flags' : PROFILES[self.profile]['flags'],
+            'attempts' : PROFILES[self.profile]['attempts'],
+            'n_colors' : n_colors,
+        }
+        if n_colors is None:
+            params['sweep'] = self.sweep
+            params['k_max'] = K_MAX
+            params['adaptive'] = [ELBOW_DROP, ELBOW_PATIENCE] if self.adaptive else False
+        if self.color_space != 'bgr': # so that existing BGR records still match
+            params['color_space'] = self.color_space
+        return cache_key(self._digest, params)
+
+    def _load(self, n_colors=None):
+        # Returns [((k, compactness, None, centroids), counts), ...] from the
+        # cache, or None. See _save.
+        if self.cache is None:
+            return None
+        key = self._cache_key(n_colors)
+        with self.metrics.stage('cache'):
+            record = self.cache.get(key)
+        self.metrics.record(cache='miss' if record is None else 'hit')
+        if record is None:
+            return None
+        results = []
+        start = 0
+        for k, compactness, size in zip(record['ks'], record['compactness'], record['sizes']):
+            stop = start + size
+            entry = (int(k), float(compactness), None, record['centroids'][start:stop])
+            results.append((entry, record['counts'][start:stop]))
+            start = stop
+        return results
+
+    def _save(self, results, n_colors=None):
+        # results are as _load returns them (labels aren't kept)
+        if self.cache is None:
+            return
+        entries = [r[0] for r in results]
+        key = self._cache_key(n_colors)
+        with self.metrics.stage('cache'):
+            self.cache.put(key, {
+                'ks' : np.int64([e[0] for e in entries]),
+                'compactness' : np.float64([e[1] for e in entries]),
+                'sizes' : np.int64([len(e[3]) for e in entries]),
+                'centroids' : np.vstack([np.float32(e[3]).reshape((-1, 3)) for e in entries]),
+                'counts' : np.concatenate([np.int64(r[1]) for r in results]),
+            })
+
+    def _load_sweep(self):
+        # Fills in cluster_data from the cache, if it's there
+        results = self._load()
+        if results is None:
+            return False
+        for entry, counts in results:
+            self._counts[entry[0]] = counts
+            self._cluster_data.append(entry)
+        return True
+
+    def _entry(self, k, compactness, labels, centroids):
+        # A cluster_data entry; in lean mode the labels are swapped for counts
+        # (the minibatch engine never has labels here)
+        if self.lean and labels is not None:
+            self._counts[k] = self._label_counts(labels)
+            labels = None
+        return (k, compactness, labels, centroids)
+
+    def _parallel_sweep(self):
+        # Copy the pixels once into shared memory that every worker maps,
+        # rather than pickling them along with each k.
+        shape = self.pixels.shape
+        shared = RawArray('f', self.pixels.size)
+        np.frombuffer(shared, dtype=np.float32)[:] = self.pixels.ravel()
+        n_workers = min(self.workers, K_MAX)
+        # In adaptive mode, go one round of k values (one per worker) at a
+        # time so that we can stop after any of them
+        batch_size = n_workers if self.adaptive else K_MAX
+        worker = partial(_k_means_worker, lean=self.lean, profile=self.profile)
+        with ProcessPoolExecutor(n_workers, initializer=_init_worker,
+                initargs=(shared, shape)) as pool:
+            for first in range(1, K_MAX+1, batch_size):
+                # Bigger k values take longer, so hand those out first.
+                ks = range(min(first+batch_size-1, K_MAX), first-1, -1)
+                results = list(pool.map(worker, ks))
+                for entry, counts, seconds in reversed(results):
+                    if counts is not None:
+                        self._counts[entry[0]] = counts
+                    self.metrics.record_k(entry[0], seconds, entry[1])
+                    yield entry
+
+    def _incremental_sweep(self):
+        # Rather than start every k from scratch with several random starts,
+        # seed k+1 with the k centroids plus one more from splitting the
+        # cluster with the highest distortion (see kmeans.split_worst), and
+        # refine that in a single attempt. k=1 starts from the mean, so the
+        # whole sweep costs about K_MAX clusterings instead of attempts *
+        # K_MAX. The distortion curve is not identical to the full
+        # sweep's, but its shape (and so _find_best_k) should be.
+        points, weights = self._clustered_points()
+        seeds = np.float32([np.average(points, axis=0, weights=weights)])
+        for k in range(1, K_MAX+1):
+            if k > 1:
+                with self.metrics.stage('split'):
+                    seeds = split_worst(points, labels, centroids, weights)
+            compactness, labels, centroids = self._k_means(k, seeds)
+            yield self._entry(k, compactness, labels, centroids)
+
+    @staticmethod
+    def _adaptive_best_k(cluster_data):
+        # The stopping rule for adaptive mode (see ELBOW_DROP): walk the
+        # distortion curve so far and return the last k before it flattened
+        # out, or None if it hasn't yet.
+        dist_curve = [e[1] for e in cluster_data]
+        flat = 0
+        for i in range(1, len(dist_curve)):
+            previous = dist_curve[i-1]
+            drop = (previous - dist_curve[i]) / previous if previous > 0 else 0
+            flat = flat + 1 if drop < ELBOW_DROP else 0
+            if flat == ELBOW_PATIENCE:
+                return cluster_data[i - ELBOW_PATIENCE][0]
+        return None
 
     def _find_best_k(self, debug=False):
+        self.cluster_data # sweep first, if need be, so that isn't timed here
+        with self.metrics.stage('find_best_k'):
+            best_k = self._elbow(debug)
+        self.metrics.record(best_k=int(best_k))
+        return best_k
+
+    def _elbow(self, debug=False):
+        if self.adaptive:
+            best_k = ImageAnalyzer._adaptive_best_k(self.cluster_data)
+            if best_k is not None:
+                if debug:
+                    print(f'Evaluated k: {self.evaluated_ks}')
+                    print(f'Best K: {best_k}')
+                return best_k
+            # else the curve never flattened out before K_MAX, so fall back to
+            # the line method below.
         # kd_data is [(k, dist, ...), (k, dist, ...), ...]
         # See: https://en.wikipedia.org/wiki/Vector_projection
         # and: https://stackoverflow.com/a/37121355/714478
@@ -135,7 +728,7 @@ class ImageAnalyzer(object):
         line_vec = all_coords[-1] - first_point
         line_vec_norm = line_vec / np.sqrt(np.sum(line_vec**2))
         vec_from_first = all_coords - first_point
-        scalar_prod = np.sum(vec_from_first * repmat(line_vec_norm, n_points, 1), axis=1)
+        scalar_prod = np.sum(vec_from_first * np.tile(line_vec_norm, (n_points, 1)), axis=1)
         vec_from_first_parallel = np.outer(scalar_prod, line_vec_norm)
         vec_to_line = vec_from_first - vec_from_first_parallel
         dist_to_line = np.sqrt(np.sum(vec_to_line ** 2, axis=1))
@@ -171,33 +764,6 @@ class ImageAnalyzer(object):
         cv2.waitKey(0)
         cv2.destroyAllWindows()
 
-    @staticmethod
-    def _viz_weighted(image, colors, width, debug=DEBUG):
-        total_pixels = sum([t[1] for t in colors])
-        offset = 0
-        for i in range(len(colors)):
-            if i == len(colors)-1:
-                # Hack because we can be off (by 1, more?) in the last pass
-                # because fractions and pixels...
-                section_width = width - offset
-            else:
-                section_width = int(colors[i][1] / total_pixels * width)
-            if debug:
-                print(f'BGR: {colors[i][0]}, Offset: {section_width}, Section Width: {offest}')
-            image[:, offset:width] = colors[i][0]
-            offset = offset + section_width
-        return image
-
-    @staticmethod
-    def _viz_unweighted(image, colors, width, debug=DEBUG):
-        section_width = 1/len(colors)
-        for i in range(len(colors)):
-            offset = int(i*section_width*width)
-            if debug:
-                print(f'BGR: {colors[i][0]}, Offset: {offset}')
-            image[:, offset:width] = colors[i][0]
-        return image
-
 if __name__ == '__main__':
 #     from cv2 import imwrite
     image_path = '/Users/jstroop/workspace/colorweight/samples/01_in.jpg'
@@ -9,14 +9,24 @@ from argparse import Action
 from argparse import ArgumentError
 from argparse import ArgumentParser
 from argparse import SUPPRESS
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+from contextlib import nullcontext
 from cv2 import imwrite
 from errno import EACCES
+from glob import glob
+from glob import has_magic
 from json import dumps
 from os.path import abspath
 from os.path import dirname
 from os.path import isdir
+from os.path import isfile
 from os.path import realpath
+from sys import exit
 from sys import path
+from sys import stderr
+from sys import stdin
 from sys import stdout
 from tempfile import TemporaryFile
 
@@ -25,8 +35,22 @@ from tempfile import TemporaryFile
 # Nice writeup:
 # https://chrisyeh96.github.io/2017/08/08/definitive-guide-python-imports.html#case-2-syspath-could-change
 path.append(abspath(dirname(dirname(dirname(realpath(__file__))))))
+from cw.utils.cache import CACHE_DIR
+from cw.utils.cache import ResultCache
+from cw.utils.color_analysis import COLOR_SPACES
+from cw.utils.color_analysis import ENGINES
 from cw.utils.color_analysis import ImageAnalyzer
 from cw.utils.color_analysis import K_MAX
+from cw.utils.color_analysis import MAX_PIXELS
+from cw.utils.color_analysis import PROFILE
+from cw.utils.color_analysis import PROFILES
+from cw.utils.color_analysis import SWEEPS
+from cw.utils.color_analysis import TILED_ENGINES
+from cw.utils.color_analysis import WORKERS
+from cw.utils.color_analysis import init_analysis_worker
+from cw.utils.decode import RESAMPLES
+from cw.utils.metrics import Metrics
+from cw.utils.tiles import TILE_PIXELS
 
 
 DESCRIPTION='A simple command line utility for analyzing images by their color.'
@@ -39,7 +63,11 @@ FORMAT_CHOICES = ['png', 'json']
 HELP = {
     'image' : """The path to an image on the file system or an HTTP(S) URI.
 If the arguement is a URI and does not appear to resolve to an image (by file
-extension), an IIIF Image API service is assumed.""",
+extension), an IIIF Image API service is assumed. With --max-pixels, the
+smallest size of the image that has that many pixels is requested from the
+service. Give more than one image, a glob pattern (quoted), or '-' to read
+images from stdin one per line, and they are all analyzed in this process (see
+--jobs), with a line of JSON written for each as soon as it's done.""",
 
     'output' : """The path for the output file. The format will be determined
 by the file extenstion. '.json' or '.png' are supported.""",
@@ -54,9 +82,81 @@ by the file extenstion. '.json' or '.png' are supported.""",
 three colors. If this number is not provided, numbers 1-{K_MAX} will be tried
 in order to determine an optimal number. This number of colors will be reported.
 This can take a long time.
-"""
+""",
+
+    'workers' : f"""The number of processes to use when trying numbers of colors
+(i.e. when --colors is not provided). The result is the same regardless of the
+number of workers. (default: {WORKERS})""",
+
+    'jobs' : """With more than one image, the number of processes analyzing
+images at once. With more than one job, --workers is ignored. Results are
+written in the order they finish. (default: 1)""",
+
+    'sweep' : """How to try numbers of colors when --colors is not provided.
+'full' (default) clusters each number from scratch; 'incremental' starts each
+number from the previous result, which is much faster and usually picks the
+same number of colors.""",
+
+    'adaptive' : f"""When trying numbers of colors, stop as soon as adding
+another color stops making much difference, rather than always trying 1-{K_MAX}.
+The number of colors reported can differ from a full sweep.""",
+
+    'engine' : """What to cluster. 'cv2' (default) clusters every pixel;
+'histogram' clusters a compact color histogram of the image, which takes about
+the same time regardless of the image size and gives nearly the same colors;
+'minibatch' clusters the pixels a strip at a time, for images too big to cluster
+all at once (not with --sweep incremental).""",
+
+    'profile' : """How hard to try when clustering: 'fast' makes one attempt
+per number of colors, with k-means++ starting colors and looser stopping rules;
+'balanced' makes three; 'exact' (default) makes ten from random starting colors,
+as colorweight always has. See the README for what each costs and how much the
+colors change.""",
+
+    'color_space' : """Where to cluster: 'bgr' (default) measures how different
+two colors are in plain RGB values; 'lab' converts to CIELAB first, where the
+distance between two colors is much closer to how different they look, so
+palettes separate colors the eye separates. Costs a conversion of every pixel
+(or histogram bin) before clustering.""",
+
+    'max_pixels' : """Analyze at most this many pixels. Larger images are
+decoded at reduced size where possible (JPEG) and resampled the rest of the way
+(see --resample). The default is to use every pixel.""",
+
+    'resample' : """How to bring images down to --max-pixels: 'area' (default)
+averages blocks of pixels; 'stratified' keeps a random pixel from each block.""",
+
+    'tiled' : """Read the image a strip at a time rather than decoding all of
+it, for images too big for memory: TIFFs and PNGs are read in strips, and IIIF
+image services are asked for their tiles, a few at a time. Needs --engine
+histogram or minibatch, and can't be used with --max-pixels.""",
+
+    'tile_pixels' : f"""With --tiled, read about this many pixels at a time (or
+one of the file's strips or the service's tiles, if that's bigger), which is
+what bounds the memory used. (default: {TILE_PIXELS})""",
+
+    'cache' : f"""Cache results in this directory (e.g. {CACHE_DIR}), so that
+analyzing the same image the same way again (e.g. for a different --geometry or
+--colors) doesn't have to cluster it again. (default: don't cache)""",
+
+    'metrics' : """Append a line of JSON to this file ('-' for stderr) with how
+long each stage of the analysis took, the distortion of each number of colors
+tried, and so on (see metrics.py).""",
 }
 
+def analyze_image(image_path, options, n_colors=None, metrics=False):
+    # For multi-image mode (see ColorWeightCLI.execute_many); may run in a
+    # pool worker. Returns ({'image' : ..., 'colors' : [...]}, or 'error'
+    # instead of 'colors' if it failed, and Metrics.to_dict() or None).
+    m = Metrics(image=image_path) if metrics else None
+    result = {'image' : image_path}
+    try:
+        with ImageAnalyzer(image_path, lean=True, metrics=m, **options) as ia:
+            result['colors'] = ia.dominant_colors_list(n_colors=n_colors)
+    except Exception as e:
+        result['error'] = repr(e)
+    return result, (m.to_dict() if metrics else None)
+
 class GeometryAction(Action):
     'Parse the WxH geometry into width and height'
     DEFAULT = f'{DEFAULT_WIDTH}x{DEFAULT_HEIGHT}'
@@ -113,7 +213,7 @@ class ColorWeightCLI(object):
     def __init__(self):
         parser = ArgumentParser(description=DESCRIPTION, prog=__file__)
         # Positional
-        parser.add_argument('image', type=str, help=HELP['image'])
+        parser.add_argument('images', nargs='+', metavar='image', help=HELP['image'])
 
         # Optional, mutually exclusive:
         group = parser.add_mutually_exclusive_group()
@@ -132,6 +232,19 @@ class ColorWeightCLI(object):
         # Optional
         parser.add_argument('-g', '--geometry', action=GeometryAction)
         parser.add_argument('-c', '--colors', metavar='NUMBER', dest='n_colors', type=int, default=None, help=HELP['colors'])
+        parser.add_argument('-w', '--workers', metavar='NUMBER', type=int, default=WORKERS, help=HELP['workers'])
+        parser.add_argument('-j', '--jobs', metavar='NUMBER', type=int, default=1, help=HELP['jobs'])
+        parser.add_argument('-s', '--sweep', default='full', choices=SWEEPS, help=HELP['sweep'])
+        parser.add_argument('-a', '--adaptive', action='store_true', default=False, help=HELP['adaptive'])
+        parser.add_argument('-e', '--engine', default='cv2', choices=ENGINES, help=HELP['engine'])
+        parser.add_argument('-p', '--profile', default=PROFILE, choices=PROFILES, help=HELP['profile'])
+        parser.add_argument('--color-space', default='bgr', choices=COLOR_SPACES, help=HELP['color_space'])
+        parser.add_argument('-m', '--max-pixels', metavar='NUMBER', type=int, default=MAX_PIXELS, help=HELP['max_pixels'])
+        parser.add_argument('--resample', default='area', choices=RESAMPLES, help=HELP['resample'])
+        parser.add_argument('-t', '--tiled', action='store_true', default=False, help=HELP['tiled'])
+        parser.add_argument('--tile-pixels', metavar='NUMBER', type=int, default=TILE_PIXELS, help=HELP['tile_pixels'])
+        parser.add_argument('--cache', metavar='DIR', default=None, help=HELP['cache'])
+        parser.add_argument('--metrics', metavar='PATH', default=None, help=HELP['metrics'])
 
         args = parser.parse_args()
         del args.geometry # use args.width and args.height going forward
@@ -139,30 +252,143 @@ class ColorWeightCLI(object):
         if args.debug:
             print(f'[DEBUG] raw args: {args}')
 
+        # More than one image (or maybe more than one) means NDJSON out
+        self.many = len(args.images) > 1 or any(i == '-' or has_magic(i)
+            for i in args.images)
+        if self.many and args.format == 'png':
+            parser.error('png output is for one image at a time')
+        if args.engine == 'minibatch' and args.sweep == 'incremental':
+            parser.error('--engine minibatch only does --sweep full')
+        if args.tiled and args.engine not in TILED_ENGINES:
+            parser.error('--tiled needs --engine histogram or minibatch')
+        if args.tiled and args.max_pixels is not None:
+            parser.error("--tiled can't be used with --max-pixels")
+
         self.args = args
 
     def execute(self):
-        analyzer = ImageAnalyzer(self.args.image)
+        # Returns the number of images that failed (only in multi-image mode;
+        # otherwise failures raise)
+        if self.many:
+            return self.execute_many()
+        image = self.args.images[0]
+        metrics = None
+        if self.args.metrics is not None:
+            metrics = Metrics(image=image)
+        analyzer = ImageAnalyzer(image, metrics=metrics, **self._options())
         # Args is an argparse.Namespace object. E.g.:
-        # Namespace(debug=True, format='json', height=100, image='foo.png',
+        # Namespace(debug=True, format='json', height=100, images=['foo.png'],
         #    n_colors=5, output=None, width=400)
         if self.args.format == 'json':
             outstream = stdout
             if self.args.output is not None:
                 outstream = open(self.args.output, 'w')
             data = analyzer.dominant_colors_list(n_colors=self.args.n_colors)
-            json_s = dumps(data, indent=2, sort_keys=True)
-            print(json_s, file=outstream)
+            with analyzer.metrics.stage('serialize'):
+                json_s = dumps(data, indent=2, sort_keys=True)
+            with analyzer.metrics.stage('write'):
+                print(json_s, file=outstream)
         else:
             image_data = analyzer.viz(n_colors=self.args.n_colors,
                 height=self.args.height, width=self.args.width)
-            if self.args.output is not None:
-                imwrite(self.args.output, image_data)
-            else: # Probably useless, but keeps the API easy :-)
-                print(image_data.tostring())
+            with analyzer.metrics.stage('write'):
+                if self.args.output is not None:
+                    imwrite(self.args.output, image_data)
+                else: # Probably useless, but keeps the API easy :-)
+                    print(image_data.tostring())
 
         # JSON or Image?
+        if metrics is not None:
+            with self._open_metrics() as f:
+                print(metrics.to_json(), file=f)
+        return 0
+
+    def execute_many(self):
+        # One line of JSON per image, written as each is finished, so this can
+        # sit in a pipeline. Images that fail get an 'error' instead of
+        # 'colors' and don't stop the rest.
+        options = self._options()
+        if self.args.jobs > 1:
+            options['workers'] = 1 # the jobs are the parallelism
+        want_metrics = self.args.metrics is not None
+        outstream = nullcontext(stdout)
+        if self.args.output is not None:
+            outstream = open(self.args.output, 'w')
+        failed = 0
+        with outstream as out, self._open_metrics() as metrics_file:
+            for result, metrics in self._results(options, want_metrics):
+                print(dumps(result, sort_keys=True), file=out, flush=True)
+                if metrics is not None:
+                    print(dumps(metrics, sort_keys=True), file=metrics_file, flush=True)
+                failed += 'error' in result
+        return failed
+
+    def _results(self, options, metrics):
+        # Yields analyze_image's results, in the order they finish
+        images = self._expand_images()
+        n_colors = self.args.n_colors
+        if self.args.jobs == 1: # no pool to start, or send images to
+            for image in images:
+                yield analyze_image(image, options, n_colors, metrics)
+            return
+        pending = set()
+        with ProcessPoolExecutor(self.args.jobs, initializer=init_analysis_worker) as pool:
+            try:
+                while True:
+                    for image in images:
+                        pending.add(pool.submit(analyze_image, image, options,
+                            n_colors, metrics))
+                        if len(pending) >= 2 * self.args.jobs:
+                            break
+                    if not pending:
+                        break
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        yield future.result()
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def _expand_images(self):
+        # Yields the images: globs are expanded, and '-' is replaced with the
+        # lines of stdin (read as they come)
+        for image in self.args.images:
+            if image == '-':
+                for line in stdin:
+                    if line.strip():
+                        yield line.strip()
+            elif has_magic(image):
+                yield from sorted(filter(isfile, glob(image, recursive=True)))
+            else:
+                yield image
+
+    def _options(self):
+        # ImageAnalyzer's keyword arguments
+        return {
+            'workers' : self.args.workers,
+            'sweep' : self.args.sweep,
+            'engine' : self.args.engine,
+            'profile' : self.args.profile,
+            'color_space' : self.args.color_space,
+            'max_pixels' : self.args.max_pixels,
+            'resample' : self.args.resample,
+            'tiled' : self.args.tiled,
+            'tile_pixels' : self.args.tile_pixels,
+            'adaptive' : self.args.adaptive,
+            'cache' : None if self.args.cache is None else ResultCache(self.args.cache),
+        }
+
+    def _open_metrics(self):
+        # The --metrics file, as a context manager (stderr for '-')
+        if self.args.metrics is None:
+            return nullcontext()
+        if self.args.metrics == '-':
+            return nullcontext(stderr)
+        return open(self.args.metrics, 'a')
 
 if __name__ == '__main__':
     cli = ColorWeightCLI()
-    cli.execute()
+    try:
+        exit(1 if cli.execute() else 0)
+    except KeyboardInterrupt:
+        exit(130)
@@ -0,0 +1,117 @@
+from io import BytesIO
+from math import ceil
+from math import sqrt
+from struct import unpack
+import cv2
+import numpy as np
+#
+# Reading images for ./color_analysis.py, optionally cut down to a pixel budget.
+#
+# With max_pixels, JPEGs are decoded at 1/2, 1/4 or 1/8 scale by libjpeg
+# (cv2.IMREAD_REDUCED_COLOR_*) when that still leaves at least max_pixels, which
+# skips most of the decode work. Whatever is still over budget after that (and
+# everything that isn't a JPEG) is brought down to max_pixels by resampling:
+# 'area' averages blocks of pixels (cv2.INTER_AREA); 'stratified' keeps one
+# randomly chosen pixel from each block, so no new colors are mixed up.
+#
+# decode_image does the same for an encoded image that is already in memory
+# (e.g. one that was just downloaded), so it never has to be written to disk.
+#
+
+RESAMPLES = ('area', 'stratified')
+
+REDUCED_MODES = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+# Start Of Frame markers, which carry the dimensions. C4, C8 and CC are
+# something else (DHT, JPG and DAC)
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+def read_image(path, max_pixels=None, resample='area'):
+    with open(path, 'rb') as f:
+        size = jpeg_size(f)
+    flags = _reduced_mode(size, max_pixels)
+    image = cv2.imread(path, flags)
+    if image is None:
+        raise ValueError(f'{path} could not be read as an image')
+    return fit(image, max_pixels, resample)
+
+def decode_image(data, max_pixels=None, resample='area'):
+    size = jpeg_size(BytesIO(data))
+    flags = _reduced_mode(size, max_pixels)
+    image = cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+    if image is None:
+        raise ValueError('data could not be decoded as an image')
+    return fit(image, max_pixels, resample)
+
+def jpeg_size(f):
+    # Returns (width, height) from the header of the JPEG in file-like f, or
+    # None if f isn't a JPEG (or we can't tell).
+    if f.read(2) != b'\xff\xd8':
+        return None
+    while True:
+        byte = f.read(1)
+        while byte == b'\xff': # fill bytes before the marker
+            marker = f.read(1)
+            if marker != b'\xff':
+                break
+            byte = marker
+        else:
+            return None
+        if not marker or marker[0] in (0xD9, 0xDA): # end of image / scan
+            return None
+        length = f.read(2)
+        if len(length) < 2:
+            return None
+        length, = unpack('>H', length)
+        if marker[0] in SOF_MARKERS:
+            data = f.read(5)
+            if len(data) < 5:
+                return None
+            _, height, width = unpack('>BHH', data)
+            return (width, height)
+        f.seek(length - 2, 1)
+
+def fit(image, max_pixels=None, resample='area'):
+    # Cuts an image down to at most max_pixels (see above). Images that are
+    # already small enough come back as they are.
+    if resample not in RESAMPLES:
+        raise ValueError(f'resample must be one of {RESAMPLES !r}, not {resample !r}')
+    if image is None or max_pixels is None:
+        return image
+    height, width = image.shape[:2]
+    if height * width <= max_pixels:
+        return image
+    if resample == 'stratified':
+        return _stratified_sample(image, max_pixels)
+    scale = sqrt(max_pixels / (height * width))
+    size = (max(int(width * scale), 1), max(int(height * scale), 1))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+
+def _reduced_mode(size, max_pixels):
+    # The cv2.imread flag for the smallest JPEG reduction that still has at
+    # least max_pixels pixels
+    if size is not None and max_pixels is not None:
+        width, height = size
+        for factor, mode in REDUCED_MODES:
+            if ceil(width / factor) * ceil(height / factor) >= max_pixels:
+                return mode
+    return cv2.IMREAD_COLOR
+
+def _stratified_sample(image, max_pixels, seed=0):
+    # Divide the image into cell x cell blocks and take one pixel at random
+    # from each, so the sample covers the whole image evenly.
+    height, width = image.shape[:2]
+    cell = ceil(sqrt(height * width / max_pixels))
+    while ceil(height / cell) * ceil(width / cell) > max_pixels:
+        cell += 1
+    rng = np.random.default_rng(seed)
+    rows = np.arange(0, height, cell)[:, None]
+    cols = np.arange(0, width, cell)[None, :]
+    shape = (rows.shape[0], cols.shape[1])
+    rows = np.minimum(rows + rng.integers(0, cell, shape), height - 1)
+    cols = np.minimum(cols + rng.integers(0, cell, shape), width - 1)
+    return image[rows, cols]
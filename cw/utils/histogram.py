@@ -0,0 +1,82 @@
+import numpy as np
+#
+# A compact color histogram for the 'histogram' engine in ./color_analysis.py.
+#
+# Each channel is cut down to `bits` bits, so there are at most 2**(3*bits)
+# occupied bins (32,768 at the default of 5) no matter how many pixels go in.
+# For each bin we keep the pixel count and the per-channel sums, so a bin is
+# represented by the exact mean of its pixels, not the middle of the bin.
+#
+# How far can the palette drift from clustering the raw pixels? Because bins
+# carry their exact sums, the centroid of any set of bins is exactly the mean
+# of the pixels in them, so the only error is in the assignment: all of the
+# pixels in a bin go to the same cluster. A bin is w = 2**(8-bits) values wide
+# on each channel, so no pixel is more than r = sqrt(3)*(w-1) from its bin's
+# mean (12.1 at 5 bits, 5.2 at 6), and every pixel ends up assigned to a
+# centroid at most 2r further away than its nearest centroid. Only pixels
+# within r of a boundary between two clusters can land on the "wrong" side.
+# In practice palettes agree with the per-pixel result to within a few values
+# per channel; use 6 bits if that is not close enough.
+#
+
+HISTOGRAM_BITS = 5
+
+class ColorHistogram(object):
+    def __init__(self, bits=HISTOGRAM_BITS):
+        self.bits = bits
+        n_bins = 1 << (3 * bits)
+        self._counts = np.zeros(n_bins, np.int64)
+        self._sums = np.zeros((n_bins, 3), np.float64)
+        self._sum_of_squares = 0.0
+        self._occupied = None
+
+    def add(self, pixels):
+        # pixels is an (N, 3) uint8 array (or anything that reshapes to one,
+        # e.g. a whole BGR image). Can be called repeatedly, e.g. per tile.
+        pixels = np.asarray(pixels, np.uint8).reshape((-1, 3))
+        shift = 8 - self.bits
+        q = pixels >> shift
+        index = q[:, 0].astype(np.intp) << (2 * self.bits)
+        index |= q[:, 1].astype(np.intp) << self.bits
+        index |= q[:, 2]
+        n_bins = len(self._counts)
+        self._counts += np.bincount(index, minlength=n_bins)
+        for c in range(3):
+            channel = pixels[:, c].astype(np.float64)
+            self._sums[:, c] += np.bincount(index, weights=channel, minlength=n_bins)
+            self._sum_of_squares += float(np.dot(channel, channel))
+        self._occupied = None
+        return self
+
+    @property
+    def occupied(self):
+        if self._occupied is None:
+            self._occupied = np.flatnonzero(self._counts)
+        return self._occupied
+
+    @property
+    def points(self):
+        # (M, 3) float32 mean color of each occupied bin
+        occupied = self.occupied
+        means = self._sums[occupied] / self._counts[occupied, None]
+        return np.float32(means)
+
+    @property
+    def weights(self):
+        # (M,) pixel count of each occupied bin
+        return self._counts[self.occupied]
+
+    @property
+    def n_pixels(self):
+        return int(self._counts.sum())
+
+    @property
+    def scatter(self):
+        # Sum of squared distances from every pixel to the mean of its bin.
+        # Adding this to a clustering's distortion over the bins gives the
+        # distortion over the pixels, so compactness stays in the same units
+        # as cv2.kmeans.
+        occupied = self.occupied
+        sums = self._sums[occupied]
+        between = np.sum(sums**2 / self._counts[occupied, None])
+        return max(self._sum_of_squares - float(between), 0.0)
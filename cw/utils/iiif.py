@@ -0,0 +1,152 @@
+from math import ceil
+from math import floor
+from math import sqrt
+from re import search
+from urllib.parse import urlparse
+
+from cw.utils.image_fetch import TIMEOUT
+from cw.utils.image_fetch import pooled_session
+#
+# Reading images over HTTP(S) for ./color_analysis.py, including from IIIF
+# Image API (2.x and 3.x) services.
+#
+# A URI whose path ends in an image extension is fetched as it is. Anything
+# else is taken to be an image service: we read its info.json and ask for the
+# smallest derivative that still has at least max_pixels pixels, so that we
+# download and decode no more than the analysis will use. Servers that can
+# scale to any size (level 1 and up) are asked for exactly that (a 'w,'
+# request); level 0 servers are asked for the smallest of their pre-made
+# `sizes` that is big enough, or the full image if none are.
+#
+# For tiled analysis (see tiles.py) we instead ask for the image a region at a
+# time at full size: the service's own tiles if it lists any, or otherwise
+# (level 1 and up) regions of up to REGION_SIZE pixels square.
+#
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.tif', '.tiff', '.gif', '.webp', '.jp2', '.bmp')
+REGION_SIZE = 1024
+
+_session = None
+
+def is_uri(path):
+    return path.startswith(('http://', 'https://'))
+
+def is_image_service(uri):
+    # i.e. a URI that isn't just an image file
+    return is_uri(uri) and not urlparse(uri).path.lower().endswith(IMAGE_EXTENSIONS)
+
+def fetch_image(uri, max_pixels=None, session=None):
+    # Returns the bytes of the image at uri (see above)
+    session = session or _shared_session()
+    if is_image_service(uri):
+        info = fetch_info(uri, session)
+        uri = image_request(info, max_pixels)
+    r = session.get(uri, timeout=TIMEOUT)
+    r.raise_for_status()
+    return r.content
+
+def fetch_info(uri, session=None):
+    # uri is the service's base URI, or its info.json
+    session = session or _shared_session()
+    base = uri.rstrip('/')
+    if base.endswith('/info.json'):
+        base = base[:-len('/info.json')]
+    r = session.get(f'{base}/info.json', timeout=TIMEOUT)
+    r.raise_for_status()
+    return r.json()
+
+def image_request(info, max_pixels=None):
+    # The URI of the image to analyze, given the service's info.json
+    base = (info.get('id') or info['@id']).rstrip('/')
+    return f'{base}/full/{request_size(info, max_pixels)}/0/default.jpg'
+
+def fetch_region(info, x, y, w, h, session=None):
+    # Returns the bytes of a region of the image, at full size
+    session = session or _shared_session()
+    r = session.get(region_request(info, x, y, w, h), timeout=TIMEOUT)
+    r.raise_for_status()
+    return r.content
+
+def region_request(info, x, y, w, h):
+    base = (info.get('id') or info['@id']).rstrip('/')
+    full = 'max' if _version(info) == 3 else 'full'
+    return f'{base}/{x},{y},{w},{h}/{full}/0/default.jpg'
+
+def region_size(info):
+    # (width, height) of the regions to ask for a full size image in: the
+    # service's full size tiles, or REGION_SIZE squares (or less, if the
+    # service has limits) if it doesn't list any. None if it can only give us
+    # the whole image (level 0 without tiles).
+    for tile in info.get('tiles', []):
+        if 1 in tile.get('scaleFactors', [1]):
+            return tile['width'], tile.get('height', tile['width'])
+    if _level(info) < 1:
+        return None
+    w = h = REGION_SIZE
+    max_width, max_height, max_area = _limits(info)
+    if max_width:
+        w = min(w, max_width)
+    if max_height:
+        h = min(h, max_height)
+    if max_area and w * h > max_area:
+        w = h = floor(sqrt(max_area))
+    return w, h
+
+def request_size(info, max_pixels=None):
+    # The size parameter of the smallest derivative with at least max_pixels
+    # pixels (or the full image, if it has fewer than that)
+    version = _version(info)
+    full = 'max' if version == 3 else 'full'
+    width, height = info['width'], info['height']
+    if max_pixels is None or width * height <= max_pixels:
+        return full
+    if _level(info) >= 1:
+        scale = sqrt(max_pixels / (width * height))
+        w = min(ceil(width * scale), width)
+        max_width, max_height, max_area = _limits(info)
+        if max_width:
+            w = min(w, max_width)
+        if max_height:
+            w = min(w, floor(max_height * width / height))
+        if max_area:
+            w = min(w, floor(sqrt(max_area * width / height)))
+        return f'{w},'
+    sizes = [(s['width'], s['height']) for s in info.get('sizes', [])]
+    big_enough = [s for s in sizes if s[0] * s[1] >= max_pixels]
+    if not big_enough:
+        return full
+    w, h = min(big_enough, key=lambda s: s[0] * s[1])
+    # sizes have to be asked for exactly as listed: 'w,' in 2.x, 'w,h' in 3.x
+    return f'{w},{h}' if version == 3 else f'{w},'
+
+def _version(info):
+    context = info.get('@context', '')
+    if isinstance(context, list):
+        context = ' '.join(context)
+    return 3 if '/image/3/' in context or info.get('type') == 'ImageService3' else 2
+
+def _level(info):
+    # The compliance level, from e.g. 'level1' (3.x) or
+    # ['http://iiif.io/api/image/2/level1.json', {...}] (2.x)
+    profile = info.get('profile', '')
+    if isinstance(profile, list):
+        profile = next((p for p in profile if isinstance(p, str)), '')
+    match = search(r'level(\d)', profile)
+    return int(match.group(1)) if match else 0
+
+def _limits(info):
+    # (maxWidth, maxHeight, maxArea); these are at the top level in 3.x and in
+    # the profile in 2.x
+    limits = dict(info)
+    profile = info.get('profile')
+    if isinstance(profile, list):
+        for p in profile:
+            if isinstance(p, dict):
+                limits.update(p)
+    return limits.get('maxWidth'), limits.get('maxHeight'), limits.get('maxArea')
+
+def _shared_session():
+    global _session
+    if _session is None:
+        _session = pooled_session()
+    return _session
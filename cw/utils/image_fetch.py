@@ -3,48 +3,113 @@
 #
 # Grabs all of the thumbnails from an IIIF Collection.
 #
+# Thumbnails are downloaded `workers` at a time over one pooled session (so
+# connections to the image server are reused), and requests that fail to
+# connect or come back 429/5xx are retried `retries` times with exponential
+# backoff. Each file is streamed to a .part file that is renamed into place
+# once it's complete, so a file that exists is a whole one: those are skipped,
+# and an interrupted run can just be run again.
+#
 
+from concurrent.futures import ThreadPoolExecutor
 from os import makedirs
+from os import remove
+from os import replace
 from os.path import dirname
 from os.path import exists
 from os.path import join
 from os.path import realpath
-from requests import get
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+WORKERS = 8
+RETRIES = 5
+BACKOFF = 0.5 # seconds; doubles with each retry
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+TIMEOUT = (10, 60) # seconds to connect, and between bytes
+CHUNK_SIZE = 64 * 1024
+
+def pooled_session(workers=WORKERS, retries=RETRIES, backoff=BACKOFF):
+    # A Session that keeps up to `workers` connections per host open and
+    # retries as described above
+    retry = Retry(total=retries, backoff_factor=backoff,
+        status_forcelist=RETRY_STATUSES)
+    adapter = HTTPAdapter(pool_maxsize=workers, max_retries=retry)
+    session = Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 class ImageCollector(object):
 
-    def __init__(self, manifest_uri, iiif_params='/full/!800,800/0/default.jpg'):
+    def __init__(self, manifest_uri, iiif_params='/full/!800,800/0/default.jpg',
+            images_dir=None, workers=WORKERS, retries=RETRIES, backoff=BACKOFF):
         self.manifest_uri = manifest_uri
         self.iiif_params = iiif_params
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
         self._iiif_collection = None
-        self._images_dir = None
+        self._images_dir = images_dir
+        self._session = None
 
     @property
     def images_dir(self):
         if self._images_dir is None:
             self._images_dir = realpath(join(dirname(realpath(__file__)), '..', 'images', 'ga'))
-            makedirs(self._images_dir, exist_ok=True)
+        makedirs(self._images_dir, exist_ok=True)
         return self._images_dir
 
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = pooled_session(self.workers, self.retries, self.backoff)
+        return self._session
+
     @property
     def iiif_collection(self):
         if self._iiif_collection is None:
-            r = get(self.manifest_uri)
+            r = self.session.get(self.manifest_uri, timeout=TIMEOUT)
             r.raise_for_status()
             self._iiif_collection = IIIF_Collection(r.json())
         return self._iiif_collection
 
     def download_thumbnails(self):
-        i = 1
-        for thumbnail in image_collector.iiif_collection.thumbnail_data:
+        # Returns the URLs that couldn't be downloaded
+        images_dir = self.images_dir
+        todo = []
+        for name, url in self.thumbnail_urls():
+            path = join(images_dir, '{}.jpg'.format(name))
+            if not exists(path):
+                todo.append((url, path))
+        with ThreadPoolExecutor(self.workers) as pool:
+            results = pool.map(lambda job: self._download(*job), todo)
+            return [url for (url, _), ok in zip(todo, results) if not ok]
+
+    def thumbnail_urls(self):
+        # Yields (name, url) for each thumbnail, where name is its number in
+        # the collection (0001, 0002, ...)
+        for i, thumbnail in enumerate(self.iiif_collection.thumbnail_data, 1):
             url = '{}{}'.format(thumbnail[0], self.iiif_params)
-            name = '{}.jpg'.format(str(i).zfill(4))
-            i+=1
-            path = join(self.images_dir, name)
-            with open(path, 'wb') as f:
-                print('Saving {} to {}'.format(url, path))
-                r = get(url)
-                f.write(r.content)
+            yield str(i).zfill(4), url
+
+    def _download(self, url, path):
+        part_path = '{}.part'.format(path)
+        try:
+            with self.session.get(url, stream=True, timeout=TIMEOUT) as r:
+                r.raise_for_status()
+                with open(part_path, 'wb') as f:
+                    for chunk in r.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+            replace(part_path, path)
+        except Exception as e:
+            print('Failed to save {}: {!r}'.format(url, e))
+            if exists(part_path):
+                remove(part_path)
+            return False
+        print('Saved {} to {}'.format(url, path))
+        return True
 
 
 class IIIF_Collection(object):
@@ -87,4 +152,6 @@ def figgy_iiif_uri(id):
 
 if __name__ == '__main__':
     image_collector = ImageCollector(figgy_iiif_uri(GA))
-    image_collector.download_thumbnails()
+    failed = image_collector.download_thumbnails()
+    if failed:
+        print('{} thumbnails could not be downloaded; run again to retry them'.format(len(failed)))
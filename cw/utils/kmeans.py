@@ -0,0 +1,178 @@
+import cv2
+import numpy as np
+#
+# NumPy helpers for the k-means work in ./color_analysis.py that cv2.kmeans
+# doesn't do for us. Points are (N, 3) float32 arrays of colors, and centers
+# are (k, 3), same as cv2.
+#
+
+def nearest(points, centers):
+    # Returns (labels, sq_distances): the index of the closest center for each
+    # point, shaped (N, 1) int32 like cv2's labels, and the squared distance
+    # to it. Uses |p|^2 - 2p.c + |c|^2 so that we only allocate N x k floats.
+    centers = np.float32(centers)
+    d = np.sum(points**2, axis=1)[:, None] - 2 * points @ centers.T
+    d += np.sum(centers**2, axis=1)
+    labels = np.argmin(d, axis=1)
+    sq_distances = np.maximum(d[np.arange(len(d)), labels], 0)
+    return labels.astype(np.int32).reshape((-1, 1)), sq_distances
+
+def split_worst(points, labels, centers, weights=None):
+    # Returns k+1 centers: the k we were given, but with the one whose cluster
+    # has the largest total distortion split in two along its principal axis.
+    # For a roughly normal cluster the halves' means sit at +/- sqrt(2/pi)
+    # standard deviations along that axis, so that is where the seeds go.
+    # `weights` (optional) is how many times each point counts.
+    labels = labels.ravel()
+    centers = np.float32(centers)
+    sq_distances = np.sum((points - centers[labels])**2, axis=1)
+    if weights is not None:
+        sq_distances = sq_distances * weights
+    distortion = np.bincount(labels, weights=sq_distances, minlength=len(centers))
+    worst = np.argmax(distortion)
+    in_worst = labels == worst
+    members = points[in_worst]
+    offset = np.zeros(3, np.float32)
+    if len(members) > 1:
+        member_weights = None if weights is None else weights[in_worst]
+        covariance = np.cov(members.T, fweights=member_weights)
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        spread = np.sqrt(max(eigenvalues[-1], 0) * 2 / np.pi)
+        offset = np.float32(spread * eigenvectors[:, -1])
+    seeds = np.vstack((centers, centers[worst] + offset))
+    seeds[worst] -= offset
+    return seeds
+
+def weighted_k_means(points, weights, k, criteria, attempts, flags, seed=0,
+        centers=None, info=None):
+    # Lloyd's k-means where each point counts `weights` times, e.g. the bins
+    # of a ColorHistogram. Takes and returns the same things as cv2.kmeans
+    # (criteria, attempts, flags -> compactness, labels, centers) so that the
+    # two are interchangeable. If `centers` are given they are used to start
+    # the (first) attempt instead of random ones. Random starts come from a
+    # generator seeded with `seed`, so results are repeatable. If `info` (a
+    # dict) is given, info['iterations'] is set to the number of iterations
+    # the returned attempt ran.
+    rng = np.random.default_rng(seed)
+    weights = np.float64(weights)
+    k = min(k, len(points))
+    best = None
+    for attempt in range(attempts):
+        if attempt == 0 and centers is not None:
+            start = np.float32(centers)
+        elif flags & cv2.KMEANS_PP_CENTERS:
+            start = _plus_plus_centers(points, weights, k, rng)
+        else:
+            chosen = rng.choice(len(points), k, replace=False, p=weights / weights.sum())
+            start = points[chosen]
+        result = _lloyd(points, weights, start, criteria)
+        if best is None or result[0] < best[0]:
+            best = result
+    if info is not None:
+        info['iterations'] = best[3]
+    return best[:3]
+
+def _plus_plus_centers(points, weights, k, rng):
+    # k-means++ (Arthur & Vassilvitskii), with each point's chance of being
+    # picked scaled by its weight.
+    centers = [points[rng.choice(len(points), p=weights / weights.sum())]]
+    _, sq_distances = nearest(points, centers)
+    for _ in range(1, k):
+        p = weights * sq_distances
+        if p.sum() <= 0:
+            p = weights
+        centers.append(points[rng.choice(len(points), p=p / p.sum())])
+        _, d = nearest(points, centers[-1:])
+        sq_distances = np.minimum(sq_distances, d)
+    return np.float32(centers)
+
+def _lloyd(points, weights, centers, criteria):
+    criteria_type, max_iter, epsilon = criteria
+    if not criteria_type & cv2.TERM_CRITERIA_MAX_ITER:
+        max_iter = 100
+    if not criteria_type & cv2.TERM_CRITERIA_EPS:
+        epsilon = 0
+    k = len(centers)
+    centers = np.float32(centers)
+    for iterations in range(1, max(max_iter, 1) + 1):
+        labels, sq_distances = nearest(points, centers)
+        labels = labels.ravel()
+        totals = np.bincount(labels, weights=weights, minlength=k)
+        sums = np.stack([np.bincount(labels, weights=weights * points[:, c],
+            minlength=k) for c in range(3)], axis=1)
+        updated = centers.copy()
+        filled = totals > 0
+        updated[filled] = sums[filled] / totals[filled, None]
+        for empty in np.flatnonzero(~filled):
+            # Same as cv2: move an empty cluster to the point that is worst
+            # served by the current centers.
+            farthest = np.argmax(weights * sq_distances)
+            updated[empty] = points[farthest]
+            sq_distances[farthest] = 0
+        shift = np.sqrt(np.max(np.sum((updated - centers)**2, axis=1)))
+        centers = updated
+        if shift <= epsilon:
+            break
+    labels, sq_distances = nearest(points, centers)
+    compactness = float(np.dot(weights, sq_distances))
+    return compactness, labels, centers, iterations
+
+def mini_batch_k_means(chunks, sample, k, criteria, attempts, flags, seed=0,
+        batch_size=4096, epochs=2, info=None):
+    # k-means over more points than we want in memory at once: `chunks` is a
+    # function that returns a fresh iterable of (n, 3) float32 arrays (e.g.
+    # row strips of an image) each time it's called, and `sample` is an
+    # (m, 3) float32 random sample of the same points.
+    #
+    # We start from weighted_k_means over the sample (attempts, flags, seed
+    # as there), then make up to `epochs` passes over the chunks doing
+    # mini-batch updates (Sculley 2010, "Web-scale k-means clustering"):
+    # each center moves towards the mean of the batch points assigned to it,
+    # by the share of all the points it has seen so far that those are. The
+    # centers start out as having seen their sample clusters, so the first
+    # batches refine them rather than replace them. We stop early if an
+    # epoch moves no center further than criteria's epsilon. A last pass
+    # assigns every point, for the counts and compactness.
+    #
+    # Returns (compactness, counts, centers); note counts (the number of
+    # points in each cluster) rather than cv2's per-point labels. If `info`
+    # (a dict) is given, info['iterations'] is set to the number of epochs.
+    criteria_type, _, epsilon = criteria
+    if not criteria_type & cv2.TERM_CRITERIA_EPS:
+        epsilon = 0
+    rng = np.random.default_rng(seed)
+    weights = np.ones(len(sample))
+    _, labels, centers = weighted_k_means(sample, weights, k, criteria,
+        attempts, flags, seed=seed)
+    k = len(centers)
+    seen = np.bincount(labels.ravel(), minlength=k).astype(np.float64)
+    centers = np.float64(centers)
+    epoch = 0
+    for epoch in range(1, epochs + 1):
+        previous = centers.copy()
+        for chunk in chunks():
+            order = rng.permutation(len(chunk))
+            for start in range(0, len(chunk), batch_size):
+                batch = chunk[order[start:start+batch_size]]
+                labels, _ = nearest(batch, centers)
+                labels = labels.ravel()
+                counts = np.bincount(labels, minlength=k)
+                sums = np.stack([np.bincount(labels, weights=batch[:, c],
+                    minlength=k) for c in range(3)], axis=1)
+                seen += counts
+                moved = counts > 0
+                centers[moved] += (sums[moved] - counts[moved, None] * centers[moved]) \
+                    / seen[moved, None]
+        shift = np.sqrt(np.max(np.sum((centers - previous)**2, axis=1)))
+        if shift <= epsilon:
+            break
+    centers = np.float32(centers)
+    counts = np.zeros(k, np.int64)
+    compactness = 0.0
+    for chunk in chunks():
+        labels, sq_distances = nearest(chunk, centers)
+        counts += np.bincount(labels.ravel(), minlength=k)
+        compactness += float(np.sum(sq_distances, dtype=np.float64))
+    if info is not None:
+        info['iterations'] = epoch
+    return compactness, counts, centers
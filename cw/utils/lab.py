@@ -0,0 +1,43 @@
+import cv2
+import numpy as np
+#
+# CIELAB conversions for the 'lab' color space of ./color_analysis.py, where
+# the distance between two colors (i.e. what k-means minimizes) is much closer
+# to how different they look than it is in BGR.
+#
+# Pixels (uint8) go through OpenCV's 8-bit conversion, which is table driven:
+# it looks up the linearized value of each channel and the cube root in
+# precomputed tables rather than doing the math per pixel. That is about as
+# cheap as a conversion gets; a precomputed table of all 2**24 colors is 48 MiB
+# per process and, because the lookups miss the cache, four times slower. The
+# 8-bit encoding is L * 255/100, a + 128, b + 128, which we undo, so that
+# distances are in Lab units (i.e. delta E 1976). L comes out to within 0.5,
+# and a and b to within 1.5.
+#
+# Anything that's already float (histogram bin means, centroids) is converted
+# exactly, in float32.
+#
+
+# Undoes the 8-bit encoding, as an affine transform for cv2.transform (which
+# is several times faster than scaling and offsetting with NumPy)
+LAB_DECODE = np.float32([
+    [100 / 255, 0, 0, 0],
+    [0, 1, 0, -128],
+    [0, 0, 1, -128]])
+
+def pixels_to_lab(pixels):
+    # uint8 BGR, (..., 3) -> (N, 3) float32 Lab
+    pixels = np.ascontiguousarray(pixels, np.uint8).reshape((-1, 1, 3))
+    lab = np.float32(cv2.cvtColor(pixels, cv2.COLOR_BGR2Lab))
+    return cv2.transform(lab, LAB_DECODE).reshape((-1, 3))
+
+def points_to_lab(points):
+    # (N, 3) BGR as floats from 0 to 255 -> (N, 3) float32 Lab
+    bgr = np.float32(points).reshape((-1, 1, 3)) / 255
+    return cv2.cvtColor(bgr, cv2.COLOR_BGR2Lab).reshape((-1, 3))
+
+def lab_to_bgr(points):
+    # (N, 3) Lab -> (N, 3) float32 BGR from 0 to 255. Lab colors outside the
+    # sRGB gamut are clipped.
+    bgr = cv2.cvtColor(np.float32(points).reshape((-1, 1, 3)), cv2.COLOR_Lab2BGR)
+    return np.clip(bgr.reshape((-1, 3)) * 255, 0, 255)
@@ -0,0 +1,70 @@
+from contextlib import contextmanager
+from contextlib import nullcontext
+from json import dumps
+from time import perf_counter
+#
+# Instrumentation for ./color_analysis.py. Give an ImageAnalyzer a Metrics and
+# it records how long each stage took (fetch, hash, cache, decode, float32 or
+# lab, histogram, sweep, find_best_k, viz; callers add their own, e.g.
+# write), and for each k clustered how long it took, its compactness, and, for
+# the histogram engine, how many iterations the best attempt ran (cv2.kmeans
+# doesn't tell us), plus a few numbers about the image, e.g. how many pixels
+# were analyzed. to_json() gives all of that as one line of NDJSON.
+#
+# Stages don't overlap, except that 'sweep' is the whole k sweep, i.e. it
+# includes the time of each k (and, for the incremental sweep, 'split'; for
+# tiled input with the minibatch engine, 'decode', since every pass reads the
+# image again). In tiled mode 'decode' is reading each strip, and for IIIF
+# services that includes fetching it.
+#
+# The default is NULL_METRICS, whose methods do nothing and whose stage() is
+# a shared nullcontext, so an analyzer that isn't being measured pays for a
+# method call per stage and nothing else.
+#
+
+class Metrics(object):
+    def __init__(self, **values):
+        self.values = dict(values) # e.g. image=path
+        self.stages = {} # name -> seconds, summed if a stage runs more than once
+        self.ks = [] # one dict per k, in the order they were clustered
+
+    @contextmanager
+    def stage(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, perf_counter() - start)
+
+    def add_time(self, name, seconds):
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def record(self, **values):
+        self.values.update(values)
+
+    def record_k(self, k, seconds, compactness, iterations=None):
+        self.ks.append({'k' : k, 'seconds' : seconds,
+            'compactness' : float(compactness), 'iterations' : iterations})
+
+    def to_dict(self):
+        return dict(self.values, stages=self.stages, ks=self.ks)
+
+    def to_json(self):
+        return dumps(self.to_dict(), sort_keys=True)
+
+class NullMetrics(object):
+    _stage = nullcontext()
+
+    def stage(self, name):
+        return NullMetrics._stage
+
+    def add_time(self, name, seconds):
+        pass
+
+    def record(self, **values):
+        pass
+
+    def record_k(self, k, seconds, compactness, iterations=None):
+        pass
+
+NULL_METRICS = NullMetrics()
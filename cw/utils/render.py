@@ -0,0 +1,61 @@
+import cv2
+import numpy as np
+#
+# Drawing palette strips for ./color_analysis.py (ImageAnalyzer.viz) and for
+# batches of palettes. A strip is one row of pixels repeated down the image,
+# so we work out where each color starts (section_widths), build that row with
+# np.repeat, and write each pixel of the image once, rather than painting each
+# color from where it starts to the right edge and then painting over it.
+#
+# The sections are exactly the ones the paint-over loop drew, so the strips are
+# pixel-identical to it:
+#  * weighted: each color is int(volume / total * width) pixels wide, and the
+#    last one gets whatever is left;
+#  * unweighted: color i starts at int(i * (1/n) * width).
+#
+
+# Cheap settings for writing lots of palette PNGs: every row of a strip is the
+# same as the one above it, so the 'up' filter turns all but the first row into
+# zeros, which RLE compresses about as fast as anything and smaller than the
+# defaults. (IMWRITE_PNG_FILTER is new in OpenCV 4.10.)
+PNG_PARAMS = [cv2.IMWRITE_PNG_STRATEGY, cv2.IMWRITE_PNG_STRATEGY_RLE]
+if hasattr(cv2, 'IMWRITE_PNG_FILTER'):
+    PNG_PARAMS += [cv2.IMWRITE_PNG_FILTER, cv2.IMWRITE_PNG_FILTER_UP]
+
+def section_widths(volumes, width, weighted=True):
+    # The width of each color's section; they add up to width. (In plain
+    # Python, so that the arithmetic is the same as it always was.)
+    n = len(volumes)
+    if weighted:
+        total = sum(volumes)
+        widths = [int(v / total * width) for v in volumes[:-1]]
+        return widths + [width - sum(widths)]
+    starts = [int(i * (1/n) * width) for i in range(n)] + [width]
+    return [stop - start for start, stop in zip(starts, starts[1:])]
+
+def strip_row(colors, width, weighted=True):
+    # (width, 3) uint8: one row of the strip for colors, [(BGR, volume), ...]
+    # as from ImageAnalyzer.dominant_colors. No colors gives black.
+    if not colors:
+        return np.zeros((width, 3), np.uint8)
+    widths = section_widths([c[1] for c in colors], width, weighted)
+    return np.repeat(np.uint8([c[0] for c in colors]), widths, axis=0)
+
+def render_strip(colors, width, height, weighted=True, out=None):
+    # (height, width, 3) uint8, into out if it's given
+    if out is None:
+        out = np.empty((height, width, 3), np.uint8)
+    out[:] = strip_row(colors, width, weighted)
+    return out
+
+def render_strips(palettes, width, height, weighted=True, out=None):
+    # (len(palettes), height, width, 3) uint8: a strip for each palette in one
+    # array, into out if it's given
+    palettes = list(palettes)
+    if out is None:
+        out = np.empty((len(palettes), height, width, 3), np.uint8)
+    rows = np.empty((len(palettes), 1, width, 3), np.uint8)
+    for i, colors in enumerate(palettes):
+        rows[i, 0] = strip_row(colors, width, weighted)
+    out[:] = rows
+    return out
@@ -0,0 +1,461 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from itertools import accumulate
+from struct import calcsize
+from struct import pack
+from struct import unpack
+from struct import unpack_from
+from zlib import compress
+from zlib import crc32
+from zlib import decompressobj
+import cv2
+import numpy as np
+
+from cw.utils.decode import decode_image
+from cw.utils.decode import read_image
+from cw.utils.iiif import fetch_image
+from cw.utils.iiif import fetch_info
+from cw.utils.iiif import fetch_region
+from cw.utils.iiif import is_image_service
+from cw.utils.iiif import region_size
+#
+# Reading big images a strip at a time, for the tiled mode of
+# ./color_analysis.py, so that the whole decoded image is never in memory.
+#
+# open_tiles gives a source with the image's width and height and a strips()
+# method that yields the image top to bottom as (rows, columns, 3) uint8 BGR
+# arrays of about tile_pixels pixels each, or of whatever the smallest piece
+# the format can be read in is, if that's bigger. They're whole rows (i.e. the
+# pixels come in the same order as the image's) for everything but IIIF:
+#
+#  * TIFF: a run of the file's strips (or rows of its tiles) is copied into a
+#    small TIFF of its own, with the tags that matter for decoding, which
+#    OpenCV (i.e. libtiff) decodes, so any compression libtiff knows works.
+#    Uncompressed strips that are too big are cut into pieces; compressed
+#    ones can't be.
+#  * PNG: the IDAT stream is inflated a strip's worth of rows at a time, and
+#    those rows are wrapped up as a PNG of their own for libpng to unfilter
+#    and decode. Its first row is the last row of the previous strip, stored
+#    unfiltered, because that's what the filters of the strip's first row
+#    refer to.
+#  * IIIF image services: the service's tiles (see iiif.region_size) at full
+#    size, TILE_WORKERS requests at once. Each row of tiles comes in groups
+#    of as many tiles as fit in tile_pixels (at least one), left to right, so
+#    that a wide image doesn't need a whole row of tiles in memory.
+#
+# Anything else (JPEGs, interlaced or low bit depth PNGs, TIFFs with separate
+# color planes, level 0 image services without tiles...) is decoded whole and
+# then cut into strips; that works, but memory isn't bounded.
+#
+# Reading a strip takes a few times tile_pixels * 3 bytes (the compressed
+# strip, the small file made from it, and the decoded strip), and analyzing it
+# some more: about 35 bytes a pixel all told for the histogram engine, i.e.
+# peak RSS goes up by about 140 MiB for the default TILE_PIXELS. (A 120
+# megapixel TIFF peaked at 107 MiB with tile_pixels=2**20, against 3.4 GiB
+# decoded whole.)
+#
+
+TILE_PIXELS = 1 << 22
+TILE_WORKERS = 4
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+TIFF_MAGIC = (b'II*\x00', b'MM\x00*', b'II+\x00', b'MM\x00+')
+
+# TIFF field types: struct format of one value
+TIFF_TYPES = {1: 'B', 2: 'B', 3: 'H', 4: 'I', 5: 'II', 6: 'b', 7: 'B', 8: 'h',
+    9: 'i', 10: 'ii', 11: 'f', 12: 'd', 13: 'I', 16: 'Q', 17: 'q', 18: 'Q'}
+# The tags that are copied into each strip's TIFF: the ones that say how to
+# decode it (width, bits per sample, compression, photometric, fill order,
+# samples per pixel, planar configuration, T4/T6 options, predictor, color
+# map, tile width/length, extra samples, sample format, JPEG tables, YCbCr)
+TIFF_DECODING_TAGS = {256, 258, 259, 262, 266, 277, 284, 292, 293, 317, 320,
+    322, 323, 338, 339, 347, 529, 530, 531, 532}
+IMAGE_LENGTH = 257
+ROWS_PER_STRIP = 278
+STRIP_OFFSETS, STRIP_BYTE_COUNTS = 273, 279
+TILE_OFFSETS, TILE_BYTE_COUNTS = 324, 325
+
+def open_tiles(image_path, image_bytes=None, tile_pixels=TILE_PIXELS):
+    # image_path is a file or the URI of an IIIF image service; if
+    # image_bytes is given that's read instead and image_path is just its name
+    if image_bytes is None and is_image_service(image_path):
+        info = fetch_info(image_path)
+        if region_size(info) is None:
+            return WholeImage(decode_image(fetch_image(image_path)), tile_pixels, info)
+        return IIIFSource(info, tile_pixels)
+    f = BytesIO(image_bytes) if image_bytes is not None else open(image_path, 'rb')
+    magic = f.read(8)
+    f.seek(0)
+    source = None
+    if magic[:4] in TIFF_MAGIC:
+        source = TiffSource.open(f, tile_pixels)
+    elif magic == PNG_SIGNATURE:
+        source = PngSource.open(f, tile_pixels)
+    if source is not None:
+        return source
+    f.close()
+    if image_bytes is not None:
+        return WholeImage(decode_image(image_bytes), tile_pixels)
+    return WholeImage(read_image(image_path), tile_pixels)
+
+def reblock(strips, pixels):
+    # Re-cuts strips (e.g. from strips()) into (pixels, 3) arrays, except for
+    # the last, taking their pixels in order, so that what comes out doesn't
+    # depend on how the image happened to be stored
+    pending = []
+    n = 0
+    for strip in strips:
+        strip = strip.reshape((-1, 3))
+        while len(strip):
+            take = min(pixels - n, len(strip))
+            pending.append(strip[:take])
+            strip = strip[take:]
+            n += take
+            if n == pixels:
+                yield pending[0] if len(pending) == 1 else np.concatenate(pending)
+                pending = []
+                n = 0
+    if pending:
+        yield np.concatenate(pending)
+
+class WholeImage(object):
+    def __init__(self, image, tile_pixels=TILE_PIXELS, info=None):
+        self.image = image
+        self.info = info # the IIIF info.json, if it came from a service
+        self.height, self.width = image.shape[:2]
+        self.tile_pixels = tile_pixels
+
+    def strips(self):
+        rows = max(1, self.tile_pixels // self.width)
+        for top in range(0, self.height, rows):
+            yield self.image[top:top+rows]
+
+    def close(self):
+        self.image = None
+
+class TiffSource(object):
+    def __init__(self, f, order, tags, tile_pixels=TILE_PIXELS):
+        self.f = f
+        self.order = order # '<' or '>'
+        self.tags = tags # {tag: (type, count, raw bytes)}
+        self.tile_pixels = tile_pixels
+        self.width = self._value(256)
+        self.height = self._value(IMAGE_LENGTH)
+        self.tiled = TILE_OFFSETS in tags
+        if self.tiled:
+            self.tile_width = self._value(322)
+            self.tile_height = self._value(323)
+            self.offsets = self._values(TILE_OFFSETS)
+            self.byte_counts = self._values(TILE_BYTE_COUNTS)
+        else:
+            self.rows_per_strip = min(self._value(ROWS_PER_STRIP, self.height), self.height)
+            self.offsets = self._values(STRIP_OFFSETS)
+            self.byte_counts = self._values(STRIP_BYTE_COUNTS)
+
+    @classmethod
+    def open(cls, f, tile_pixels=TILE_PIXELS):
+        # A TiffSource for the first image in file f, or None if it can't be
+        # read in strips
+        order, tags = _read_ifd(f)
+        planar = tags.get(284)
+        if planar and unpack_from(order + TIFF_TYPES[planar[0]], planar[2])[0] != 1:
+            return None # separate color planes
+        if IMAGE_LENGTH not in tags or (STRIP_OFFSETS not in tags and TILE_OFFSETS not in tags):
+            return None
+        return cls(f, order, tags, tile_pixels)
+
+    def strips(self):
+        for rows, pieces in self._groups():
+            chunks = []
+            for offset, count in pieces:
+                self.f.seek(offset)
+                chunks.append(self.f.read(count))
+            data = self._tiff(rows, chunks)
+            strip = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+            if strip is None:
+                raise ValueError('a strip of the TIFF could not be decoded')
+            yield strip[:rows, :self.width]
+
+    def close(self):
+        self.f.close()
+
+    def _groups(self):
+        # [(rows, [(offset, byte count), ...]), ...]: runs of whole strips (or
+        # rows of tiles) of up to about tile_pixels pixels, top to bottom
+        if self.tiled:
+            across = -(-self.width // self.tile_width)
+            unit_rows = self.tile_height
+            units = [list(zip(self.offsets[i:i+across], self.byte_counts[i:i+across]))
+                for i in range(0, len(self.offsets), across)]
+        elif self._compression() == 1 and self.rows_per_strip * self.width > self.tile_pixels:
+            # Uncompressed and too big: every row is the same number of bytes,
+            # so we can cut each strip into pieces of whole rows
+            yield from self._pieces()
+            return
+        else:
+            unit_rows = self.rows_per_strip
+            units = [[p] for p in zip(self.offsets, self.byte_counts)]
+        per_group = max(1, self.tile_pixels // (unit_rows * self.width))
+        for top in range(0, len(units), per_group):
+            first_row = top * unit_rows
+            rows = min(per_group * unit_rows, self.height - first_row)
+            if rows <= 0:
+                break
+            yield rows, [p for unit in units[top:top+per_group] for p in unit]
+
+    def _pieces(self):
+        rows = max(1, self.tile_pixels // self.width)
+        bits = self._values(258) if 258 in self.tags else (1,)
+        if len(bits) == 1:
+            bits *= self._value(277, 1) # samples per pixel
+        row_bytes = -(-self.width * sum(bits) // 8)
+        for i, offset in enumerate(self.offsets):
+            strip_rows = min(self.rows_per_strip, self.height - i * self.rows_per_strip)
+            for first in range(0, strip_rows, rows):
+                n = min(rows, strip_rows - first)
+                yield n, [(offset + first * row_bytes, n * row_bytes)]
+
+    def _tiff(self, rows, chunks):
+        # A TIFF of just these rows, for cv2.imdecode
+        order = self.order
+        tags = {tag: value for tag, value in self.tags.items()
+            if tag in TIFF_DECODING_TAGS and value[0] not in (16, 17, 18)}
+        tags[IMAGE_LENGTH] = (4, 1, pack(order + 'I', rows))
+        if self.tiled:
+            offsets_tag, counts_tag = TILE_OFFSETS, TILE_BYTE_COUNTS
+        else:
+            offsets_tag, counts_tag = STRIP_OFFSETS, STRIP_BYTE_COUNTS
+            tags[ROWS_PER_STRIP] = (4, 1, pack(order + 'I',
+                rows if len(chunks) == 1 else self.rows_per_strip))
+        n = len(chunks)
+        counts = [len(c) for c in chunks]
+        tags[counts_tag] = (4, n, pack(f'{order}{n}I', *counts))
+        tags[offsets_tag] = (4, n, bytes(4 * n)) # filled in once we know where
+        # Header, IFD, the values that don't fit in the IFD, then the data
+        position = 8 + 2 + 12 * len(tags) + 4
+        value_offsets = {}
+        for tag in sorted(tags):
+            size = len(tags[tag][2])
+            if size > 4:
+                value_offsets[tag] = position
+                position += size + (size & 1)
+        starts = list(accumulate([position] + counts[:-1]))
+        tags[offsets_tag] = (4, n, pack(f'{order}{n}I', *starts))
+        parts = [(b'II' if order == '<' else b'MM') + pack(order + 'HI', 42, 8),
+            pack(order + 'H', len(tags))]
+        values = []
+        for tag in sorted(tags):
+            type_, count, raw = tags[tag]
+            if tag in value_offsets:
+                field = pack(order + 'I', value_offsets[tag])
+                values.append(raw + b'\x00' * (len(raw) & 1))
+            else:
+                field = raw.ljust(4, b'\x00')
+            parts.append(pack(order + 'HHI', tag, type_, count) + field)
+        parts.append(pack(order + 'I', 0))
+        return b''.join(parts + values + chunks)
+
+    def _compression(self):
+        return self._value(259, 1)
+
+    def _value(self, tag, default=None):
+        if tag not in self.tags:
+            return default
+        return self._values(tag)[0]
+
+    def _values(self, tag):
+        type_, count, raw = self.tags[tag]
+        return unpack_from(f'{self.order}{count}{TIFF_TYPES[type_]}', raw)
+
+def _read_ifd(f):
+    # (byte order, {tag: (type, count, raw bytes)}) for the first image in a
+    # TIFF or BigTIFF. Tags of types we don't know are left out.
+    header = f.read(16)
+    order = '<' if header[:2] == b'II' else '>'
+    magic, = unpack_from(order + 'H', header, 2)
+    big = magic == 43
+    if big:
+        offset, = unpack_from(order + 'Q', header, 8)
+        count_format, field_size = 'Q', 8
+    else:
+        offset, = unpack_from(order + 'I', header, 4)
+        count_format, field_size = 'I', 4
+    f.seek(offset)
+    n_format = order + ('Q' if big else 'H')
+    n, = unpack(n_format, f.read(calcsize(n_format)))
+    entry_format = f'{order}HH{count_format}{field_size}s'
+    entries = [unpack(entry_format, f.read(calcsize(entry_format))) for _ in range(n)]
+    tags = {}
+    for tag, type_, count, field in entries:
+        if type_ not in TIFF_TYPES:
+            continue
+        size = calcsize(order + TIFF_TYPES[type_]) * count
+        if size <= field_size:
+            raw = field[:size]
+        else:
+            f.seek(unpack(order + count_format, field)[0])
+            raw = f.read(size)
+        tags[tag] = (type_, count, raw)
+    return order, tags
+
+class PngSource(object):
+    # Color types: 0 gray, 2 RGB, 3 palette, 4 gray + alpha, 6 RGBA
+    CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}
+
+    def __init__(self, f, header, palette, first_idat, tile_pixels=TILE_PIXELS):
+        self.f = f
+        self.width, self.height, self.depth, self.color_type = header
+        self.palette = palette # (n, 3) BGR for color type 3
+        self.first_idat = first_idat # file offset of the first IDAT chunk
+        self.tile_pixels = tile_pixels
+        self.row_bytes = self.width * PngSource.CHANNELS[self.color_type] * self.depth // 8
+
+    @classmethod
+    def open(cls, f, tile_pixels=TILE_PIXELS):
+        # A PngSource for file f, or None if it can't be read in strips
+        f.seek(len(PNG_SIGNATURE))
+        palette = None
+        while True:
+            start = f.tell()
+            length, kind = unpack('>I4s', f.read(8))
+            if kind == b'IHDR':
+                width, height, depth, color_type, _, _, interlace = unpack('>IIBBBBB', f.read(13))
+            elif kind == b'PLTE':
+                rgb = np.frombuffer(f.read(length), np.uint8).reshape((-1, 3))
+                palette = np.ascontiguousarray(rgb[:, ::-1])
+            elif kind in (b'IDAT', b'IEND', b''):
+                break
+            f.seek(start + 8 + length + 4)
+        if kind != b'IDAT' or interlace or color_type not in PngSource.CHANNELS:
+            return None
+        if depth not in (8, 16) or (color_type == 3 and (depth != 8 or palette is None)):
+            return None
+        return cls(f, (width, height, depth, color_type), palette, start, tile_pixels)
+
+    def strips(self):
+        rows = max(1, self.tile_pixels // self.width)
+        stride = self.row_bytes + 1 # each row starts with its filter type
+        inflate = decompressobj()
+        pending = bytearray()
+        previous = None
+        top = 0
+        for data in self._idat():
+            while data and top < self.height:
+                size = min(rows, self.height - top) * stride
+                pending += inflate.decompress(data, max(size - len(pending), 1))
+                data = inflate.unconsumed_tail
+                if len(pending) >= size:
+                    strip, previous = self._decode(bytes(pending[:size]), previous)
+                    del pending[:size]
+                    top += len(strip)
+                    yield strip
+        pending += inflate.flush()
+        if top < self.height and len(pending) >= (self.height - top) * stride:
+            strip, _ = self._decode(bytes(pending), previous)
+            top += len(strip)
+            yield strip
+        if top < self.height:
+            raise ValueError('the PNG is truncated')
+
+    def close(self):
+        self.f.close()
+
+    def _idat(self):
+        # The data of each IDAT chunk (they're all together)
+        self.f.seek(self.first_idat)
+        while True:
+            length, kind = unpack('>I4s', self.f.read(8))
+            if kind != b'IDAT':
+                return
+            yield self.f.read(length)
+            self.f.seek(4, 1) # CRC
+
+    def _decode(self, filtered, previous):
+        # (strip, last row unfiltered): the rows in filtered, as BGR
+        n = len(filtered) // (self.row_bytes + 1)
+        if previous is not None:
+            filtered = b'\x00' + previous + filtered # filter type 0, i.e. none
+            n += 1
+        # Palette images are decoded as gray, which gives us the indices
+        color_type = 0 if self.color_type == 3 else self.color_type
+        header = pack('>IIBBBBB', self.width, n, self.depth, color_type, 0, 0, 0)
+        data = b''.join([PNG_SIGNATURE, _png_chunk(b'IHDR', header),
+            _png_chunk(b'IDAT', compress(filtered, 0)), _png_chunk(b'IEND', b'')])
+        image = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_UNCHANGED)
+        if image is None:
+            raise ValueError('a strip of the PNG could not be decoded')
+        last = self._unfiltered(image[-1])
+        if previous is not None:
+            image = image[1:]
+        return self._bgr(image), last
+
+    def _unfiltered(self, row):
+        # A decoded row back as the bytes the PNG has for it
+        if row.ndim == 2 and self.color_type == 2:
+            row = row[:, ::-1] # BGR -> RGB
+        elif row.ndim == 2 and self.color_type == 6:
+            row = row[:, [2, 1, 0, 3]] # BGRA -> RGBA
+        elif row.ndim == 2 and self.color_type == 4:
+            row = row[:, [0, 3]] # gray + alpha comes back as BGRA
+        return np.ascontiguousarray(row, '>u2' if self.depth == 16 else np.uint8).tobytes()
+
+    def _bgr(self, image):
+        if self.color_type == 3:
+            return self.palette[image]
+        if self.depth == 16:
+            image = np.uint8(image >> 8)
+        if image.ndim == 2:
+            return cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        return np.ascontiguousarray(image[:, :, :3])
+
+def _png_chunk(kind, data):
+    return pack('>I', len(data)) + kind + data + pack('>I', crc32(kind + data))
+
+class IIIFSource(object):
+    def __init__(self, info, tile_pixels=TILE_PIXELS):
+        self.info = info
+        self.width = info['width']
+        self.height = info['height']
+        self.tile_pixels = tile_pixels
+        self.tile_width, self.tile_height = region_size(info)
+
+    def strips(self):
+        # Groups of tiles, left to right along each row of them (see above)
+        tile_area = self.tile_width * self.tile_height
+        group_width = max(1, self.tile_pixels // tile_area) * self.tile_width
+        group = None
+        for left, top, tile in self._tiles():
+            start = left - left % group_width
+            if left == start:
+                width = min(group_width, self.width - start)
+                group = np.empty((tile.shape[0], width, 3), np.uint8)
+            group[:, left-start:left-start+tile.shape[1]] = tile
+            if left + tile.shape[1] == start + group.shape[1]:
+                yield group
+
+    def close(self):
+        pass
+
+    def _tiles(self):
+        # Yields (left, top, tile) for every tile, top to bottom and left to
+        # right, with up to TILE_WORKERS of them being fetched at once
+        regions = ((left, top, min(self.tile_height, self.height - top))
+            for top in range(0, self.height, self.tile_height)
+            for left in range(0, self.width, self.tile_width))
+        with ThreadPoolExecutor(TILE_WORKERS) as pool:
+            pending = deque()
+            for region in regions:
+                pending.append((region, pool.submit(self._tile, *region)))
+                if len(pending) == TILE_WORKERS:
+                    (left, top, _), future = pending.popleft()
+                    yield left, top, future.result()
+            for (left, top, _), future in pending:
+                yield left, top, future.result()
+
+    def _tile(self, left, top, rows):
+        w = min(self.tile_width, self.width - left)
+        tile = decode_image(fetch_region(self.info, left, top, w, rows))
+        if tile.shape[:2] != (rows, w): # shouldn't happen, but be forgiving
+            tile = cv2.resize(tile, (w, rows), interpolation=cv2.INTER_AREA)
+        return tile
@@ -0,0 +1,60 @@
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from os.path import abspath
+from os.path import dirname
+from sys import path
+from threading import Thread
+
+# So that cw can be imported however pytest is run
+path.append(abspath(dirname(dirname(__file__))))
+
+import pytest
+#
+# Shared fixtures. stub_server is a local HTTP server for tests of the code
+# that fetches things (image_fetch.py, iiif.py): give it a dict of routes, and
+# it answers each GET for a path with that route's responses in order, the
+# last one again once they run out. A response is (status, body) or (status,
+# body, headers), where headers can override the Content-Length (e.g. to cut a
+# response short); paths without a route get a 404. Every path requested is
+# recorded in server.requests, in order.
+#
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        responses = self.server.routes.get(self.path)
+        if not responses:
+            status, body, headers = 404, b'', {}
+        else:
+            response = responses.pop(0) if len(responses) > 1 else responses[0]
+            status, body, headers = (tuple(response) + ({},))[:3]
+        self.send_response(status)
+        for name, value in dict({'Content-Length' : str(len(body))}, **headers).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super(StubServer, self).__init__(('127.0.0.1', 0), StubHandler)
+        self.routes = {} # path -> [response, ...]
+        self.requests = []
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+@pytest.fixture
+def stub_server():
+    server = StubServer()
+    # (polling often, so that shutdown doesn't wait half a second)
+    Thread(target=server.serve_forever, args=(0.01,), daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,169 @@
+from os import getpid
+from os import kill
+from signal import SIGKILL
+from threading import Thread
+from time import sleep
+
+import cv2
+import numpy as np
+import pytest
+import requests
+
+from cw import analysis_server
+from cw.analysis_server import AnalysisServer
+from cw.analysis_server import AnalysisService
+from cw.analysis_server import RequestError
+
+OPTIONS = {'workers' : 1, 'profile' : 'fast'}
+
+def synthetic_png(seed=0):
+    rng = np.random.default_rng(seed)
+    return cv2.imencode('.png', np.uint8(rng.integers(0, 256, (32, 48, 3))))[1].tobytes()
+
+def busy(seconds):
+    # Keeps a pool worker busy, so that requests queue up behind it
+    sleep(seconds)
+
+def die(seconds):
+    # As if the worker were killed, e.g. for using too much memory
+    sleep(seconds)
+    kill(getpid(), SIGKILL)
+
+@pytest.fixture
+def make_service(tmp_path):
+    # Makes AnalysisServices serving tmp_path, which has image.png in it
+    (tmp_path / 'root').mkdir()
+    (tmp_path / 'root' / 'image.png').write_bytes(synthetic_png())
+    (tmp_path / 'secret.png').write_bytes(synthetic_png(1))
+    services = []
+    def make_service(**kwargs):
+        service = AnalysisService(1, root=str(tmp_path / 'root'), options=OPTIONS, **kwargs)
+        services.append(service)
+        return service
+    yield make_service
+    for service in services:
+        service.shutdown()
+
+@pytest.fixture
+def server(make_service):
+    # An AnalysisServer on a free port, in a thread
+    server = AnalysisServer(('127.0.0.1', 0), make_service(), quiet=True)
+    Thread(target=server.serve_forever, args=(0.01,), daemon=True).start()
+    host, port = server.server_address[:2]
+    server.url = f'http://{host}:{port}'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def in_threads(*calls):
+    # Starts each call on its own thread; returns a function that waits for
+    # them and returns their results
+    results = [None] * len(calls)
+    def run(i, call):
+        try:
+            results[i] = call()
+        except Exception as e:
+            results[i] = e
+    threads = [Thread(target=run, args=(i, call)) for i, call in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    def join():
+        for thread in threads:
+            thread.join()
+        return results
+    return join
+
+def status(call):
+    with pytest.raises(RequestError) as e:
+        call()
+    return e.value.status
+
+def test_same_image_is_coalesced(server):
+    # Both requests arrive while the pool is busy, so the second waits for
+    # the first's analysis rather than starting its own
+    server.service.pool.submit(busy, 1)
+    url = f'{server.url}/colors?image=image.png'
+    join = in_threads(lambda: requests.get(url), lambda: requests.get(url))
+    responses = join()
+    assert [r.status_code for r in responses] == [200, 200]
+    assert sorted(r.headers['X-Cache'] for r in responses) == ['analyzed', 'coalesced']
+    assert responses[0].json() == responses[1].json()
+    assert requests.get(url).headers['X-Cache'] == 'hit'
+    stats = requests.get(f'{server.url}/stats').json()
+    assert (stats['requests'], stats['coalesced'], stats['lru']['hits']) == (3, 1, 1)
+
+def test_lru_hit(make_service):
+    service = make_service()
+    body, how = service.respond('/palette', {'image' : 'image.png', 'geometry' : '40x10'})
+    assert how == 'analyzed'
+    assert service.respond('/palette', {'image' : 'image.png', 'geometry' : '40x10'}) == (body, 'hit')
+    # A different size is a different response
+    assert service.respond('/palette', {'image' : 'image.png', 'geometry' : '20x10'})[1] == 'analyzed'
+
+def test_path_outside_root(make_service):
+    service = make_service()
+    assert status(lambda: service.respond('/colors', {'image' : '../secret.png'})) == 403
+    assert status(lambda: service.respond('/colors', {'image' : '/etc/passwd'})) == 403
+    assert status(lambda: service.respond('/colors', {'image' : 'missing.png'})) == 404
+
+def test_remote_host_not_allowed(make_service, stub_server):
+    stub_server.routes['/image.png'] = [(200, synthetic_png())]
+    service = make_service()
+    image = f'{stub_server.url}/image.png'
+    assert status(lambda: service.respond('/colors', {'image' : image})) == 403
+    assert stub_server.requests == []
+    service = make_service(allowed_hosts=['127.0.0.1'])
+    assert service.respond('/colors', {'image' : image})[1] == 'analyzed'
+
+def test_redirect_to_host_not_allowed(make_service, stub_server):
+    # 127.0.0.1 is allowed, but it redirects to localhost, which isn't
+    port = stub_server.server_address[1]
+    stub_server.routes['/image.png'] = [(302, b'', {'Location' : f'http://localhost:{port}/other.png'})]
+    stub_server.routes['/other.png'] = [(200, synthetic_png())]
+    service = make_service(allowed_hosts=['127.0.0.1'])
+    image = f'{stub_server.url}/image.png'
+    assert status(lambda: service.respond('/colors', {'image' : image})) == 403
+    assert stub_server.requests == ['/image.png']
+
+def test_remote_ttl(make_service, stub_server, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(analysis_server, 'monotonic', lambda: now[0])
+    stub_server.routes['/image.png'] = [(200, synthetic_png())]
+    service = make_service(allowed_hosts=['127.0.0.1'], remote_ttl=10)
+    query = {'image' : f'{stub_server.url}/image.png'}
+    assert service.respond('/colors', query)[1] == 'analyzed'
+    now[0] += 9
+    assert service.respond('/colors', query)[1] == 'hit'
+    now[0] += 1
+    assert service.respond('/colors', query)[1] == 'analyzed'
+    assert stub_server.requests == ['/image.png', '/image.png']
+    # Local images don't expire
+    assert service.respond('/colors', {'image' : 'image.png'})[1] == 'analyzed'
+    now[0] += 3600
+    assert service.respond('/colors', {'image' : 'image.png'})[1] == 'hit'
+
+def test_queue_full(make_service):
+    service = make_service(max_queue=1)
+    service.pool.submit(busy, 1)
+    join = in_threads(lambda: service.respond('/colors', {'image' : 'image.png'}))
+    while not service.in_flight:
+        sleep(0.01)
+    # A different response, so it can't be coalesced with the first
+    query = {'image' : 'image.png', 'colors' : '2'}
+    assert status(lambda: service.respond('/colors', query)) == 503
+    assert join()[0][1] == 'analyzed'
+    assert service.stats()['rejected'] == 1
+    assert service.respond('/colors', query)[1] == 'analyzed'
+
+def test_dead_worker(make_service):
+    service = make_service()
+    broken = service.pool
+    broken.submit(die, 0.5)
+    join = in_threads(lambda: service.respond('/colors', {'image' : 'image.png'}))
+    error, = join()
+    assert isinstance(error, RequestError) and error.status == 500
+    assert service.pool is not broken
+    assert service.stats()['restarts'] == 1
+    assert service.in_flight == {}
+    # The new pool works, and the failure wasn't cached
+    assert service.respond('/colors', {'image' : 'image.png'})[1] == 'analyzed'
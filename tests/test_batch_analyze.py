@@ -0,0 +1,50 @@
+from os import listdir
+
+import cv2
+import numpy as np
+
+from cw.batch_analyze import Batch
+from cw.models import ImageStore
+from cw.stream_analyze import StreamBatch
+from cw.utils.image_fetch import ImageCollector
+
+OPTIONS = {'profile' : 'fast'}
+
+def synthetic_png(seed):
+    rng = np.random.default_rng(seed)
+    return cv2.imencode('.png', np.uint8(rng.integers(0, 256, (24, 32, 3))))[1].tobytes()
+
+def test_batch(tmp_path):
+    image_paths = []
+    for i in range(3):
+        image_path = tmp_path / f'{i}.png'
+        image_path.write_bytes(synthetic_png(i))
+        image_paths.append(str(image_path))
+    store_path = str(tmp_path / 'data.jsonl')
+
+    batch = Batch(image_paths + [str(tmp_path / 'missing.png')], store_path,
+        jobs=1, options=OPTIONS, log=None)
+    assert batch.run() == 4
+    with ImageStore(store_path) as store:
+        assert [image.source_image for image in store] == image_paths
+    assert len(listdir(tmp_path / 'palettes')) == 3
+    # Done already, apart from the one that failed
+    assert batch.run() == 1
+
+def test_stream_batch(stub_server, tmp_path):
+    sources = []
+    for i in range(3):
+        stub_server.routes[f'/{i}.png'] = [(200, synthetic_png(i))]
+        sources.append((str(i + 1).zfill(4), f'{stub_server.url}/{i}.png'))
+    sources.append(('0004', f'{stub_server.url}/missing.png'))
+    store_path = str(tmp_path / 'data.jsonl')
+    collector = ImageCollector(None, retries=0)
+
+    batch = StreamBatch(sources, store_path, collector,
+        palettes_dir=str(tmp_path / 'palettes'), jobs=1, options=OPTIONS,
+        log=None)
+    assert batch.run() == 4
+    with ImageStore(store_path) as store:
+        assert sorted(image.source_image for image in store) == [url for _, url in sources[:3]]
+    assert sorted(listdir(tmp_path / 'palettes')) == ['0001.png', '0002.png', '0003.png']
+    assert batch.run() == 1
@@ -0,0 +1,97 @@
+from os import listdir
+from os import utime
+from os.path import getsize
+
+import cv2
+import numpy as np
+import pytest
+
+from cw.utils import cache
+from cw.utils.cache import LOW_WATER
+from cw.utils.cache import ResultCache
+from cw.utils.color_analysis import ImageAnalyzer
+
+class CountingCache(ResultCache):
+    # A ResultCache that counts its hits and misses
+    def __init__(self, *args, **kwargs):
+        super(CountingCache, self).__init__(*args, **kwargs)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        arrays = super(CountingCache, self).get(key)
+        if arrays is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return arrays
+
+def synthetic_png(seed=0):
+    rng = np.random.default_rng(seed)
+    return cv2.imencode('.png', np.uint8(rng.integers(0, 256, (32, 48, 3))))[1].tobytes()
+
+def analyze(result_cache, n_colors=None, geometry=None, **options):
+    # Analyzes the same image as every other call, as colorweight.py would
+    with ImageAnalyzer('image.png', image_bytes=synthetic_png(), lean=True,
+            cache=result_cache, **dict({'profile' : 'fast'}, **options)) as ia:
+        if geometry is not None:
+            return ia.viz(n_colors=n_colors, width=geometry[0], height=geometry[1])
+        return ia.dominant_colors_list(n_colors=n_colors)
+
+def test_hit_for_a_different_geometry_or_number_of_colors(tmp_path):
+    result_cache = CountingCache(str(tmp_path))
+    colors = analyze(result_cache)
+    assert (result_cache.hits, result_cache.misses) == (0, 1)
+    assert analyze(result_cache) == colors
+    analyze(result_cache, geometry=(300, 20))
+    analyze(result_cache, geometry=(40, 10))
+    assert analyze(result_cache, n_colors=3) == analyze(None, n_colors=3)
+    assert (result_cache.hits, result_cache.misses) == (4, 1)
+
+@pytest.mark.parametrize('option', [
+    {'engine' : 'histogram'},
+    {'profile' : 'balanced'},
+    {'color_space' : 'lab'},
+    {'max_pixels' : 500},
+])
+def test_miss_for_different_options(tmp_path, option):
+    result_cache = CountingCache(str(tmp_path))
+    analyze(result_cache)
+    analyze(result_cache, **option)
+    assert (result_cache.hits, result_cache.misses) == (0, 2)
+    # and each is cached in its own right
+    analyze(result_cache, **option)
+    assert result_cache.hits == 1
+
+def test_failed_write_leaves_nothing_behind(tmp_path, monkeypatch):
+    def savez(f, **arrays):
+        f.write(b'PK\x03\x04 half a zip file')
+        raise OSError('disk full')
+    monkeypatch.setattr(cache.np, 'savez', savez)
+    result_cache = ResultCache(str(tmp_path))
+    key = 'ab' + '0' * 62
+    with pytest.raises(OSError):
+        result_cache.put(key, {'a' : np.arange(10)})
+    assert listdir(tmp_path / 'ab') == []
+    assert result_cache.get(key) is None
+
+def test_eviction(tmp_path):
+    record = {'a' : np.zeros(1000)}
+    result_cache = ResultCache(str(tmp_path), max_bytes=10**9)
+    keys = [f'{i:02x}' + '0' * 62 for i in range(10)]
+    for i, key in enumerate(keys):
+        result_cache.put(key, record)
+        # Written a minute apart, oldest first
+        path = result_cache._path(key)
+        utime(path, (1_000_000 + 60 * i, 1_000_000 + 60 * i))
+    size = getsize(result_cache._path(keys[0]))
+    # Reading the oldest makes it the most recently used
+    assert result_cache.get(keys[0]) is not None
+
+    result_cache.max_bytes = 8 * size
+    result_cache.evict()
+    # Down to LOW_WATER of max_bytes (7.2 records' worth, so 7), dropping
+    # the least recently used
+    assert result_cache._scan()[1] <= LOW_WATER * result_cache.max_bytes
+    left = [key for key in keys if result_cache.get(key) is not None]
+    assert left == [keys[0]] + keys[4:]
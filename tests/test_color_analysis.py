@@ -0,0 +1,36 @@
+import cv2
+import numpy as np
+import pytest
+
+from cw.utils.color_analysis import ImageAnalyzer
+from cw.utils.color_analysis import K_MAX
+
+def synthetic_png(size=96, n_colors=5, seed=0):
+    # A PNG of n_colors flat regions with some noise on top
+    rng = np.random.default_rng(seed)
+    palette = rng.integers(0, 256, (n_colors, 3))
+    sites = rng.random((n_colors, 2)) * size
+    ys, xs = np.mgrid[0:size, 0:size]
+    d = (ys[..., None] - sites[:, 0])**2 + (xs[..., None] - sites[:, 1])**2
+    noise = rng.normal(0, 8, (size, size, 3))
+    image = np.uint8(np.clip(palette[np.argmin(d, axis=2)] + noise, 0, 255))
+    return cv2.imencode('.png', image)[1].tobytes()
+
+@pytest.mark.parametrize('lean', [False, True])
+def test_parallel_sweep_matches_serial(lean):
+    data = synthetic_png()
+    serial = ImageAnalyzer('synthetic.png', image_bytes=data, workers=1, lean=lean)
+    parallel = ImageAnalyzer('synthetic.png', image_bytes=data, workers=3, lean=lean)
+
+    assert len(serial.cluster_data) == len(parallel.cluster_data) == K_MAX
+    for s, p in zip(serial.cluster_data, parallel.cluster_data):
+        k, compactness, labels, centroids = s
+        assert p[0] == k
+        assert p[1] == compactness
+        assert np.array_equal(p[3], centroids)
+        if lean:
+            assert p[2] is None
+            assert np.array_equal(parallel._entry_counts(p), serial._entry_counts(s))
+        else:
+            assert np.array_equal(p[2], labels)
+    assert parallel.dominant_colors_list() == serial.dominant_colors_list()
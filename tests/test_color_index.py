@@ -0,0 +1,64 @@
+import cv2
+import numpy as np
+import pytest
+
+from cw.color_index import ColorIndex
+from cw.models import ColorVolume
+from cw.models import Image
+
+def random_images(n=60, seed=0):
+    rng = np.random.default_rng(seed)
+    images = []
+    for i in range(n):
+        n_colors = rng.integers(1, 7)
+        volumes = rng.dirichlet(np.ones(n_colors))
+        colors = [ColorVolume(float(v), [int(c) for c in rng.integers(0, 256, 3)]) for v in volumes]
+        images.append(Image(colors, f'{i}.png', f'{i}.jpg'))
+    return images
+
+def signature(palette):
+    # [(rgb, volume), ...] as a cv2.EMD signature
+    volumes = np.float32([v for _, v in palette])
+    return np.float32(np.hstack(((volumes / volumes.sum())[:, None], [rgb for rgb, _ in palette])))
+
+def brute_force(images, palette, k):
+    # Every image's EMD to palette, nearest k first
+    query = signature(palette)
+    distances = []
+    for image in images:
+        other = signature([(c.rgb, c.relative_volume) for c in image.colors])
+        distances.append((cv2.EMD(query, other, cv2.DIST_L2)[0], image.source_image))
+    return [(key, emd) for emd, key in sorted(distances)[:k]]
+
+def assert_same_results(results, expected):
+    assert [key for key, _ in results] == [key for key, _ in expected]
+    assert np.allclose([d for _, d in results], [d for _, d in expected], rtol=1e-4, atol=1e-3)
+
+@pytest.mark.parametrize('rgb', [[230, 120, 20], [0, 0, 0], [128, 200, 255]])
+def test_by_color_matches_brute_force(rgb):
+    images = random_images()
+    index = ColorIndex.from_images(images)
+    assert_same_results(index.by_color(rgb, k=10), brute_force(images, [(rgb, 1)], 10))
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_by_palette_matches_brute_force(seed):
+    images = random_images()
+    rng = np.random.default_rng(seed)
+    palette = [(list(rng.integers(0, 256, 3)), float(v)) for v in rng.random(3)]
+    index = ColorIndex.from_images(images)
+    assert_same_results(index.by_palette(palette, k=10), brute_force(images, palette, 10))
+    # All of them, i.e. with nothing for the bound to cut off
+    assert_same_results(index.by_palette(palette, k=100), brute_force(images, palette, 100))
+
+def test_saved_index_gives_same_results(tmp_path):
+    index = ColorIndex.from_images(random_images())
+    index.save(str(tmp_path))
+    loaded = ColorIndex.load(str(tmp_path))
+    palette = [([230, 120, 20], 0.7), ([20, 20, 20], 0.3)]
+    assert loaded.by_palette(palette, k=5) == index.by_palette(palette, k=5)
+    assert loaded.by_color([20, 20, 20], k=5) == index.by_color([20, 20, 20], k=5)
+
+def test_k_zero():
+    index = ColorIndex.from_images(random_images())
+    assert index.by_color([230, 120, 20], k=0) == []
+    assert index.by_palette([([230, 120, 20], 1)], k=0) == []
@@ -0,0 +1,39 @@
+import numpy as np
+
+from cw.color_sorting import BACKGROUND
+from cw.color_sorting import color_int_to_float
+from cw.color_sorting import dominant_order
+from cw.color_sorting import strip
+from cw.columnar_models import ColumnarImageSet
+from cw.models import ColorVolume
+from cw.models import Image
+
+def test_strip():
+    image = strip([[1, 0, 0], [0, 0, 1]], width=10, height=2)
+    assert image.shape == (2, 10, 3)
+    assert (image[:, :5] == [0, 0, 255]).all() # BGR
+    assert (image[:, 5:] == [255, 0, 0]).all()
+
+def test_strip_without_colors():
+    image = strip([], width=10, height=2)
+    assert image.shape == (2, 10, 3)
+    assert (image == BACKGROUND).all()
+
+def test_strip_of_images_without_colors():
+    # As color_sorting.py --strip does it, for a set of images that haven't
+    # been analyzed
+    images = ColumnarImageSet.from_images([Image([], None, 'a.jpg'), Image([], None, 'b.jpg')])
+    order = dominant_order(images)
+    order = order[images.color_counts[order] > 0]
+    image = strip(color_int_to_float(images.dominant_rgb[order]), width=10, height=2)
+    assert (image == BACKGROUND).all()
+
+def test_dominant_order_puts_images_without_colors_last():
+    images = ColumnarImageSet.from_images([
+        Image([], None, 'none.jpg'),
+        Image([ColorVolume(1.0, [255, 255, 255])], None, 'white.jpg'),
+        Image([ColorVolume(1.0, [0, 0, 0])], None, 'black.jpg'),
+    ])
+    order = dominant_order(images, key='lum')
+    assert [images.source_image(i) for i in order] == ['black.jpg', 'white.jpg', 'none.jpg']
+    assert np.array_equal(images.color_counts[order], [1, 1, 0])
@@ -0,0 +1,84 @@
+from io import BytesIO
+
+import cv2
+import numpy as np
+import pytest
+
+from cw.utils.decode import _reduced_mode
+from cw.utils.decode import _stratified_sample
+from cw.utils.decode import decode_image
+from cw.utils.decode import fit
+from cw.utils.decode import jpeg_size
+from cw.utils.decode import read_image
+
+WIDTH = 800
+HEIGHT = 600
+
+def synthetic_image(seed=0):
+    rng = np.random.default_rng(seed)
+    ys, xs = np.mgrid[0:HEIGHT, 0:WIDTH]
+    image = np.stack((xs * 255 / WIDTH, ys * 255 / HEIGHT, (xs + ys) % 256), axis=2)
+    return np.uint8(np.clip(image + rng.normal(0, 8, image.shape), 0, 255))
+
+@pytest.mark.parametrize('max_pixels, mode', [
+    (None, cv2.IMREAD_COLOR),
+    (100 * 75, cv2.IMREAD_REDUCED_COLOR_8), # exactly 1/8 scale
+    (100 * 75 + 1, cv2.IMREAD_REDUCED_COLOR_4),
+    (200 * 150 + 1, cv2.IMREAD_REDUCED_COLOR_2),
+    (400 * 300, cv2.IMREAD_REDUCED_COLOR_2),
+    (400 * 300 + 1, cv2.IMREAD_COLOR),
+])
+def test_reduced_mode(max_pixels, mode):
+    assert _reduced_mode((WIDTH, HEIGHT), max_pixels) == mode
+
+def test_reduced_mode_rounds_up():
+    # libjpeg rounds the reduced size up: 801x601 at 1/8 is 101x76
+    assert _reduced_mode((801, 601), 101 * 76) == cv2.IMREAD_REDUCED_COLOR_8
+    assert _reduced_mode((801, 601), 101 * 76 + 1) == cv2.IMREAD_REDUCED_COLOR_4
+
+@pytest.mark.parametrize('max_pixels, shape', [
+    (100 * 75, (75, 100)), # decoded at 1/8, and no resize needed
+    (20000, (122, 163)), # decoded at 1/4 (200x150), then resized
+])
+def test_decode_jpeg(tmp_path, max_pixels, shape):
+    data = cv2.imencode('.jpg', synthetic_image())[1].tobytes()
+    assert jpeg_size(BytesIO(data)) == (WIDTH, HEIGHT)
+    image = decode_image(data, max_pixels)
+    assert image.shape == shape + (3,)
+    assert image.shape[0] * image.shape[1] <= max_pixels
+    # The same from a file
+    path = tmp_path / 'image.jpg'
+    path.write_bytes(data)
+    assert np.array_equal(read_image(str(path), max_pixels), image)
+
+def test_decode_png_is_resized():
+    # Not a JPEG, so it's decoded at full size and then resized
+    image = synthetic_image()
+    data = cv2.imencode('.png', image)[1].tobytes()
+    assert jpeg_size(BytesIO(data)) is None
+    decoded = decode_image(data, 20000)
+    assert decoded.shape == (122, 163, 3)
+    assert np.array_equal(decoded, cv2.resize(image, (163, 122), interpolation=cv2.INTER_AREA))
+    # and left alone without a budget, or if it's within it
+    assert np.array_equal(decode_image(data), image)
+    assert np.array_equal(decode_image(data, WIDTH * HEIGHT), image)
+
+def test_stratified_is_deterministic():
+    image = synthetic_image()
+    sample = fit(image, 20000, 'stratified')
+    assert np.array_equal(fit(image, 20000, 'stratified'), sample)
+    assert sample.shape[0] * sample.shape[1] <= 20000
+    # A different seed picks different pixels
+    assert not np.array_equal(_stratified_sample(image, 20000, seed=1), sample)
+
+def test_stratified_keeps_pixels_from_each_block():
+    # Every pixel of the sample is a pixel of the image, from its own block,
+    # so no new colors are made
+    rng = np.random.default_rng(0)
+    image = np.uint8(rng.integers(0, 256, (HEIGHT, WIDTH, 3)))
+    sample = fit(image, 20000, 'stratified')
+    cell = 5 # the smallest cell with at most 20000 blocks (120x160)
+    assert sample.shape[:2] == (HEIGHT // cell, -(-WIDTH // cell))
+    for row, col in [(0, 0), (10, 20), (sample.shape[0] - 1, sample.shape[1] - 1)]:
+        block = image[row*cell:(row+1)*cell, col*cell:(col+1)*cell].reshape((-1, 3))
+        assert (block == sample[row, col]).all(axis=1).any()
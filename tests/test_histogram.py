@@ -0,0 +1,93 @@
+from math import sqrt
+
+import cv2
+import numpy as np
+import pytest
+
+from cw.utils.color_analysis import ImageAnalyzer
+from cw.utils.histogram import ColorHistogram
+
+# BGR, and each color's share of the image
+PALETTE = np.array([[30, 60, 200], [200, 180, 40], [90, 200, 90], [240, 240, 240]])
+SHARES = [0.4, 0.3, 0.2, 0.1]
+
+def known_colors(sigma, seed=0, height=120, width=160):
+    # An image of PALETTE's colors in SHARES, with Gaussian noise
+    rng = np.random.default_rng(seed)
+    labels = rng.choice(len(PALETTE), height * width, p=SHARES)
+    pixels = PALETTE[labels] + rng.normal(0, sigma, (height * width, 3))
+    return np.uint8(np.clip(pixels, 0, 255)).reshape((height, width, 3))
+
+def bin_radius(bits):
+    # The furthest a pixel can be from its bin's mean (see histogram.py)
+    return sqrt(3) * (2**(8 - bits) - 1)
+
+def bin_index(pixels, bits):
+    q = np.intp(pixels.reshape((-1, 3))) >> (8 - bits)
+    return (q[:, 0] << (2 * bits)) | (q[:, 1] << bits) | q[:, 2]
+
+@pytest.mark.parametrize('bits', [5, 6])
+def test_bins_are_exact(bits):
+    image = known_colors(20)
+    pixels = np.float64(image.reshape((-1, 3)))
+    histogram = ColorHistogram(bits)
+    for strip in np.array_split(image, 7): # added a strip at a time, as tiled
+        histogram.add(strip)
+
+    index = bin_index(image, bits)
+    assert np.array_equal(histogram.occupied, np.unique(index))
+    assert histogram.n_pixels == len(pixels) == histogram.weights.sum()
+    for c in range(3):
+        sums = np.bincount(index, weights=pixels[:, c])[histogram.occupied]
+        assert np.allclose(histogram.points[:, c], sums / histogram.weights, rtol=0, atol=1e-4)
+    # The mean of any set of bins is the mean of the pixels in them
+    chosen = histogram.occupied[::3]
+    in_chosen = np.isin(index, chosen)
+    weights = histogram.weights[::3, None]
+    mean = (np.float64(histogram.points[::3]) * weights).sum(axis=0) / weights.sum()
+    assert np.allclose(mean, pixels[in_chosen].mean(axis=0), atol=1e-3)
+    # scatter is the pixels' squared distance to their bins' means
+    means = np.zeros((1 << (3 * bits), 3))
+    means[histogram.occupied] = histogram.points
+    scatter = np.sum((pixels - means[index])**2)
+    assert histogram.scatter == pytest.approx(scatter, rel=1e-6)
+    # and no pixel is further than the bin radius from its bin's mean
+    assert np.linalg.norm(pixels - means[index], axis=1).max() <= bin_radius(bits)
+
+@pytest.mark.parametrize('bits', [5, 6])
+def test_assignment_is_within_the_bound(bits):
+    # Every pixel goes to the centroid its bin's mean is nearest, which is at
+    # most 2r further away than the pixel's own nearest centroid
+    image = known_colors(40)
+    ia = ImageAnalyzer('image.png', image_bytes=cv2.imencode('.png', image)[1].tobytes(),
+        engine='histogram', histogram_bits=bits, profile='fast')
+    histogram = ia.histogram
+    pixels = np.float64(image.reshape((-1, 3)))
+    means = np.zeros((1 << (3 * bits), 3))
+    means[histogram.occupied] = histogram.points
+    index = bin_index(image, bits)
+    for k, _, _, centroids in ia.cluster_data:
+        centroids = np.float64(centroids)
+        bin_labels = np.linalg.norm(means[:, None] - centroids[None], axis=2).argmin(axis=1)
+        distances = np.linalg.norm(pixels[:, None] - centroids[None], axis=2)
+        assigned = distances[np.arange(len(pixels)), bin_labels[index]]
+        assert (assigned <= distances.min(axis=1) + 2 * bin_radius(bits) + 1e-6).all()
+
+@pytest.mark.parametrize('sigma', [4, 12])
+@pytest.mark.parametrize('bits', [5, 6])
+def test_palette_drift(bits, sigma):
+    # With the known colors apart, the histogram engine finds the same four
+    # as cv2.kmeans on every pixel, to within the bin radius (in practice
+    # exactly), and the same volumes
+    data = cv2.imencode('.png', known_colors(sigma))[1].tobytes()
+    pixels = ImageAnalyzer('image.png', image_bytes=data, engine='cv2', profile='fast')
+    bins = ImageAnalyzer('image.png', image_bytes=data, engine='histogram',
+        histogram_bits=bits, profile='fast')
+    expected, _ = pixels._fixed_k(4)
+    centroids, counts = bins._fixed_k(4)
+    distances = np.linalg.norm(np.float64(expected)[:, None] - centroids[None], axis=2)
+    match = distances.argmin(axis=1)
+    assert sorted(match) == [0, 1, 2, 3]
+    assert distances[np.arange(4), match].max() <= bin_radius(bits)
+    assert np.array_equal(pixels._fixed_k(4)[1], counts[match])
+    assert np.abs(np.sort(expected, axis=0) - np.sort(PALETTE, axis=0)).max() < 3
@@ -0,0 +1,72 @@
+from json import dumps
+
+from cw.utils.iiif import fetch_image
+
+IMAGE = b'not really a jpeg'
+
+def serve(stub_server, info, expected_path):
+    # Serves info at /iiif/img/info.json (with its id filled in), and IMAGE at
+    # expected_path only; returns the service's URI
+    service = f'{stub_server.url}/iiif/img'
+    key = 'id' if 'id' in info else '@id'
+    stub_server.routes['/iiif/img/info.json'] = [(200, dumps(dict(info, **{key : service})).encode())]
+    stub_server.routes[expected_path] = [(200, IMAGE)]
+    return service
+
+def v2_info(level, **values):
+    return dict({
+        '@context' : 'http://iiif.io/api/image/2/context.json',
+        '@id' : None,
+        'profile' : [f'http://iiif.io/api/image/2/level{level}.json'],
+        'width' : 4000,
+        'height' : 3000,
+    }, **values)
+
+def v3_info(level, **values):
+    return dict({
+        '@context' : 'http://iiif.io/api/image/3/context.json',
+        'id' : None,
+        'type' : 'ImageService3',
+        'profile' : f'level{level}',
+        'width' : 4000,
+        'height' : 3000,
+    }, **values)
+
+SIZES = [
+    {'width' : 250, 'height' : 188},
+    {'width' : 1000, 'height' : 750},
+    {'width' : 2000, 'height' : 1500},
+]
+
+def test_level0_picks_the_smallest_size_that_is_big_enough(stub_server):
+    # 500,000 pixels: 250x188 is too small, 1000x750 is the smallest that isn't
+    service = serve(stub_server, v2_info(0, sizes=SIZES), '/iiif/img/full/1000,/0/default.jpg')
+    assert fetch_image(service, max_pixels=500_000) == IMAGE
+    assert stub_server.requests == ['/iiif/img/info.json', '/iiif/img/full/1000,/0/default.jpg']
+
+def test_level0_sizes_are_asked_for_as_listed_in_3x(stub_server):
+    service = serve(stub_server, v3_info(0, sizes=SIZES), '/iiif/img/full/1000,750/0/default.jpg')
+    assert fetch_image(service, max_pixels=500_000) == IMAGE
+
+def test_level0_without_a_big_enough_size_gets_the_full_image(stub_server):
+    service = serve(stub_server, v2_info(0, sizes=SIZES), '/iiif/img/full/full/0/default.jpg')
+    assert fetch_image(service, max_pixels=5_000_000) == IMAGE
+
+def test_level1_is_asked_for_the_size_that_fits(stub_server):
+    # sqrt(1,200,000 / 12,000,000) of 4000 wide is 1265 (rounded up), which
+    # at 4:3 is at least 1,200,000 pixels
+    service = serve(stub_server, v2_info(1), '/iiif/img/full/1265,/0/default.jpg')
+    assert fetch_image(service, max_pixels=1_200_000) == IMAGE
+
+def test_level1_respects_the_services_limits(stub_server):
+    service = serve(stub_server, v3_info(2, maxWidth=1000), '/iiif/img/full/1000,/0/default.jpg')
+    assert fetch_image(service, max_pixels=1_200_000) == IMAGE
+
+def test_small_images_are_fetched_whole(stub_server):
+    # The image already has fewer than max_pixels pixels ('max' in 3.x)
+    service = serve(stub_server, v3_info(1), '/iiif/img/full/max/0/default.jpg')
+    assert fetch_image(service, max_pixels=20_000_000) == IMAGE
+
+def test_without_max_pixels_the_full_image_is_fetched(stub_server):
+    service = serve(stub_server, v2_info(1), '/iiif/img/full/full/0/default.jpg')
+    assert fetch_image(f'{service}/info.json') == IMAGE
@@ -0,0 +1,63 @@
+from json import dumps
+from os import listdir
+from os.path import join
+
+from cw.utils.image_fetch import ImageCollector
+
+IIIF_PARAMS = '/full/!800,800/0/default.jpg'
+
+def collection(base_url, n):
+    # A IIIF Collection of n manifests, whose thumbnails are services at
+    # /thumbs/1, /thumbs/2...
+    return {'manifests' : [{
+        'label' : [f'Item {i}'],
+        '@id' : f'{base_url}/manifests/{i}',
+        'thumbnail' : {'service' : {'@id' : f'{base_url}/thumbs/{i}'}},
+    } for i in range(1, n + 1)]}
+
+def test_download_thumbnails(stub_server, tmp_path):
+    # The first thumbnail fails once and is retried; the second is already
+    # there, so it isn't asked for.
+    stub_server.routes['/collection'] = [(200, dumps(collection(stub_server.url, 2)).encode())]
+    stub_server.routes[f'/thumbs/1{IIIF_PARAMS}'] = [(503, b''), (200, b'one')]
+    stub_server.routes[f'/thumbs/2{IIIF_PARAMS}'] = [(200, b'two')]
+    (tmp_path / '0002.jpg').write_bytes(b'already here')
+
+    collector = ImageCollector(f'{stub_server.url}/collection',
+        iiif_params=IIIF_PARAMS, images_dir=str(tmp_path), workers=2,
+        backoff=0.01)
+    failed = collector.download_thumbnails()
+
+    assert failed == []
+    assert stub_server.requests.count(f'/thumbs/1{IIIF_PARAMS}') == 2
+    assert f'/thumbs/2{IIIF_PARAMS}' not in stub_server.requests
+    assert (tmp_path / '0001.jpg').read_bytes() == b'one'
+    assert (tmp_path / '0002.jpg').read_bytes() == b'already here'
+    assert sorted(listdir(tmp_path)) == ['0001.jpg', '0002.jpg'] # no .part files
+
+def test_download_thumbnails_gives_up(stub_server, tmp_path):
+    # A thumbnail that never comes back is reported, and leaves nothing behind
+    stub_server.routes['/collection'] = [(200, dumps(collection(stub_server.url, 1)).encode())]
+    stub_server.routes[f'/thumbs/1{IIIF_PARAMS}'] = [(503, b'')]
+
+    collector = ImageCollector(f'{stub_server.url}/collection',
+        iiif_params=IIIF_PARAMS, images_dir=str(tmp_path), retries=2,
+        backoff=0.01)
+    failed = collector.download_thumbnails()
+
+    assert failed == [f'{stub_server.url}/thumbs/1{IIIF_PARAMS}']
+    assert stub_server.requests.count(f'/thumbs/1{IIIF_PARAMS}') == 3
+    assert listdir(tmp_path) == []
+
+def test_download_thumbnails_cut_short(stub_server, tmp_path):
+    # A response that ends early doesn't leave a .part file (or a partial
+    # image) behind
+    stub_server.routes['/collection'] = [(200, dumps(collection(stub_server.url, 1)).encode())]
+    stub_server.routes[f'/thumbs/1{IIIF_PARAMS}'] = [(200, b'par', {'Content-Length' : '100'})]
+
+    collector = ImageCollector(f'{stub_server.url}/collection',
+        iiif_params=IIIF_PARAMS, images_dir=str(tmp_path), backoff=0.01)
+    failed = collector.download_thumbnails()
+
+    assert failed == [f'{stub_server.url}/thumbs/1{IIIF_PARAMS}']
+    assert listdir(tmp_path) == []
@@ -0,0 +1,35 @@
+from cw.models import ColorVolume
+from cw.models import Image
+from cw.models import ImageSet
+from cw.models import ImageStore
+
+def image(n):
+    colors = [ColorVolume(0.75, [n, 0, 0]), ColorVolume(0.25, [0, n, 0])]
+    return Image(colors, f'palettes/{n}.png', f'images/{n}.jpg')
+
+def store_with_partial_line(path):
+    with ImageStore(str(path)) as store:
+        store.append(image(1))
+        store.append(image(2))
+    with open(path, 'ab') as f:
+        f.write(b'{"colors": [{"relative_vo') # e.g. a crash mid-append
+
+def test_reading_leaves_partial_line(tmp_path):
+    path = tmp_path / 'store.jsonl'
+    store_with_partial_line(path)
+    before = path.read_bytes()
+
+    images = ImageSet.from_file(str(path))
+    assert [i.source_image for i in images] == ['images/1.jpg', 'images/2.jpg']
+    assert len(ImageStore(str(path))) == 2
+    assert path.read_bytes() == before
+
+def test_append_cuts_off_partial_line(tmp_path):
+    path = tmp_path / 'store.jsonl'
+    store_with_partial_line(path)
+
+    with ImageStore(str(path)) as store:
+        store.append(image(3))
+    assert path.read_bytes().count(b'\n') == 3
+    images = list(ImageStore(str(path)))
+    assert images == [image(1), image(2), image(3)]
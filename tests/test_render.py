@@ -0,0 +1,65 @@
+import numpy as np
+import pytest
+
+from cw.utils.render import render_strip
+from cw.utils.render import render_strips
+
+# The loops ImageAnalyzer.viz used before render.py: paint each color from
+# where it starts to the right edge, over whatever was there
+
+def paint_weighted(colors, width, height):
+    image = np.zeros((height, width, 3), np.uint8)
+    total_pixels = sum([t[1] for t in colors])
+    offset = 0
+    for i in range(len(colors)):
+        if i == len(colors)-1:
+            section_width = width - offset
+        else:
+            section_width = int(colors[i][1] / total_pixels * width)
+        image[:, offset:width] = colors[i][0]
+        offset = offset + section_width
+    return image
+
+def paint_unweighted(colors, width, height):
+    image = np.zeros((height, width, 3), np.uint8)
+    section_width = 1/len(colors)
+    for i in range(len(colors)):
+        offset = int(i*section_width*width)
+        image[:, offset:width] = colors[i][0]
+    return image
+
+PAINT = {True : paint_weighted, False : paint_unweighted}
+
+def random_palettes(n, seed=0):
+    # [(BGR, volume), ...] as from ImageAnalyzer.dominant_colors: pixel
+    # counts, or relative volumes
+    rng = np.random.default_rng(seed)
+    palettes = []
+    for i in range(n):
+        k = rng.integers(1, 13)
+        bgr = [list(map(int, c)) for c in rng.integers(0, 256, (k, 3))]
+        if i % 2:
+            volumes = [int(v) for v in rng.integers(1, 100000, k)]
+        else:
+            volumes = list(rng.dirichlet(np.ones(k)))
+        palettes.append(list(zip(bgr, volumes)))
+    return palettes
+
+@pytest.mark.parametrize('weighted', [True, False])
+@pytest.mark.parametrize('width', [1, 7, 100, 400, 997])
+def test_render_strip_matches_painting(weighted, width):
+    for colors in random_palettes(200, seed=width):
+        expected = PAINT[weighted](colors, width, 3)
+        assert np.array_equal(render_strip(colors, width, 3, weighted), expected)
+
+@pytest.mark.parametrize('weighted', [True, False])
+def test_render_strips_matches_painting(weighted):
+    palettes = random_palettes(50)
+    strips = render_strips(palettes, 120, 5, weighted)
+    assert strips.shape == (50, 5, 120, 3)
+    for strip, colors in zip(strips, palettes):
+        assert np.array_equal(strip, PAINT[weighted](colors, 120, 5))
+    # and into a given array
+    out = np.ones((50, 5, 120, 3), np.uint8)
+    assert render_strips(palettes, 120, 5, weighted, out=out) is out
+    assert np.array_equal(out, strips)
@@ -0,0 +1,62 @@
+from cw.models import ColorVolume
+from cw.models import Image
+from cw.models import ImageSet
+from cw.models import ImageStore
+from cw.sql_models import SQLiteImageSet
+
+IMAGES = [
+    Image([ColorVolume(0.6, [230, 120, 20]), ColorVolume(0.4, [20, 20, 20])], 'p/1.png', 'i/1.jpg'),
+    Image([ColorVolume(0.1, [235, 110, 30]), ColorVolume(0.2, [0, 0, 255]),
+        ColorVolume(0.7, [255, 255, 255])], 'p/2.png', 'i/2.jpg'),
+    Image([ColorVolume(1 / 3, [20, 20, 20]), ColorVolume(2 / 3, [200, 200, 200])], 'p/3.png', 'i/3.jpg'),
+    Image([], None, 'i/4.jpg'), # not analyzed
+    Image([ColorVolume(0.5, [240, 130, 10]), ColorVolume(0.5, [10, 10, 10])], 'p/5.png', 'i/5.jpg'),
+]
+
+def test_json_round_trip(tmp_path):
+    json_path = tmp_path / 'data.json'
+    ImageSet(list(IMAGES)).save(str(json_path))
+    with SQLiteImageSet(str(tmp_path / 'data.db')) as images:
+        images.import_file(str(json_path))
+        images.export_json(str(tmp_path / 'export.json'))
+        assert list(images) == IMAGES
+        assert images[1] == IMAGES[1]
+        assert images[-1] == IMAGES[-1]
+        assert images[1:3] == IMAGES[1:3]
+    assert (tmp_path / 'export.json').read_bytes() == json_path.read_bytes()
+
+def test_import_twice_upserts(tmp_path):
+    store_path = str(tmp_path / 'data.jsonl')
+    with ImageStore(store_path) as store:
+        for image in IMAGES:
+            store.append(image)
+    with SQLiteImageSet(str(tmp_path / 'data.db')) as images:
+        images.import_file(store_path)
+        images.import_file(store_path)
+        assert len(images) == len(IMAGES)
+        n_colors = images._connection.execute('SELECT COUNT(*) FROM colors').fetchone()[0]
+        assert n_colors == sum(len(image.colors) for image in IMAGES)
+        # A changed image replaces the old one, in the same place
+        changed = Image([ColorVolume(1.0, [1, 2, 3])], 'p/2b.png', 'i/2.jpg')
+        images.append(changed)
+        assert len(images) == len(IMAGES)
+        assert images[1] == changed
+
+def test_by_dominant_color(tmp_path):
+    with SQLiteImageSet(str(tmp_path / 'data.db')) as images:
+        images.extend(IMAGES)
+        orange = [i.source_image for i in images.by_dominant_color([230, 120, 20])]
+        assert orange == ['i/1.jpg', 'i/2.jpg', 'i/5.jpg']
+        assert [i.source_image for i in images.by_dominant_color([230, 120, 20], tolerance=5)] == ['i/1.jpg']
+        assert [i.source_image for i in images.by_dominant_color([230, 120, 20], limit=2)] == orange[:2]
+        # The images come back whole
+        assert list(images.by_dominant_color([20, 20, 20], tolerance=0)) == [IMAGES[2]]
+
+def test_by_color_variance(tmp_path):
+    with SQLiteImageSet(str(tmp_path / 'data.db')) as images:
+        images.extend(IMAGES)
+        expected = sorted((i for i in IMAGES if i.colors), key=lambda i: i.color_variance)
+        assert list(images.by_color_variance()) == expected
+        assert [i.source_image for i in images.by_color_variance(high=0.01)] == ['i/5.jpg', 'i/1.jpg']
+        assert [i.source_image for i in images.by_color_variance(low=0.05)] == ['i/2.jpg']
+        assert list(images.by_color_variance(limit=1)) == expected[:1]
@@ -0,0 +1,127 @@
+from json import dumps
+
+import cv2
+import numpy as np
+import pytest
+
+from cw.utils.color_analysis import ImageAnalyzer
+from cw.utils.color_analysis import TILED_ENGINES
+from cw.utils.tiles import IIIFSource
+from cw.utils.tiles import PngSource
+from cw.utils.tiles import TiffSource
+
+WIDTH = 200
+HEIGHT = 150
+TILE_PIXELS = 2000 # i.e. strips of 10 rows, so every image has lots of them
+IIIF_TILE = (64, 48) # doesn't divide the image evenly, on purpose
+
+def synthetic_image(seed=0):
+    # Smooth gradients plus noise, so that there are plenty of colors
+    rng = np.random.default_rng(seed)
+    ys, xs = np.mgrid[0:HEIGHT, 0:WIDTH]
+    image = np.stack((xs * 255 / WIDTH, ys * 255 / HEIGHT, (xs + ys) % 256), axis=2)
+    return np.uint8(np.clip(image + rng.normal(0, 12, image.shape), 0, 255))
+
+def png_8_bit():
+    return cv2.imencode('.png', synthetic_image())[1].tobytes()
+
+def png_16_bit():
+    # The low bytes vary too, so that they have to be dropped the same way
+    rng = np.random.default_rng(1)
+    image = np.uint16(synthetic_image()) * 256 + np.uint16(rng.integers(0, 256, (HEIGHT, WIDTH, 3)))
+    return cv2.imencode('.png', image)[1].tobytes()
+
+def tiff_compressed():
+    # libtiff's default LZW, in strips of a few rows
+    return cv2.imencode('.tiff', synthetic_image())[1].tobytes()
+
+def tiff_uncompressed():
+    # One strip for the whole image, which has to be cut into pieces
+    params = [cv2.IMWRITE_TIFF_COMPRESSION, 1, cv2.IMWRITE_TIFF_ROWSPERSTRIP, HEIGHT]
+    return cv2.imencode('.tiff', synthetic_image(), params)[1].tobytes()
+
+# name -> (make the image, the source that should read it)
+IMAGES = {
+    'image.png' : (png_8_bit, PngSource),
+    'image-16.png' : (png_16_bit, PngSource),
+    'image.tiff' : (tiff_compressed, TiffSource),
+    'image-uncompressed.tiff' : (tiff_uncompressed, TiffSource),
+}
+
+def assert_same_analysis(whole, tiled):
+    assert len(tiled.cluster_data) == len(whole.cluster_data)
+    for w, t in zip(whole.cluster_data, tiled.cluster_data):
+        assert t[0] == w[0]
+        assert t[1] == w[1]
+        assert np.array_equal(t[3], w[3])
+    assert tiled.dominant_colors_list() == whole.dominant_colors_list()
+
+@pytest.mark.parametrize('engine', TILED_ENGINES)
+@pytest.mark.parametrize('name', IMAGES)
+def test_tiled_matches_whole(name, engine):
+    make_image, source = IMAGES[name]
+    data = make_image()
+    # (The profile makes no difference to whether they match; 'fast' is fast.)
+    whole = ImageAnalyzer(name, image_bytes=data, engine=engine, profile='fast')
+    tiled = ImageAnalyzer(name, image_bytes=data, engine=engine, profile='fast',
+        tiled=True, tile_pixels=TILE_PIXELS)
+    assert isinstance(tiled.tiles, source) # i.e. really read in strips
+    assert_same_analysis(whole, tiled)
+
+def iiif_service(stub_server, image):
+    # Serves image from a stub level 1 service with IIIF_TILE tiles; returns
+    # its URI. The tiles (and the full image) are PNGs, so they decode to
+    # exactly the same pixels.
+    service = f'{stub_server.url}/iiif/img'
+    info = {
+        '@context' : 'http://iiif.io/api/image/2/context.json',
+        '@id' : service,
+        'profile' : ['http://iiif.io/api/image/2/level1.json'],
+        'width' : WIDTH,
+        'height' : HEIGHT,
+        'tiles' : [{'width' : IIIF_TILE[0], 'height' : IIIF_TILE[1], 'scaleFactors' : [1, 2]}],
+    }
+    routes = stub_server.routes
+    routes['/iiif/img/info.json'] = [(200, dumps(info).encode())]
+    routes['/iiif/img/full/full/0/default.jpg'] = [(200, cv2.imencode('.png', image)[1].tobytes())]
+    for top in range(0, HEIGHT, IIIF_TILE[1]):
+        for left in range(0, WIDTH, IIIF_TILE[0]):
+            tile = image[top:top+IIIF_TILE[1], left:left+IIIF_TILE[0]]
+            h, w = tile.shape[:2]
+            path = f'/iiif/img/{left},{top},{w},{h}/full/0/default.jpg'
+            routes[path] = [(200, cv2.imencode('.png', tile)[1].tobytes())]
+    return service
+
+# The minibatch engine's results depend on the order the pixels come in, so
+# they only match when the service's tiles come a whole row at a time
+IIIF_TILE_PIXELS = {
+    'histogram' : TILE_PIXELS, # i.e. one tile at a time
+    'minibatch' : 4 * IIIF_TILE[0] * IIIF_TILE[1], # (the last is only 8 wide)
+}
+
+@pytest.mark.parametrize('engine', TILED_ENGINES)
+def test_tiled_iiif_matches_whole(stub_server, engine):
+    service = iiif_service(stub_server, synthetic_image())
+    whole = ImageAnalyzer(service, engine=engine, profile='fast')
+    tiled = ImageAnalyzer(service, engine=engine, profile='fast', tiled=True,
+        tile_pixels=IIIF_TILE_PIXELS[engine])
+    assert isinstance(tiled.tiles, IIIFSource)
+    assert_same_analysis(whole, tiled)
+
+@pytest.mark.parametrize('tiles_per_group', [1, 2, 4])
+def test_iiif_strips_are_bounded(stub_server, tiles_per_group):
+    # Each row of tiles comes in groups of at most tile_pixels, which put
+    # back together are the image
+    image = synthetic_image()
+    tile_pixels = tiles_per_group * IIIF_TILE[0] * IIIF_TILE[1]
+    with ImageAnalyzer(iiif_service(stub_server, image), engine='histogram',
+            tiled=True, tile_pixels=tile_pixels) as ia:
+        strips = list(ia.tiles.strips())
+    assert all(s.shape[0] * s.shape[1] <= tile_pixels for s in strips)
+    rows = []
+    while strips:
+        row = [strips.pop(0)]
+        while sum(s.shape[1] for s in row) < WIDTH:
+            row.append(strips.pop(0))
+        rows.append(np.concatenate(row, axis=1))
+    assert np.array_equal(np.concatenate(rows), image)